@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Report the cold start cost of each lambda handler module.
+
+Every module is imported in a fresh interpreter, like a cold container of Lambda, and the wall
+time of the import is reported along with the slowest imports from `python -X importtime`.
+No AWS request is expected while importing, the AWS credentials are not required.
+
+Usage:
+    python benchmarks/import_time.py [--rounds 5] [--top 5]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_converter')
+HANDLERS = ['auto_executor', 'manual_executor', 'task_event']
+
+_SNIPPET = 'import time; t = time.perf_counter(); import %s; print(time.perf_counter() - t)'
+
+
+def _run(args: list) -> subprocess.CompletedProcess:
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    return subprocess.run([sys.executable] + args, cwd=SOURCE_DIR, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def import_seconds(module: str) -> float:
+    """ Wall time in seconds to import the module in a fresh interpreter """
+    return float(_run(['-c', _SNIPPET % module]).stdout.strip())
+
+
+def slowest_imports(module: str, top: int) -> list:
+    """ The slowest imports with their cumulative time in microseconds """
+    imports = []
+    for line in _run(['-X', 'importtime', '-c', 'import %s' % module]).stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name[1:]
+        # the nested imports are indented by 2 spaces per level, keep the direct ones of module
+        if len(name) - len(name.lstrip(' ')) <= 2:
+            imports.append((int(cumulative), name.strip()))
+
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5, help='times to import each module')
+    parser.add_argument('--top', type=int, default=5, help='number of slowest imports to show')
+    args = parser.parse_args()
+
+    for module in HANDLERS:
+        samples = [import_seconds(module) for _ in range(args.rounds)]
+        print('%-16s median %8.1f ms  min %8.1f ms  max %8.1f ms'
+              % (module, statistics.median(samples) * 1000, min(samples) * 1000, max(samples) * 1000))
+
+        for cumulative, name in slowest_imports(module, args.top):
+            print('    %8.1f ms  %s' % (cumulative / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the per job cost to build the `create_job` params of MediaConvert.
+
+`legacy` reads and parses `task_params.json` for every job, `builder` uses the `JobSpecBuilder`
+which loads it once and copies the merged base with the input and output patched.
+
+Usage:
+    python benchmarks/job_spec.py [--objects 10000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_converter')
+sys.path.insert(0, SOURCE_DIR)
+
+from job_spec import BASE_PARAMS_FILE, JobSpecBuilder  # noqa: E402
+
+ROLE = 'arn:aws:iam::000000000000:role/VideoConverterJobRole'
+TEMPLATE = 'benchmark-template'
+
+
+class _Options:
+    """ Stand-in of the option store with one bucket overlay """
+    def __init__(self):
+        self.values = {
+            'bench-bucket-JobParams': json.dumps({'Settings': {'TimecodeConfig': {'Source': 'ZEROBASED'}}}),
+        }
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+
+def legacy(bucket: str, key: str) -> dict:
+    with open(BASE_PARAMS_FILE, 'r') as f:
+        params = json.load(f)
+        params['Role'] = ROLE
+        params['JobTemplate'] = TEMPLATE
+        params['Settings']['Inputs'][0]['FileInput'] = 's3://%s/%s' % (bucket, key)
+
+    params['Settings']['OutputGroups'] = [{
+        'OutputGroupSettings': {
+            'Type': 'FILE_GROUP_SETTINGS',
+            'FileGroupSettings': {'Destination': 's3://output/%s' % key[0:key.rindex('/') + 1]},
+        }
+    }]
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=10000, help='number of objects in the task')
+    args = parser.parse_args()
+
+    keys = ['sub-dir/%06d.mp4' % i for i in range(args.objects)]
+    builder = JobSpecBuilder(_Options())
+
+    start = time.perf_counter()
+    for key in keys:
+        legacy('bench-bucket', key)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in keys:
+        builder.build('bench-bucket', TEMPLATE, 's3://bench-bucket/%s' % key, ROLE,
+                      's3://output/%s' % key[0:key.rindex('/') + 1])
+    builder_seconds = time.perf_counter() - start
+
+    for name, seconds in (('legacy', legacy_seconds), ('builder', builder_seconds)):
+        print('%-8s total %8.1f ms  per job %7.2f us' % (name, seconds * 1000, seconds / args.objects * 1e6))
+    print('speedup  %.1fx' % (legacy_seconds / builder_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the cost to decode the JSON output of mediainfo into `MediaInfo`.
+
+`legacy` parses the document, coerces the string values by a recursive walk and normalizes the
+keys by another one. `single-pass` is the `_Decoder` of `mediainfo.py` which normalizes the keys
+and coerces the values by the `object_pairs_hook` while parsing.
+The corpus has the output of `docs/mediainfo.json` with the keys in the case of mediainfo, and
+the same output with a menu track of many chapters as a long movie or an audio book has.
+
+Usage:
+    python benchmarks/mediainfo_decode.py [--rounds 200] [--chapters 5000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_converter')
+sys.path.insert(0, SOURCE_DIR)
+
+from mediainfo import MediaInfo, _Decoder  # noqa: E402
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs', 'mediainfo.json')
+
+
+class _LegacyDecoder(json.JSONDecoder):
+    def decode(self, s, **kwargs):
+        return self._decode(super().decode(s))
+
+    def _decode(self, o):
+        if isinstance(o, str):
+            if o.lower() == 'true':
+                return True
+            elif o.lower() == 'false':
+                return False
+            else:
+                try:
+                    return int(o)
+                except ValueError:
+                    try:
+                        return float(o)
+                    except ValueError:
+                        return o
+        elif isinstance(o, dict):
+            return {k: self._decode(v) for k, v in o.items()}
+        elif isinstance(o, list):
+            return [self._decode(v) for v in o]
+        else:
+            return o
+
+
+def _legacy_format_keys(x):
+    if isinstance(x, list):
+        return [_legacy_format_keys(v) for v in x]
+    elif isinstance(x, dict):
+        return {k.lower().strip().strip('_'): _legacy_format_keys(v) for k, v in x.items()}
+    else:
+        return x
+
+
+def legacy(raw: str) -> MediaInfo:
+    return MediaInfo(_legacy_format_keys(json.loads(raw, cls=_LegacyDecoder)))
+
+
+def single_pass(raw: str) -> MediaInfo:
+    return MediaInfo(json.loads(raw, cls=_Decoder))
+
+
+def _raw_output(chapters: int) -> dict:
+    """ The sample output with keys in the case of mediainfo, and a menu track of chapters if any """
+    with open(SAMPLE_FILE, 'r') as f:
+        output = json.load(f)
+
+    def raw(x):
+        if isinstance(x, dict):
+            return {k if k.startswith('@') or k in ('media', 'track') else k.title(): raw(v) for k, v in x.items()}
+        if isinstance(x, list):
+            return [raw(v) for v in x]
+        return str(x) if isinstance(x, (int, float)) and not isinstance(x, bool) else x
+
+    output = raw(output)
+    if chapters > 0:
+        marks = {'_%02d_%02d_%02d_%03d' % (i // 3600, i // 60 % 60, i % 60, i % 1000): 'en:Chapter %d' % (i + 1)
+                 for i in range(chapters)}
+        output['media']['track'].append({
+            '@type': 'Menu',
+            'Chapters_Pos_Begin': '100',
+            'Chapters_Pos_End': str(100 + chapters),
+            'extra': marks,
+        })
+
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=200, help='number of decodes of each output')
+    parser.add_argument('--chapters', type=int, default=5000, help='number of chapters in the menu track')
+    args = parser.parse_args()
+
+    corpus = [('sample', json.dumps(_raw_output(0))), ('menu', json.dumps(_raw_output(args.chapters)))]
+
+    print('%-8s %10s %14s %14s %8s' % ('output', 'size(KiB)', 'legacy(ms)', 'single(ms)', 'speedup'))
+    for name, raw in corpus:
+        assert legacy(raw) == single_pass(raw), 'decoded outputs are different'
+
+        timings = []
+        for decode in (legacy, single_pass):
+            started = time.perf_counter()
+            for _ in range(args.rounds):
+                decode(raw)
+            timings.append((time.perf_counter() - started) / args.rounds * 1000)
+
+        print('%-8s %10.1f %14.3f %14.3f %7.1fx'
+              % (name, len(raw) / 1024, timings[0], timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
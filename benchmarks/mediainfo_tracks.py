@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the time and memory of the MediaInfo track models.
+
+`legacy` is the former `Track` which copies each nested dict by a JSON round trip, keeps the
+attributes in the instance dict and filters the tracks on each `video_tracks` access.
+`compact` is the `Track` of `mediainfo.py` which keeps the parsed dict of track, materializes an
+attribute into the instance dict on its first access and indexes the tracks by type once.
+The memory is the one retained after the accesses.
+The input is the output of `docs/mediainfo.json`.
+
+Usage:
+    python benchmarks/mediainfo_tracks.py [--files 2000] [--accesses 20]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_converter')
+sys.path.insert(0, SOURCE_DIR)
+
+from mediainfo import MediaInfo, RecursiveNamespace, _Decoder  # noqa: E402
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docs', 'mediainfo.json')
+
+
+class _LegacyTrack:
+    def __getattribute__(self, name):
+        try:
+            return object.__getattribute__(self, name)
+        except AttributeError:
+            pass
+        return None
+
+    def __init__(self, track: dict):
+        self.track_type = track["@type"]
+        repeated_attributes = []
+        for k, v in track.items():
+            if k == "id":
+                k = "track_id"
+
+            if getattr(self, k) is None:
+                if isinstance(v, dict):
+                    v = json.loads(json.dumps(v), object_hook=lambda d: RecursiveNamespace(**d))
+                setattr(self, k, v)
+            else:
+                other_name = f"other_{k}"
+                repeated_attributes.append((k, other_name))
+                if getattr(self, other_name) is None:
+                    setattr(self, other_name, [v])
+                else:
+                    getattr(self, other_name).append(v)
+
+        for primary_key, other_key in repeated_attributes:
+            try:
+                setattr(self, primary_key, int(getattr(self, primary_key)))
+            except ValueError:
+                for other_value in getattr(self, other_key):
+                    try:
+                        current = getattr(self, primary_key)
+                        setattr(self, primary_key, int(other_value))
+                        getattr(self, other_key).append(current)
+                        break
+                    except ValueError:
+                        pass
+
+
+class _LegacyMediaInfo:
+    def __init__(self, mi_output: dict):
+        self.tracks = [_LegacyTrack(t) for t in mi_output.get('media', dict()).get('track', [])]
+
+    @property
+    def video_tracks(self):
+        return [track for track in self.tracks if track.track_type == 'Video']
+
+
+def _run(cls, outputs: list, accesses: int) -> tuple:
+    tracemalloc.start()
+    started = time.perf_counter()
+    infos = [cls(output) for output in outputs]
+    built = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for mi in infos:
+        for _ in range(accesses):
+            for track in mi.video_tracks:
+                _ = track.width, track.height, track.non_existing
+    accessed = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return built, accessed, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000, help='number of media files')
+    parser.add_argument('--accesses', type=int, default=20, help='number of video track accesses of each file')
+    args = parser.parse_args()
+
+    with open(SAMPLE_FILE, 'r') as f:
+        raw = f.read()
+    outputs = [json.loads(raw, cls=_Decoder) for _ in range(args.files)]
+
+    print('%-8s %12s %12s %12s' % ('model', 'build(ms)', 'access(ms)', 'memory(KiB)'))
+    for name, cls in (('legacy', _LegacyMediaInfo), ('compact', MediaInfo)):
+        built, accessed, memory = _run(cls, outputs, args.accesses)
+        print('%-8s %12.1f %12.1f %12.1f' % (name, built * 1000, accessed * 1000, memory / 1024))
+
+
+if __name__ == '__main__':
+    main()
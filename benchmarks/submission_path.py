@@ -0,0 +1,614 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end load test of the submission path against local stand-ins of the AWS services.
+
+`manual` sends one message of the whole bucket to `manual_executor.lambda_handler` and invokes it
+again with each continuation message until the task is done. `auto` sends one S3 event per object
+buffered by SQS to `auto_executor.lambda_handler` in batches of `--batch` messages, the failed
+messages of a batch are sent again.
+S3, DynamoDB, MediaConvert and SQS are in-memory stand-ins which count every API call and spend
+`--latency-ms` on it. The buckets have `--objects` synthetic objects and the tables are empty
+before each run.
+The wall time, the API calls of each service and the calls per job created are reported, run it
+with `--operations` to see the calls of each operation.
+With `--events`, the COMPLETE event of each job is sent to `task_event.batch_handler` as soon as the
+job is created, before its task item is written by the executor, and the failed events are sent
+again after the run. The run fails unless every job is settled and no running job is counted.
+
+Usage:
+    python benchmarks/submission_path.py [--objects 100 10000 100000] [--handlers manual auto]
+                                         [--latency-ms 0] [--batch 10] [--operations] [--events]
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import types
+import urllib.parse
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_converter')
+sys.path.insert(0, SOURCE_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/000000000000/bench-tasks')
+os.environ.setdefault('MEDIACONVERT_ENDPOINT', 'https://bench.mediaconvert.us-east-1.amazonaws.com')
+
+import boto3  # noqa: E402
+import task  # noqa: E402
+import manual_executor  # noqa: E402
+import auto_executor  # noqa: E402
+import task_event  # noqa: E402
+
+BUCKET = 'bench-bucket'
+TEMPLATE = 'bench-template'
+QUERY_PAGE_SIZE = 1000  # The max number of items in a page of query and scan, as the 1 MB page of DynamoDB
+MAX_INVOCATIONS = 10000  # The max invocations of the manual handler for one task
+MAX_RECEIVES = 5  # The max times a message is sent to the auto handler
+
+OPTIONS = {
+    'default-JobTemplate': TEMPLATE,
+    'default-OutputBucket': 'bench-output',
+    'MediaConvertJobRole': 'arn:aws:iam::000000000000:role/VideoConverterJobRole',
+    'MaxJobSubmitRate': '1000000',  # not paced, the creates are limited by the latency only
+}
+
+
+class _Meter:
+    """ Counter of the API calls by service and operation, each call spends the latency """
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def call(self, service: str, operation: str):
+        with self._lock:
+            self.calls[(service, operation)] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def by_service(self) -> dict:
+        services = defaultdict(int)
+        for (service, _), n in self.calls.items():
+            services[service] += n
+        return services
+
+
+class _Metered:
+    """ Proxy of a stand-in whose public methods are counted as the API calls of service """
+    def __init__(self, meter: _Meter, service: str, target):
+        self._meter = meter
+        self._service = service
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._meter.call(self._service, ''.join(p.title() for p in name.split('_')))
+            return attr(*args, **kwargs)
+
+        return call
+
+
+def _matches(item: dict, expression: str, values: dict) -> bool:
+    """ Evaluate the `AND` conditions (and `OR` groups) of key, filter or condition expressions used by `task` """
+    for term in (expression or '').split(' AND '):
+        term = term.strip()
+        if not term:
+            continue
+
+        func, _, args = term.partition('(')
+        if term.startswith('(') and ' OR ' in term:
+            ok = any(_matches(item, t, values) for t in term[1:-1].split(' OR '))
+        elif args:
+            args = [a.strip() for a in args.rstrip(')').split(',')]
+            if func == 'attribute_exists':
+                ok = args[0] in item
+            elif func == 'attribute_not_exists':
+                ok = args[0] not in item
+            elif func == 'begins_with':
+                ok = str(item.get(args[0], '')).startswith(values[args[1]])
+            else:
+                raise NotImplementedError(term)
+        else:
+            name, op, value = term.split(' ', 2)
+            if op == '=':
+                ok = name in item and item[name] == values[value]
+            elif op == '<':
+                ok = name in item and item[name] < values[value]
+            elif op == '>':
+                ok = name in item and item[name] > values[value]
+            else:
+                raise NotImplementedError(term)
+
+        if not ok:
+            return False
+
+    return True
+
+
+def _split_assignments(expression: str) -> list:
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(expression):
+        depth += c == '('
+        depth -= c == ')'
+        if c == ',' and depth == 0:
+            parts.append(expression[start:i].strip())
+            start = i + 1
+    parts.append(expression[start:].strip())
+    return parts
+
+
+def _operand(item: dict, operand: str, values: dict):
+    operand = operand.strip()
+    if operand.startswith('if_not_exists('):
+        name, default = operand[len('if_not_exists('):-1].split(',')
+        return item.get(name.strip(), values[default.strip()])
+    if operand.startswith(':'):
+        return values[operand]
+    return item[operand]
+
+
+class _ConditionalCheckFailedException(Exception):
+    pass
+
+
+class _TransactionCanceledException(Exception):
+    def __init__(self, reasons: list):
+        super().__init__('Transaction cancelled')
+        self.response = {'CancellationReasons': reasons}
+
+
+class _Table:
+    """ Stand-in of a DynamoDB table with the hash keys of its indexes """
+    def __init__(self, key: str, indexes: dict):
+        self.key = key
+        self.indexes = indexes  # hash key of each index by name
+        self.items = dict()
+        self._by_index = {name: defaultdict(dict) for name in indexes}
+        self._lock = threading.Lock()
+
+    def get_item(self, Key, **_):  # noqa: N803
+        item = self.items.get(Key[self.key], None)
+        return {'Item': dict(item)} if item is not None else {}
+
+    def put_item(self, Item, **_):  # noqa: N803
+        with self._lock:
+            self._put(dict(Item))
+
+    def delete_item(self, Key, **_):  # noqa: N803
+        with self._lock:
+            self._delete(Key[self.key])
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,  # noqa: N803
+                    ConditionExpression=None, ReturnValues='NONE', **_):
+        values = ExpressionAttributeValues or dict()
+        with self._lock:
+            old = self.items.get(Key[self.key], dict())
+            item = dict(old or Key)
+            if ConditionExpression is not None and not _matches(item, ConditionExpression, values):
+                raise _ConditionalCheckFailedException(ConditionExpression)
+
+            updated = []
+            for assignment in _split_assignments(UpdateExpression[len('SET '):]):
+                name, expression = [p.strip() for p in assignment.split('=', 1)]
+                for op in (' + ', ' - '):
+                    left, sign, right = expression.partition(op)
+                    if sign:
+                        break
+                value = _operand(item, left, values)
+                if sign:
+                    value = value + _operand(item, right, values) if sign == ' + ' \
+                        else value - _operand(item, right, values)
+                item[name] = value
+                updated.append(name)
+
+            self._put(item)
+
+        if ReturnValues == 'ALL_OLD':
+            return {'Attributes': dict(old)}
+        if ReturnValues == 'UPDATED_OLD':
+            return {'Attributes': {k: old[k] for k in updated if k in old}}
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': {k: item[k] for k in updated}}
+        return {}
+
+    def query(self, IndexName=None, KeyConditionExpression=None, ExpressionAttributeValues=None,  # noqa: N803
+              FilterExpression=None, Select=None, Limit=None, ExclusiveStartKey=None, **_):
+        values = ExpressionAttributeValues or dict()
+        name, _, value = KeyConditionExpression.split(' AND ')[0].split(' ', 2)
+        if IndexName is None:
+            candidates = [self.items[values[value]]] if values[value] in self.items else []
+        else:
+            candidates = list(self._by_index[IndexName].get(values[value], dict()).values())
+
+        return self._page([item for item in candidates if _matches(item, KeyConditionExpression, values)],
+                          FilterExpression, values, Select, Limit, ExclusiveStartKey)
+
+    def scan(self, FilterExpression=None, ExpressionAttributeValues=None, Select=None, Limit=None,  # noqa: N803
+             ExclusiveStartKey=None, **_):
+        return self._page(list(self.items.values()), FilterExpression, ExpressionAttributeValues or dict(),
+                          Select, Limit, ExclusiveStartKey)
+
+    def _page(self, items: list, condition: str, values: dict, select: str, limit: int, start: dict) -> dict:
+        offset = start['offset'] if start else 0
+        size = min(limit or QUERY_PAGE_SIZE, QUERY_PAGE_SIZE)
+        page = [item for item in items[offset:offset + size] if _matches(item, condition, values)]
+
+        resp = {'Count': len(page)}
+        if select != 'COUNT':
+            resp['Items'] = [dict(item) for item in page]
+        if offset + size < len(items):
+            resp['LastEvaluatedKey'] = {'offset': offset + size}
+        return resp
+
+    def _put(self, item: dict):
+        self._delete(item[self.key])
+        self.items[item[self.key]] = item
+        for name, key in self.indexes.items():
+            if key in item:
+                self._by_index[name][item[key]][item[self.key]] = item
+
+    def _delete(self, pk: str):
+        item = self.items.pop(pk, None)
+        if item is None:
+            return
+        for name, key in self.indexes.items():
+            if key in item:
+                self._by_index[name][item[key]].pop(pk, None)
+
+
+class _DynamoDB:
+    """ Stand-in of the DynamoDB resource with the tables of `template.yaml` """
+    def __init__(self, meter: _Meter):
+        self.meter = meter
+        self.tables = {
+            task.task_table_name: _Table('S_TaskId', {'FingerprintIndex': 'S_Fingerprint'}),
+            task.taskitem_table_name: _Table('S_ItemId', {
+                'SourceBucketIndex': 'S_SourceBucket',
+                'SourceIndex': 'S_Source',
+                'TaskIndex': 'S_TaskId',
+                'StatusIndex': 'S_Status',
+                'ContentIndex': 'S_ETag',
+            }),
+            task.options_table_name: _Table('S_Key', dict()),
+        }
+        self.exceptions = types.SimpleNamespace(ConditionalCheckFailedException=_ConditionalCheckFailedException,
+                                                TransactionCanceledException=_TransactionCanceledException)
+        self.meta = types.SimpleNamespace(client=_Metered(meter, 'dynamodb', self))
+        self._lock = threading.Lock()
+
+    def Table(self, name):  # noqa: N802
+        return _Metered(self.meter, 'dynamodb', self.tables[name])
+
+    def batch_write_item(self, RequestItems, **_):  # noqa: N803
+        self.meter.call('dynamodb', 'BatchWriteItem')
+        for name, requests in RequestItems.items():
+            for request in requests:
+                if 'PutRequest' in request:
+                    self.tables[name].put_item(request['PutRequest']['Item'])
+                else:
+                    self.tables[name].delete_item(request['DeleteRequest']['Key'])
+        return {'UnprocessedItems': {}}
+
+    def transact_write_items(self, TransactItems, **_):  # noqa: N803
+        with self._lock:
+            reasons = []
+            for action in TransactItems:
+                update = action['Update']
+                table = self.tables[update['TableName']]
+                item = table.items.get(update['Key'][table.key], dict(update['Key']))
+                ok = _matches(item, update.get('ConditionExpression', None),
+                              update.get('ExpressionAttributeValues', dict()))
+                reasons.append({'Code': 'None' if ok else 'ConditionalCheckFailed'})
+
+            if any(reason['Code'] != 'None' for reason in reasons):
+                raise _TransactionCanceledException(reasons)
+
+            for action in TransactItems:
+                update = dict(action['Update'])
+                update.pop('ConditionExpression', None)
+                self.tables[update.pop('TableName')].update_item(**update)
+        return {}
+
+    def batch_get_item(self, RequestItems, **_):  # noqa: N803
+        self.meter.call('dynamodb', 'BatchGetItem')
+        responses = dict()
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            rows = [table.get_item(key).get('Item', None) for key in request['Keys']]
+            responses[name] = [row for row in rows if row is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class _S3:
+    """ Stand-in of the S3 client and resource with the synthetic objects of bucket """
+    def __init__(self, meter: _Meter, objects: dict):
+        self.meter = meter
+        self.objects = objects  # ETag and size by (bucket, key)
+        self.keys = sorted(key for _, key in objects)
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, **_):  # noqa: N803
+        start = int(ContinuationToken or 0)
+        keys = [key for key in self.keys[start:start + MaxKeys] if key.startswith(Prefix)]
+        resp = {
+            'Contents': [{'Key': key, 'ETag': '"%s"' % self.objects[(Bucket, key)][0],
+                          'Size': self.objects[(Bucket, key)][1]} for key in keys],
+            'IsTruncated': start + MaxKeys < len(self.keys),
+        }
+        if resp['IsTruncated']:
+            resp['NextContinuationToken'] = str(start + MaxKeys)
+        return resp
+
+    def head_object(self, Bucket, Key, **_):  # noqa: N803
+        etag, size = self.objects[(Bucket, Key)]
+        return {'ETag': '"%s"' % etag, 'ContentLength': size}
+
+    def copy(self, source, bucket, key, **_):
+        self.objects[(bucket, key)] = self.objects[(source['Bucket'], source['Key'])]
+
+    def Object(self, bucket, key):  # noqa: N802
+        s3 = self
+
+        class _Object:
+            @property
+            def content_length(self):
+                s3.meter.call('s3', 'HeadObject')
+                return s3.objects[(bucket, key)][1]
+
+        return _Object()
+
+
+class _MediaConvert:
+    """ Stand-in of the MediaConvert client, every job is created """
+    def __init__(self):
+        self.jobs = 0
+        self.on_created = None  # called with the id of each job created if set
+        self._lock = threading.Lock()
+
+    def describe_endpoints(self, **_):
+        return {'Endpoints': [{'Url': os.environ['MEDIACONVERT_ENDPOINT']}]}
+
+    def get_job_template(self, Name, **_):  # noqa: N803
+        return {'JobTemplate': {'Name': Name, 'Settings': {'OutputGroups': [{
+            'OutputGroupSettings': {'Type': 'FILE_GROUP_SETTINGS', 'FileGroupSettings': {}},
+        }]}}}
+
+    def get_queue(self, Name, **_):  # noqa: N803
+        return {'Queue': {'Name': Name, 'SubmittedJobsCount': 0, 'ProgressingJobsCount': 0}}
+
+    def create_job(self, **_):
+        with self._lock:
+            self.jobs += 1
+        job = {'Id': uuid.uuid4().hex, 'CreatedAt': datetime.now().astimezone()}
+        if self.on_created is not None:
+            self.on_created(job['Id'])
+        return {'Job': job}
+
+
+class _SQS:
+    """ Stand-in of the SQS client, the messages sent are kept in order """
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, **kwargs):
+        self.messages.append(kwargs)
+        return {'MessageId': uuid.uuid4().hex}
+
+
+class _Events:
+    """
+    Stand-in of the TaskEvent queue, the COMPLETE event of a job is handled by `task_event.batch_handler`
+    as soon as the job is created, i.e. before its task item is written, the failed events are kept
+    to send again
+    """
+    def __init__(self):
+        self.failed = []
+        self._handler = getattr(task_event.batch_handler, '__wrapped__', task_event.batch_handler)
+        self._lock = threading.Lock()
+
+    def send(self, jobid: str):
+        self.deliver([{'messageId': uuid.uuid4().hex, 'body': json.dumps({'detail': {
+            'timestamp': int(time.time() * 1000),
+            'jobId': jobid,
+            'status': 'COMPLETE',
+            'outputGroupDetails': [{'type': 'FILE_GROUP', 'outputDetails': [{
+                'outputFilePaths': ['s3://bench-output/%s.mp4' % jobid],
+            }]}],
+        }})}])
+
+    def deliver(self, records: list):
+        resp = self._handler({'Records': records}, None)
+        failed = {failure['itemIdentifier'] for failure in resp['batchItemFailures']}
+        with self._lock:
+            self.failed.extend(record for record in records if record['messageId'] in failed)
+
+    def drain(self, batch: int):
+        """ Send the failed events again until they are handled """
+        for _ in range(MAX_RECEIVES):
+            records, self.failed = self.failed, []
+            for i in range(0, len(records), batch):
+                self.deliver(records[i:i + batch])
+
+        if len(self.failed) > 0:
+            raise AssertionError('%d events failed after %d receives' % (len(self.failed), MAX_RECEIVES))
+
+
+class _Context:
+    """ Stand-in of the lambda context with the timeout of invocation """
+    def __init__(self, timeout: float):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+class _Services:
+    def __init__(self, objects: int, latency: float):
+        self.meter = _Meter(latency)
+        self.dynamodb = _DynamoDB(self.meter)
+        self.s3 = _S3(self.meter, {(BUCKET, 'videos/%07d.mp4' % i): ('%032x' % i, 1024 * 1024 + i)
+                                   for i in range(objects)})
+        self.mediaconvert = _MediaConvert()
+        self.sqs = _SQS()
+
+        for key, value in OPTIONS.items():
+            self.dynamodb.tables[task.options_table_name].put_item({'S_Key': key, 'S_Value': value})
+
+    def install(self):
+        """ Route the boto3 clients and resources of the handlers to the stand-ins """
+        clients = {
+            's3': _Metered(self.meter, 's3', self.s3),
+            'mediaconvert': _Metered(self.meter, 'mediaconvert', self.mediaconvert),
+            'sqs': _Metered(self.meter, 'sqs', self.sqs),
+        }
+        resources = {'s3': self.s3, 'dynamodb': self.dynamodb}
+
+        boto3.client = lambda service, *_, **__: clients[service]
+        boto3.resource = lambda service, *_, **__: resources[service]
+        boto3.session.Session = lambda *_, **__: type('Session', (), {
+            'resource': staticmethod(lambda service, *_, **__: resources[service]),
+            'client': staticmethod(lambda service, *_, **__: clients[service]),
+        })()
+
+        task._local = threading.local()
+        task._converter = None
+        task.invalidate_template_cache()
+        task.option_store.refresh()
+
+
+def run_manual(services: _Services, timeout: float) -> int:
+    """ Convert the whole bucket by a manual task, returns the number of invocations """
+    messages = [{
+        'messageId': uuid.uuid4().hex,
+        'messageAttributes': {'Bucket': {'stringValue': BUCKET, 'dataType': 'String'}},
+    }]
+
+    invocations = 0
+    while messages and invocations < MAX_INVOCATIONS:
+        msg = messages.pop(0)
+        manual_executor.lambda_handler({'Records': [msg]}, _Context(timeout))
+        invocations += 1
+
+        for sent in services.sqs.messages:
+            messages.append({
+                'messageId': uuid.uuid4().hex,
+                'messageAttributes': {k: {'stringValue': v['StringValue'], 'dataType': v['DataType']}
+                                      for k, v in sent['MessageAttributes'].items()},
+            })
+        services.sqs.messages.clear()
+
+    return invocations
+
+
+def run_auto(services: _Services, batch: int) -> int:
+    """ Convert each object by its S3 event notification, returns the number of invocations """
+    records = []
+    for (bucket, key), (etag, size) in services.s3.objects.items():
+        event = {'Records': [{'s3': {
+            'bucket': {'name': bucket},
+            'object': {'key': urllib.parse.quote_plus(key), 'eTag': etag, 'size': size},
+        }}]}
+        records.append({'messageId': uuid.uuid4().hex, 'body': json.dumps(event),
+                        'attributes': {'ApproximateReceiveCount': '1'}})
+
+    receives = defaultdict(int)
+    invocations = 0
+    while records:
+        chunk, records = records[:batch], records[batch:]
+        resp = auto_executor.lambda_handler({'Records': chunk}, None)
+        invocations += 1
+
+        failed = {failure['itemIdentifier'] for failure in resp['batchItemFailures']}
+        for record in chunk:
+            receives[record['messageId']] += 1
+            if record['messageId'] in failed and receives[record['messageId']] < MAX_RECEIVES:
+                records.append(dict(record, attributes={
+                    'ApproximateReceiveCount': str(receives[record['messageId']] + 1),
+                }))
+
+    return invocations
+
+
+def verify_events(services: _Services, events: _Events, batch: int) -> int:
+    """ Check every job is settled by its event and counted out of the running jobs, returns the events failed first """
+    failed = len(events.failed)
+    events.drain(batch)
+
+    items = services.dynamodb.tables[task.taskitem_table_name].items.values()
+    running = [item['S_ItemId'] for item in items if item['S_Status'] == 'RUNNING']
+    if len(running) > 0:
+        raise AssertionError('%d jobs are still running after their events, e.g. %s' % (len(running), running[0]))
+
+    counted = sum(t.get('N_Running', 0) for t in services.dynamodb.tables[task.task_table_name].items.values())
+    if counted != 0:
+        raise AssertionError('%d running jobs are counted after all events' % counted)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, nargs='+', default=[100, 10000, 100000],
+                        help='numbers of objects in bucket')
+    parser.add_argument('--handlers', nargs='+', choices=['manual', 'auto'], default=['manual', 'auto'],
+                        help='handlers to run')
+    parser.add_argument('--latency-ms', type=float, default=0, help='milliseconds spent on each API call')
+    parser.add_argument('--batch', type=int, default=10, help='number of messages in a batch of the auto handler')
+    parser.add_argument('--timeout', type=float, default=900, help='seconds of the timeout of an invocation')
+    parser.add_argument('--operations', action='store_true', help='print the API calls of each operation')
+    parser.add_argument('--events', action='store_true',
+                        help='send the event of each job before its task item is written and check it is applied')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)  # the per object logs of handlers are not measured
+
+    print('%-7s %8s %7s %8s %9s %8s %9s %8s %6s %9s'
+          % ('handler', 'objects', 'invokes', 'jobs', 'wall(s)', 's3', 'dynamodb', 'convert', 'sqs', 'calls/job'))
+    for handler in args.handlers:
+        for objects in args.objects:
+            services = _Services(objects, args.latency_ms / 1000)
+            services.install()
+            events = None
+            if args.events:
+                events = _Events()
+                services.mediaconvert.on_created = events.send
+
+            started = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # the metrics of handlers
+                if handler == 'manual':
+                    invocations = run_manual(services, args.timeout)
+                else:
+                    invocations = run_auto(services, args.batch)
+            seconds = time.perf_counter() - started
+
+            jobs = services.mediaconvert.jobs
+            if jobs != objects:
+                raise AssertionError('%d jobs created for %d objects' % (jobs, objects))
+
+            if events is not None:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    failed = verify_events(services, events, args.batch)
+                print('    %d events sent before the task item written, %d failed and applied when sent again'
+                      % (jobs, failed))
+
+            calls = services.meter.by_service()
+            print('%-7s %8d %7d %8d %9.2f %8d %9d %8d %6d %9.2f'
+                  % (handler, objects, invocations, jobs, seconds, calls['s3'], calls['dynamodb'],
+                     calls['mediaconvert'], calls['sqs'], sum(calls.values()) / max(jobs, 1)))
+
+            if args.operations:
+                for (service, operation), n in sorted(services.meter.calls.items()):
+                    print('    %-12s %-20s %9d %9.3f/job' % (service, operation, n, n / max(jobs, 1)))
+
+
+if __name__ == '__main__':
+    main()
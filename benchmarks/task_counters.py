@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the task counters with concurrent job completions.
+
+The DynamoDB table is a local stand-in which serializes the writes of one partition key and
+spends `--write-ms` on each of them, like the per-partition write throughput limit of DynamoDB.
+Every completion calls `increase_task_finished_counter` on the same task, and the counters read
+back by `get_task` are checked against the number of completions.
+
+Usage:
+    python benchmarks/task_counters.py [--completions 2000] [--workers 200] [--shards 0 10 50]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_converter')
+sys.path.insert(0, SOURCE_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import task  # noqa: E402
+
+
+class _Table:
+    """ Stand-in of a DynamoDB table, only the counter updates of `task` are supported """
+    def __init__(self, write_seconds: float):
+        self.rows = defaultdict(dict)
+        self.write_seconds = write_seconds
+        self._locks = defaultdict(threading.Lock)
+
+    def put_item(self, Item, **_):
+        self.rows[Item['S_TaskId']] = dict(Item)
+
+    def get_item(self, Key, **_):
+        row = self.rows.get(Key['S_TaskId'], None)
+        return {'Item': dict(row)} if row is not None else {}
+
+    def update_item(self, Key, ExpressionAttributeValues, **_):
+        with self._locks[Key['S_TaskId']]:
+            time.sleep(self.write_seconds)
+            row = self.rows[Key['S_TaskId']]
+            for k, v in ExpressionAttributeValues.items():
+                if k.startswith(':N_'):
+                    row[k[1:]] = row.get(k[1:], 0) + v
+
+
+class _Resource:
+    def __init__(self, table: _Table):
+        self.table = table
+
+    def Table(self, _):  # noqa: N802
+        return self.table
+
+    def batch_get_item(self, RequestItems):  # noqa: N802
+        name, request = next(iter(RequestItems.items()))
+        rows = [self.table.get_item(key).get('Item', None) for key in request['Keys']]
+        return {'Responses': {name: [row for row in rows if row is not None]}}
+
+
+def run(completions: int, workers: int, shards: int, write_seconds: float) -> float:
+    """ Run the completions and return the throughput in writes per second """
+    resource = _Resource(_Table(write_seconds))
+    task.get_db = lambda: resource
+    task.TASK_COUNTER_SHARDS = shards
+
+    created = task.create_task('benchmark-task', 'bench-bucket')
+    resource.table.update_item({'S_TaskId': created.taskId}, {':N_Running': completions})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(lambda _: task.increase_task_finished_counter(created.taskId), range(completions)):
+            pass
+    seconds = time.perf_counter() - start
+
+    consolidated = task.get_task(created.taskId)
+    if consolidated.finished != completions or consolidated.running != 0:
+        raise AssertionError('counters mismatch, finished %d running %d'
+                             % (consolidated.finished, consolidated.running))
+
+    return completions / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--completions', type=int, default=2000, help='number of job completions')
+    parser.add_argument('--workers', type=int, default=200, help='number of concurrent writers')
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 10, 50], help='shards to compare')
+    parser.add_argument('--write-ms', type=float, default=2.0, help='milliseconds of a write on one partition')
+    args = parser.parse_args()
+
+    for shards in args.shards:
+        throughput = run(args.completions, args.workers, shards, args.write_ms / 1000)
+        print('shards %4d  %10.1f writes/s' % (shards, throughput))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the cost of the duplicate task check with a large history of tasks in one bucket.
+
+`legacy` queries `BucketIndex` by bucket and filters by key and filter, which reads every task of
+the bucket. `fingerprint` looks up the task by its fingerprint in `FingerprintIndex`.
+The DynamoDB table is a local stand-in which counts the items read by each query.
+
+Usage:
+    python benchmarks/task_exists.py [--tasks 100000] [--checks 200]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_converter')
+sys.path.insert(0, SOURCE_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import task  # noqa: E402
+
+BUCKET = 'bench-bucket'
+TEMPLATE = 'bench-template'
+
+
+class _Table:
+    """ Stand-in of the tasks table, only the queries of duplicate check are supported """
+    def __init__(self):
+        self.by_bucket = defaultdict(list)
+        self.by_fingerprint = defaultdict(list)
+        self.items_read = 0
+
+    def put_item(self, Item, **_):
+        self.by_bucket[Item['S_Bucket']].append(Item)
+        self.by_fingerprint[Item['S_Fingerprint']].append(Item)
+
+    def query(self, IndexName, ExpressionAttributeValues, Limit=None, **_):  # noqa: N803
+        values = ExpressionAttributeValues
+        if IndexName == 'BucketIndex':
+            items = self.by_bucket[values[':bucket']]
+            self.items_read += len(items)
+            matched = [i for i in items if i['S_Key'] == values[':key'] and i['S_Filter'] == values[':filter']]
+        else:
+            matched = self.by_fingerprint[values[':fingerprint']][:Limit]
+            self.items_read += len(matched)
+
+        return {'Count': len(matched)}
+
+
+class _Resource:
+    def __init__(self, table: _Table):
+        self.table = table
+
+    def Table(self, _):  # noqa: N802
+        return self.table
+
+
+def legacy_is_task_exists(bucket: str, key: str, condition: str) -> bool:
+    item = task.get_db().Table(task.task_table_name).query(
+        KeyConditionExpression='S_Bucket = :bucket',
+        IndexName='BucketIndex',
+        FilterExpression='S_Key = :key AND S_Filter = :filter',
+        ExpressionAttributeValues={':bucket': bucket, ':key': key, ':filter': condition},
+        Select='COUNT'
+    )
+    return item.get('Count', 0) > 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=100000, help='number of historical tasks in the bucket')
+    parser.add_argument('--checks', type=int, default=200, help='number of duplicate checks')
+    args = parser.parse_args()
+
+    table = _Table()
+    resource = _Resource(table)
+    task.get_db = lambda: resource
+
+    for i in range(args.tasks):
+        task.create_task('task-%d' % i, BUCKET, 'sub-dir/%06d.mp4' % i, None, TEMPLATE)
+
+    random.seed(0)
+    keys = ['sub-dir/%06d.mp4' % random.randrange(args.tasks * 2) for _ in range(args.checks)]
+
+    for name, check in (('legacy', lambda k: legacy_is_task_exists(BUCKET, k, None)),
+                        ('fingerprint', lambda k: task.is_task_exists(BUCKET, k, None, TEMPLATE))):
+        table.items_read = 0
+        start = time.perf_counter()
+        found = sum(1 for key in keys if check(key))
+        seconds = time.perf_counter() - start
+
+        print('%-12s found %4d  items read per check %10.1f  time per check %9.1f us'
+              % (name, found, table.items_read / args.checks, seconds / args.checks * 1e6))
+
+
+if __name__ == '__main__':
+    main()
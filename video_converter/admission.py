@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from typing import Callable
+
+from options import OptionStore
+
+DEFAULT_SUBMIT_RATE = 10  # The max number of jobs created per second by default
+MIN_SUBMIT_RATE = 0.5  # The rate is never decreased below it on throttling
+RATE_INCREASE = 1  # The rate increased per second of successful creates (additive increase)
+RATE_DECREASE = 0.5  # The factor of rate on a throttling response (multiplicative decrease)
+MAX_WAIT = 10  # The max seconds to wait for a token before the job is deferred
+RUNNING_REFRESH = 10  # The number of seconds that the running jobs of a task loaded are valid
+
+
+class JobDeferred(Exception):
+    """ The job is deferred by the admission control instead of created """
+
+
+class AdmissionController:
+    """
+    Rate controller of the MediaConvert jobs created by a container.
+    The creates are paced by a token bucket whose rate is adjusted in AIMD style: it grows by
+    `RATE_INCREASE` per second of successful creates up to option `MaxJobSubmitRate`, and is cut
+    by `RATE_DECREASE` (at most once per second) on a throttling response.
+    If option `MaxRunningJobs` is set, the jobs of a task are admitted only while its running jobs
+    (the `N_Running` of task plus the jobs admitted since it is loaded) are less than it, a job admitted
+    but not created is counted out by `release`.
+    The controller is thread safe.
+
+    Example:
+    >>> controller = AdmissionController(option_store, lambda taskid: get_task(taskid).running)
+    >>> if controller.admit(taskid):
+    ...     if controller.acquire():
+    ...         create_job()
+    ...         controller.on_created()
+    ...     else:
+    ...         controller.release(taskid)
+    """
+    def __init__(self, options: OptionStore, running: Callable[[str], int]):
+        self.submitted = 0
+        """ Total jobs created """
+        self.deferred = 0
+        """ Total jobs deferred """
+        self.throttled = 0
+        """ Total throttling responses of create """
+        self._options = options
+        self._running = running
+        self._rate = None
+        self._tokens = 1.0
+        self._refilled_at = time.monotonic()
+        self._decreased_at = 0
+        self._tasks = dict()  # running jobs and the time loaded of each task
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        """ The current number of jobs created per second """
+        with self._lock:
+            return self._current_rate()
+
+    def admit(self, taskid: str) -> bool:
+        """
+        Check whether the running jobs of task are under the cap and count a job in if so
+        Args:
+            taskid: The id of Task
+        Returns:
+            Whether the job is admitted
+        """
+        cap = self._options.get_int('MaxRunningJobs', 0)
+        if cap <= 0:
+            return True
+
+        now, loaded = self._load(taskid)
+        with self._lock:
+            running, loaded_at = self._get_running(taskid, now, loaded)
+            if running >= cap:
+                self._tasks[taskid] = (running, loaded_at)
+                return False
+
+            self._tasks[taskid] = (running + 1, loaded_at)
+            return True
+
+    def available(self, taskid: str) -> int:
+        """
+        Get the number of jobs of task which can be admitted now, they are not counted in
+        Args:
+            taskid: The id of Task
+        Returns:
+            The number of jobs, `None` if the running jobs are not capped
+        """
+        cap = self._options.get_int('MaxRunningJobs', 0)
+        if cap <= 0:
+            return None
+
+        now, loaded = self._load(taskid)
+        with self._lock:
+            running, loaded_at = self._get_running(taskid, now, loaded)
+            self._tasks[taskid] = (running, loaded_at)
+            return max(cap - running, 0)
+
+    def release(self, taskid: str):
+        """
+        Count out a job admitted but not created, i.e. it is deferred or failed after `admit`
+        Args:
+            taskid: The id of Task
+        """
+        with self._lock:
+            if taskid in self._tasks:
+                running, loaded_at = self._tasks[taskid]
+                self._tasks[taskid] = (max(running - 1, 0), loaded_at)
+
+    def acquire(self, timeout: float = MAX_WAIT) -> bool:
+        """
+        Take a token to create a job, wait for it if the bucket is empty
+        Args:
+            timeout: The max seconds to wait
+        Returns:
+            Whether the token is taken
+        """
+        with self._lock:
+            rate = self._refill()
+            self._tokens -= 1
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+            if wait > timeout:
+                self._tokens += 1
+                return False
+
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def on_created(self):
+        """ Record a job created, the rate is increased """
+        with self._lock:
+            rate = self._current_rate()
+            self._rate = min(rate + RATE_INCREASE / rate, self._max_rate())
+            self.submitted += 1
+
+    def on_throttled(self):
+        """ Record a throttling response of create, the rate is decreased """
+        with self._lock:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self._decreased_at < 1:
+                return  # the in-flight creates are throttled by the same burst
+
+            self._rate = max(self._current_rate() * RATE_DECREASE, MIN_SUBMIT_RATE)
+            self._tokens = min(self._tokens, 0)
+            self._decreased_at = now
+
+    def on_deferred(self):
+        """ Record a job deferred """
+        with self._lock:
+            self.deferred += 1
+
+    def stats(self) -> dict:
+        """ Numbers of the jobs submitted, deferred and throttled responses, and the current rate """
+        return {'submitted': self.submitted, 'deferred': self.deferred, 'throttled': self.throttled,
+                'rate': round(self.rate, 2)}
+
+    def _load(self, taskid: str) -> tuple:
+        """ The time now and the running jobs of task read out of the lock if stale, `None` if not """
+        with self._lock:
+            entry = self._tasks.get(taskid, None)
+
+        now = time.monotonic()
+        if entry is None or now - entry[1] > RUNNING_REFRESH:
+            return now, self._running(taskid)
+        return now, None
+
+    def _get_running(self, taskid: str, now: float, loaded: int = None) -> tuple:
+        running, loaded_at = self._tasks.get(taskid, (0, None))
+        if loaded is not None and (loaded_at is None or loaded_at < now - RUNNING_REFRESH):
+            return loaded, now  # not refreshed by another thread meanwhile
+        return running, loaded_at
+
+    def _max_rate(self) -> float:
+        return max(float(self._options.get('MaxJobSubmitRate', DEFAULT_SUBMIT_RATE)), MIN_SUBMIT_RATE)
+
+    def _current_rate(self) -> float:
+        if self._rate is None:
+            self._rate = self._max_rate()
+        return self._rate
+
+    def _refill(self) -> float:
+        rate = self._current_rate()
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._refilled_at) * rate, max(rate, 1))
+        self._refilled_at = now
+        return rate
@@ -3,33 +3,154 @@
 import urllib.parse
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from task import *
+from content import get_content_dedupe
+from routing import get_router
+from scheduler import get_scheduler
+from metrics import LOG_LEVEL, instrumented, log_event, phase
 
 
-logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().setLevel(LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 
+@instrumented('AutoExecutor')
 def lambda_handler(event, _):
-    logger.info("Received event: " + json.dumps(event, indent=2))
+    log_event(logger, event, records=len(event['Records']))
+
+    sources = dict()  # the keys and their message ids of each bucket
+    contents = dict()  # the ETag and size of the keys of each bucket
+    received = dict()  # the keys received again of each bucket, checked for the jobs created already
+    failures = []
+
+    for record in event['Records']:
+        try:
+            if 'body' in record:
+                # S3 event notification buffered by SQS, the message body is the S3 event
+                notifications = json.loads(record['body']).get('Records', [])
+                msgid = record['messageId']
+                again = int(record.get('attributes', dict()).get('ApproximateReceiveCount', 1)) > 1
+            else:
+                notifications = [record]
+                msgid = None
+                again = False
+
+            for notification in notifications:
+                bucket = notification['s3']['bucket']['name']
+                key = urllib.parse.unquote_plus(notification['s3']['object']['key'], encoding='utf-8')
+                sources.setdefault(bucket, dict()).setdefault(key, []).append(msgid)
+                if again:
+                    received.setdefault(bucket, set()).add(key)
+                if 'eTag' in notification['s3']['object'] and 'size' in notification['s3']['object']:
+                    contents.setdefault(bucket, dict())[key] = (notification['s3']['object']['eTag'],
+                                                                notification['s3']['object']['size'])
+        except (ValueError, KeyError, TypeError) as err:
+            logger.error("Invalid record - %s" % err)
+
+    total = 0
+    for bucket, keys in sources.items():
+        try:
+            for result in _execute(bucket, list(keys.keys()), contents.get(bucket, dict()),
+                                   received.get(bucket, set())):
+                if result.deferred:
+                    # the message is received again to retry the job
+                    logger.info('Job deferred, source - %s' % get_source(bucket, result.key))
+                    failures.extend(keys[result.key])
+                    continue
+
+                if result.error is None:
+                    total += 1
+                    continue
+
+                logger.error('Job submit with error, source - %s, error - %s'
+                             % (get_source(bucket, result.key), result.error))
+                failures.extend(keys[result.key])
+        except Exception as err:
+            # raised before any job is created, all messages of the bucket are received again
+            error = ''.join(traceback.format_exception(None, err, err.__traceback__))
+
+            logger.error("Manual task execute error: " + error)
+            failures.extend(msgid for msgids in keys.values() for msgid in msgids)
+
+    logger.info('Admission of jobs - %s' % json.dumps(admission_controller.stats()))
+    if None in failures:
+        # invoked by S3 event notification directly, no message is received again to retry the jobs
+        # deferred or failed, the event is invoked again by the retry of asynchronous invocation
+        raise RuntimeError('%d jobs of the S3 event are deferred or failed, the event is retried'
+                           % failures.count(None))
+
+    failures = [{'itemIdentifier': msgid} for msgid in dict.fromkeys(failures)]
+
+    if total == 0 and len(failures) == 0:
+        return {"status": 400, "event": event, 'message': 'Ignored. Key is directory or task already exists.',
+                'batchItemFailures': failures}
+
+    return {"status": 200 if len(failures) == 0 else 400, "event": event, 'message': None,
+            'batchItemFailures': failures}
+
+
+def _execute(bucket: str, keys: list, contents: dict = None, received: set = None) -> list:
+    """
+    Create one task for all the keys in bucket received in a batch and submit their jobs.
+    The job of a key received the first time is always created, as the object is uploaded again,
+    and the one of a key received again is created only if no task item of it with the same ETag
+    exists, as the job may be created by the former receive
+    Args:
+        bucket: Bucket name where the sources in
+        keys: Keys of the sources in bucket
+        contents: The ETag and size of the keys from the event notifications
+        received: The keys received again
+    Returns:
+        The results of submitted jobs
+    """
+    received = received or set()
+    keys = [key for key in keys if not key.endswith('/')]
+    with phase('CheckSources'), \
+            ThreadPoolExecutor(max_workers=max(min(len(keys), DEFAULT_JOB_CONCURRENCY), 1)) as executor:
+        exists = list(executor.map(lambda k: source_file_exists(bucket, k), keys))
+    keys = [key for key, exist in zip(keys, exists) if exist]
+
+    if len(keys) == 0:
+        return []
+
+    # always create task when invoked by s3 event notification
+    template = get_bucket_template_name(bucket)
+    if len(keys) == 1:
+        task = create_task(uuid.uuid4().hex, bucket, keys[0], None, template)
+    else:
+        # the keys of task are described by a filter of the listed objects
+        condition = 'Contents[?contains([%s], Key)][]' % ', '.join(
+            "'%s'" % key.replace('\\', '\\\\').replace("'", "\\'") for key in keys
+        )
+        task = create_task(uuid.uuid4().hex, bucket, None, condition, template)
+
+    writer = TaskItemBatchWriter()
+    with phase('Submit'):
+        router = get_router(bucket, template)
+        scheduler = get_scheduler(bucket)
+        dedupe = get_content_dedupe(bucket)
+        results = []
+        for batch, force in (([key for key in keys if key not in received], True),
+                             ([key for key in keys if key in received], False)):
+            if len(batch) > 0:
+                results.extend(submit_converter_jobs(task.taskId, task.bucket, batch, task.template_name, force,
+                                                     writer=writer, router=router, contents=contents,
+                                                     admission=admission_controller, scheduler=scheduler,
+                                                     dedupe=dedupe))
+        try:
+            writer.flush()
+        except Exception as err:
+            # the jobs of the items not written are created already, their messages are not received
+            # again to avoid creating the jobs again, the items are logged by the writer
+            logger.error('Task items write with error - %s' % err)
 
     try:
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-
-        if not key.endswith('/') and source_file_exists(bucket, key):
-            # always create task when invoked by s3 event notification
-            template = get_bucket_template_name(bucket)
-            task = create_task(uuid.uuid4().hex, bucket, key, None, template)
-            create_converter_job(task.taskId, task.bucket, task.key, task.template_name)
-            set_task_total(task.taskId, 1)
-
-            logger.info('Task created.')
-            return {"status": 200, "event": event, 'message': None}
+        set_task_total(task.taskId, len([result for result in results
+                                         if result.error is None and not result.skipped and not result.deferred]))
     except Exception as err:
-        error = ''.join(traceback.format_exception(None, err, err.__traceback__))
-
-        logger.error("Manual task execute error: " + error)
-        return {'status': 400, 'event': event, 'message': error}
+        # the jobs are created, their messages are not received again to create them again
+        logger.error('Task(%s) total set with error - %s' % (task.taskId, err))
 
-    return {"status": 400, "event": event, 'message': 'Ignored. Key is directory or task already exists.'}
+    logger.info('Task created, total job - %d' % len(keys))
+    return results
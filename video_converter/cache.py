@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread safe in-memory cache, the entries are expired after `ttl` seconds and the least
+    recently used entry is evicted when the cache is full.
+
+    Example:
+    >>> cache = TTLCache(ttl=300, maxsize=64)
+    >>> cache.get('key', lambda: load_value('key'))
+    """
+    def __init__(self, ttl: float, maxsize: int = 128):
+        self.ttl = ttl
+        """ Seconds before an entry is expired """
+        self.maxsize = maxsize
+        """ The max number of entries in cache """
+        self.hits = 0
+        """ Total lookups answered by the cache """
+        self.misses = 0
+        """ Total lookups not in the cache or expired """
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, loader: Callable[[], Any] = None, default: Any = None) -> Any:
+        """
+        Get the value of key from cache
+        Args:
+            key: The key of entry
+            loader: The function to load the value when missed, the loaded value is stored in cache
+            default: The value returned when missed and no loader is given
+        Returns:
+            The cached or loaded value
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        if loader is None:
+            return default
+
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        """
+        Store the value of key in cache
+        Args:
+            key: The key of entry
+            value: The value of entry
+            ttl: Seconds before the entry is expired, default is the `ttl` of cache
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable = None):
+        """
+        Remove the entry of key from cache
+        Args:
+            key: The key of entry, remove all entries if `None`
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def keys(self) -> list:
+        """ A snapshot of the keys in cache, includes the expired ones not evicted yet """
+        with self._lock:
+            return list(self._entries.keys())
+
+    def stats(self) -> dict:
+        """ Hits, misses and size of the cache """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return _MISSING
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return _MISSING
+
+        self._entries.move_to_end(key)
+        return value
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import posixpath
+import re
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+from xml.etree import ElementTree
+
+from task import TaskItem, TaskItemBatchWriter, get_db, get_output_url, get_s3, get_source, \
+    increase_task_counters, option_store, taskitem_table_name
+
+
+class ContentDedupe:
+    """
+    Content dedupe of the sources in a bucket by option `<bucket>-ContentDedupe` (or `default-ContentDedupe`).
+    A source is converted only once for the same content (ETag and size) and job template across keys
+    and buckets: the outputs of the completed task item of the same content are copied to the
+    destination of the source by S3 server-side copy instead of creating a job, refer to
+    `copy_content_outputs`.
+
+    Example:
+    >>> dedupe = get_content_dedupe('bucket')
+    >>> item = dedupe(taskid, 'sub-dir/demo.mp4', template_name, (etag, size))
+    """
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        """ Bucket name where the sources in """
+
+    def __call__(self, taskid: str, key: str, template_name: str, content: Tuple[str, int],
+                 writer: TaskItemBatchWriter = None) -> TaskItem:
+        """
+        Copy the outputs of the same content converted with the template
+        Args:
+            taskid: The id of Task
+            key: Key of the source in bucket
+            template_name: The template name used to create MediaConvert job
+            content: The ETag and size of the source
+            writer: The batch writer to buffer the task item and counters, write them directly if `None`
+        Returns:
+            The `COMPLETE` task item saved, `None` if the same content is not converted with the template
+        """
+        origin = get_content_origin(*content, template_name)
+        if origin is None:
+            return None
+
+        return copy_content_outputs(taskid, self.bucket, key, template_name, origin, content, writer)
+
+
+def get_content_dedupe(bucket: str) -> ContentDedupe:
+    """
+    Get the content dedupe of bucket
+    Args:
+        bucket: Bucket name where the sources in
+    Returns:
+        The content dedupe, `None` if option `ContentDedupe` of the bucket is not `true`
+    """
+    if str(option_store.bucket_option(bucket, 'ContentDedupe', 'false')).upper() != 'TRUE':
+        return None
+
+    return ContentDedupe(bucket)
+
+
+def get_content_origin(etag: str, size: int, template_name: str) -> TaskItem:
+    """
+    Look up a completed task item converted from the same content with the template
+    Args:
+        etag: ETag of the source object
+        size: Size of the source object
+        template_name: The template name used to create MediaConvert job
+    Returns:
+        The task item with the outputs recorded, `None` if not found
+    """
+    params = {
+        'IndexName': 'ContentIndex',
+        'KeyConditionExpression': 'S_ETag = :etag AND N_Size = :size',
+        'FilterExpression': 'S_Status = :status AND S_TemplateName = :template AND attribute_exists(S_Outputs)',
+        'ExpressionAttributeValues': {
+            ':etag': etag.strip('"'),
+            ':size': size,
+            ':status': 'COMPLETE',
+            ':template': template_name,
+        },
+    }
+    table = get_db().Table(taskitem_table_name)
+
+    while True:
+        resp = table.query(**params)
+        if len(resp.get('Items', [])) > 0:
+            return TaskItem.from_item(resp['Items'][0])
+
+        if 'LastEvaluatedKey' not in resp:
+            return None
+        params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def copy_content_outputs(taskid: str, bucket: str, key: str, template_name: str, origin: TaskItem,
+                         content: Tuple[str, int], writer: TaskItemBatchWriter = None) -> TaskItem:
+    """
+    Copy the outputs of the task item converted from the same content to the destination of source
+    by S3 server-side copy, and save a `COMPLETE` task item instead of creating a MediaConvert job.
+    The output files are renamed after the source if they are named after the origin source, the
+    files of a segmented output group (e.g. HLS) are enumerated from its manifest, and the manifests
+    referring to renamed files are rewritten
+    Args:
+        taskid: The id of Task
+        bucket: Bucket name where the source in
+        key: Key of the source in bucket
+        template_name: The template name used to create MediaConvert job
+        origin: The task item found by `get_content_origin`
+        content: The ETag and size of the source
+        writer: The batch writer to buffer the task item and counters, write them directly if `None`
+    Returns:
+        The task item saved
+    """
+    client = get_s3()
+    dest, output = get_output_url(template_name, bucket, key)
+    output = output if output is not None else dest
+    output_dir = output[0:output.rindex('/') + 1]
+
+    origin_name = _get_basename(origin.source)
+    name = _get_basename(key)
+
+    groups, copied = [], set()
+    for group in json.loads(origin.outputs):
+        paths = []
+        for path in group['paths']:
+            origin_dir = path[0:path.rindex('/') + 1]
+            files, manifests = [path], dict()
+            if group['type'] != 'FILE_GROUP':
+                files, manifests = _get_output_files(client, path)
+
+            for url in files:
+                target = output_dir + _rename_output(url[len(origin_dir):], origin_name, name)
+                if url != target and url not in copied:
+                    src_bucket, src_key = _split_url(url)
+                    dst_bucket, dst_key = _split_url(target)
+                    if url in manifests and origin_name != name:
+                        body, content_type, refs = manifests[url]
+                        for ref in sorted(refs, key=len, reverse=True):
+                            body = body.replace(ref, _rename_output(ref, origin_name, name))
+                        client.put_object(Bucket=dst_bucket, Key=dst_key, Body=body.encode('utf-8'),
+                                          ContentType=content_type)
+                    else:
+                        client.copy({'Bucket': src_bucket, 'Key': src_key}, dst_bucket, dst_key)
+                    copied.add(url)
+
+                if url == path:
+                    paths.append(target)
+
+        groups.append({'type': group['type'], 'paths': paths})
+
+    now = datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
+
+    item = TaskItem()
+    item.itemid = uuid.uuid4().hex
+    item.source = get_source(bucket, key)
+    item.source_bucket = bucket
+    item.target = get_source(dest, key)
+    item.taskid = taskid
+    item.status = 'COMPLETE'
+    item.progress = 100
+    item.created_at = now
+    item.finished_at = now
+    item.template_name = template_name
+    item.etag, item.size = content[0].strip('"'), content[1]
+    item.outputs = json.dumps(groups, separators=(',', ':'))
+    item.copied_from = origin.itemid
+
+    if writer is None:
+        increase_task_counters(taskid, {'N_Finished': 1, 'N_ProgressSum': 100})
+        get_db().Table(taskitem_table_name).put_item(
+            Item=item.as_dict(),
+            ReturnValues='NONE')
+    else:
+        writer.put_item(item)
+
+    return item
+
+
+def _get_basename(key: str) -> str:
+    name = key[key.rindex('/') + 1:] if '/' in key else key
+    return name.rsplit('.', 1)[0] if '.' in name else name
+
+
+def _split_url(url: str) -> Tuple[str, str]:
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def _list_keys(client, bucket: str, prefix: str) -> Iterator[str]:
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for f in page.get('Contents', []):
+            yield f['Key']
+
+
+def _rename_output(path: str, origin_name: str, name: str) -> str:
+    head, _, filename = path.rpartition('/')
+    if filename.startswith(origin_name):
+        filename = name + filename[len(origin_name):]
+    return head + '/' + filename if head else filename
+
+
+def _get_output_files(client, url: str) -> Tuple[List[str], Dict[str, Tuple[str, str, List[str]]]]:
+    """
+    Get the files of an output of a segmented group from its manifest: the playlists and segments
+    referred by a HLS playlist recursively, the segments matching the templates of a DASH manifest,
+    or the tracks of a Smooth Streaming manifest. The files out of the directory of the manifest are
+    ignored.
+    Args:
+        client: The S3 client
+        url: The S3 url of the manifest
+    Returns:
+        The urls of the files including the manifest, and the body, content type and the references
+        of each manifest by its url
+    """
+    base = url[0:url.rindex('/') + 1]
+    files, manifests, pending = [], dict(), [url]
+    while len(pending) > 0:
+        current = pending.pop(0)
+        if current in files or not current.startswith(base):
+            continue
+        files.append(current)
+
+        ext = os.path.splitext(current)[1].lower()
+        if ext not in ('.m3u8', '.mpd', '.ism'):
+            continue
+
+        bucket, key = _split_url(current)
+        resp = client.get_object(Bucket=bucket, Key=key)
+        body = resp['Body'].read().decode('utf-8')
+        current_dir = current[0:current.rindex('/') + 1]
+        if ext == '.m3u8':
+            refs = _get_hls_refs(body)
+            pending.extend(_join_url(current_dir, ref) for ref in refs)
+        elif ext == '.ism':
+            refs = _get_smooth_refs(body)
+            pending.extend(_join_url(current_dir, ref) for ref in refs)
+        else:
+            refs = _get_dash_refs(body)
+            dir_bucket, dir_key = _split_url(current_dir)
+            for pattern, prefix in _get_dash_patterns(body, refs):
+                for k in _list_keys(client, dir_bucket, dir_key + prefix):
+                    if pattern.fullmatch(k[len(dir_key):]):
+                        pending.append('s3://%s/%s' % (dir_bucket, k))
+        manifests[current] = (body, resp.get('ContentType', 'binary/octet-stream'), refs)
+
+    return files, manifests
+
+
+def _join_url(base: str, ref: str) -> str:
+    if '://' in ref or ref.startswith('/'):
+        return ref
+    bucket, key = _split_url(base + ref.split('?', 1)[0])
+    return 's3://%s/%s' % (bucket, posixpath.normpath(key))
+
+
+def _get_hls_refs(body: str) -> List[str]:
+    refs = []
+    for line in body.splitlines():
+        line = line.strip()
+        if line.startswith('#'):
+            refs.extend(re.findall(r'URI="([^"]+)"', line))
+        elif line:
+            refs.append(line)
+    return list(dict.fromkeys(refs))
+
+
+def _get_smooth_refs(body: str) -> List[str]:
+    refs = []
+    for element in ElementTree.fromstring(body).iter():
+        if 'src' in element.attrib:
+            refs.append(element.attrib['src'])
+        if element.attrib.get('name') == 'clientManifestRelativePath' and 'content' in element.attrib:
+            refs.append(element.attrib['content'])
+    return list(dict.fromkeys(refs))
+
+
+def _get_dash_refs(body: str) -> List[str]:
+    refs = []
+    for element in ElementTree.fromstring(body).iter():
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'BaseURL' and element.text and element.text.strip():
+            refs.append(element.text.strip())
+        for attr in ('media', 'initialization', 'sourceURL'):
+            if attr in element.attrib:
+                refs.append(element.attrib[attr])
+    return list(dict.fromkeys(refs))
+
+
+def _get_dash_patterns(body: str, refs: List[str]) -> List[Tuple[Any, str]]:
+    """ The patterns of the relative keys matching the references of DASH manifest, and their literal prefixes """
+    ids = [e.attrib['id'] for e in ElementTree.fromstring(body).iter()
+           if e.tag.rsplit('}', 1)[-1] == 'Representation' and 'id' in e.attrib]
+    patterns = []
+    for ref in refs:
+        if '://' in ref or ref.startswith('/') or ref.endswith('/'):
+            continue
+        pattern = ''
+        for i, part in enumerate(re.split(r'(\$[^$]*\$)', ref)):
+            if i % 2 == 0:
+                pattern += re.escape(part)
+            elif part == '$$':
+                pattern += re.escape('$')
+            elif part == '$RepresentationID$':
+                pattern += '(?:%s)' % '|'.join(re.escape(rid) for rid in ids)
+            else:
+                pattern += r'\d+'
+        patterns.append((re.compile(pattern), ref.split('$', 1)[0]))
+    return patterns
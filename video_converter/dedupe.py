@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import math
+from typing import Callable, Iterable
+
+EXACT_LIMIT = 200000  # The max number of sources kept in a set, a bloom filter is used for more
+BLOOM_ERROR_RATE = 0.001  # The false positive rate of bloom filter
+
+
+class BloomFilter:
+    """
+    A compact probabilistic set, a lookup may be false positive but never false negative.
+
+    Example:
+    >>> f = BloomFilter(capacity=1000000)
+    >>> f.add('s3://bucket/demo.mp4')
+    >>> 's3://bucket/demo.mp4' in f
+    True
+    """
+    def __init__(self, capacity: int, error_rate: float = BLOOM_ERROR_RATE):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        """ Number of bits """
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        """ Number of hash functions """
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(value))
+
+    def add(self, value: str):
+        for i in self._indexes(value):
+            self._bits[i >> 3] |= 1 << (i & 7)
+
+    def _indexes(self, value: str):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+
+class SourceSet:
+    """
+    Sources already converted, loaded in bulk to answer the duplicate checks locally.
+    The sources are kept in a set, if there are more than `EXACT_LIMIT` of them, they are moved into
+    a bloom filter and a hit is confirmed by the exact check.
+
+    Example:
+    >>> sources = SourceSet(loaded_sources, is_source_converted)
+    >>> sources.contains('s3://bucket/demo.mp4')
+    False
+    """
+    def __init__(self, sources: Iterable[str], exact_check: Callable[[str], bool], exact_limit: int = EXACT_LIMIT):
+        self._exact_check = exact_check
+        self._set = set()
+        self._bloom = None
+        self.count = 0
+        """ Number of sources loaded """
+        self.exact_checks = 0
+        """ Number of hits confirmed by the exact check """
+
+        for source in sources:
+            self.count += 1
+            if self._bloom is not None:
+                self._bloom.add(source)
+                continue
+
+            self._set.add(source)
+            if len(self._set) > exact_limit:
+                self._bloom = BloomFilter(exact_limit * 8)
+                for v in self._set:
+                    self._bloom.add(v)
+                self._set = None
+
+    @property
+    def probabilistic(self) -> bool:
+        """ Whether the sources are kept in a bloom filter """
+        return self._bloom is not None
+
+    def contains(self, source: str) -> bool:
+        """
+        Check whether the source is converted
+        Args:
+            source: The source url
+        Returns:
+            Whether the source is converted
+        """
+        if self._bloom is None:
+            return source in self._set
+
+        if source not in self._bloom:
+            return False
+
+        self.exact_checks += 1
+        return self._exact_check(source)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+
+from cache import TTLCache
+from options import OptionStore
+
+BASE_PARAMS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'task_params.json')
+OVERLAY_CACHE_TTL = 300  # The number of seconds that a merged base params is valid
+OVERLAY_CACHE_SIZE = 64  # The max number of merged base params in cache
+
+
+def merge_params(base: dict, overlay: dict) -> dict:
+    """
+    Merge the overlay into base params, both of them are not changed
+    Dicts are merged recursively, other values (includes lists) in overlay replace the ones in base
+    Args:
+        base: The base params
+        overlay: The params to override the base one
+    Returns:
+        The merged params
+    """
+    merged = dict(base)
+    for k, v in overlay.items():
+        if isinstance(v, dict) and isinstance(merged.get(k, None), dict):
+            merged[k] = merge_params(merged[k], v)
+        else:
+            merged[k] = v
+
+    return merged
+
+
+class JobSpecBuilder:
+    """
+    Builder of the `create_job` params of MediaConvert.
+    The base params is loaded from `task_params.json` once, the overlays in options are merged
+    into it by order of `default-JobParams`, `template-<template>-JobParams` and `<bucket>-JobParams`.
+    The overlay options are JSON objects in the same structure of `task_params.json`.
+    Each job params is a shallow copy of the merged base with its own input and output patched,
+    so the merged base MUST NOT be changed by the caller.
+
+    Example:
+    >>> builder = JobSpecBuilder(option_store)
+    >>> params = builder.build('bucket', 'template', 's3://bucket/demo.mp4', role_arn)
+    """
+    def __init__(self, options: OptionStore, path: str = BASE_PARAMS_FILE):
+        self.path = path
+        """ Path of the base params file """
+        self._options = options
+        self._base = None
+        self._merged = TTLCache(OVERLAY_CACHE_TTL, OVERLAY_CACHE_SIZE)
+        self._lock = threading.Lock()
+
+    def base(self, bucket: str, template_name: str) -> dict:
+        """
+        Get the base params merged with the overlays of bucket and template
+        Args:
+            bucket: Bucket name where the source in
+            template_name: The template name used to create MediaConvert job
+        Returns:
+            The merged base params
+        """
+        return self._merged.get((bucket, template_name), lambda: self._merge(bucket, template_name))
+
+    def build(self, bucket: str, template_name: str, source: str, role: str, destination: str = None) -> dict:
+        """
+        Build the `create_job` params of a job
+        Args:
+            bucket: Bucket name where the source in
+            template_name: The template name used to create MediaConvert job
+            source: The source url of job input
+            role: The IAM role used to create MediaConvert job
+            destination: The destination url of job output, use the one of JobTemplate if `None`
+        Returns:
+            The params of job
+        """
+        base = self.base(bucket, template_name)
+
+        inputs = list(base['Settings']['Inputs'])
+        inputs[0] = dict(inputs[0], FileInput=source)
+
+        settings = dict(base['Settings'], Inputs=inputs)
+        if destination is not None:
+            settings['OutputGroups'] = [{
+                'OutputGroupSettings': {
+                    'Type': 'FILE_GROUP_SETTINGS',
+                    'FileGroupSettings': {
+                        'Destination': destination
+                    },
+                }
+            }]
+
+        return dict(base, Role=role, JobTemplate=template_name, Settings=settings)
+
+    def invalidate(self):
+        """
+        Reload the base params file and overlays on next build
+        """
+        with self._lock:
+            self._base = None
+        self._merged.invalidate()
+
+    def _load(self) -> dict:
+        if self._base is None:
+            with self._lock:
+                if self._base is None:
+                    with open(self.path, 'r') as f:
+                        self._base = json.load(f)
+
+        return self._base
+
+    def _merge(self, bucket: str, template_name: str) -> dict:
+        params = self._load()
+
+        for key in ('default-JobParams', 'template-%s-JobParams' % template_name, '%s-JobParams' % bucket):
+            overlay = self._options.get(key)
+            if overlay:
+                params = merge_params(params, json.loads(overlay) if isinstance(overlay, str) else overlay)
+
+        return params
@@ -1,92 +1,320 @@
 # -*- coding: utf-8 -*-
 
+import os
+import jmespath
 import logging
 import traceback
 from task import *
-# from mediainfo import get_media_info
+from content import get_content_dedupe
+from routing import get_router
+from scheduler import get_scheduler
+from metrics import LOG_LEVEL, instrumented, log_event, phase
 
-logging.getLogger().setLevel(logging.INFO)
+LISTING_PAGE_SIZE = 500  # The max number of objects listed and submitted in one slice
+DEADLINE_MARGIN = 60 * 1000  # Stop listing when the remaining time of invocation is less than it (in milliseconds)
+DEFER_DELAY = 60  # The number of seconds to delay the continuation of a task with the deferred jobs
+
+logging.getLogger().setLevel(LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 
-def lambda_handler(event, _):
-    logger.info("Manual task request: " + json.dumps(event, indent=2))
+@instrumented('ManualExecutor')
+def lambda_handler(event, context):
+    log_event(logger, event, records=len(event['Records']))
 
-    msg = event['Records'][0]
-    attributes = msg['messageAttributes']
+    code = 200
+    messages = []
+    failures = []
 
-    try:
-        taskid = msg['messageId']
+    for msg in event['Records']:
+        if context is not None and context.get_remaining_time_in_millis() < DEADLINE_MARGIN:
+            # no time left for the task, the message will be received again
+            logger.info('Manual task deferred, message - %s' % msg['messageId'])
+            failures.append({'itemIdentifier': msg['messageId']})
+            continue
 
-        bucket = attributes.get('Bucket', dict()).get('stringValue', None)
-        key = attributes.get('Key', dict()).get('stringValue', None)
-        template = attributes.get('TemplateName', dict()).get('stringValue', None)
-        condition = attributes.get('Filter', dict()).get('stringValue', None)
-        force = attributes.get('Force', dict()).get('stringValue', 'False').upper() == 'TRUE'
+        try:
+            status, message = _execute(msg, context)
+        except Exception as err:
+            error = ''.join(traceback.format_exception(None, err, err.__traceback__))
 
-        if bucket is None:
-            raise ValueError('bucket is none')
+            # TODO log error to dynamodb
+
+            logger.error("Manual task executed with error - " + error)
+            status, message = 400, error
+            if not isinstance(err, ValueError):
+                # retry the message unless it is invalid
+                failures.append({'itemIdentifier': msg['messageId']})
+
+        code = max(code, status)
+        messages.append(message)
+
+    return {"status": code, "event": event, 'message': messages[0] if len(messages) == 1 else messages,
+            'batchItemFailures': failures}
 
-        if is_task_exists(bucket, key, condition) and not force:
-            logger.info('Task already exists, exit!')
-            return {'status': 400, 'event': event, 'message': 'task already exists'}
 
+def _execute(msg: dict, context) -> tuple:
+    """
+    Execute the manual task of a message
+    Args:
+        msg: The message record
+        context: The lambda context, `None` means no deadline
+    Returns:
+        The status code and message of the execution
+    """
+    attributes = msg['messageAttributes']
+
+    # continuation message of a sliced task carries the id of the task
+    taskid = attributes.get('TaskId', dict()).get('stringValue', msg['messageId'])
+
+    bucket = attributes.get('Bucket', dict()).get('stringValue', None)
+    key = attributes.get('Key', dict()).get('stringValue', None)
+    template = attributes.get('TemplateName', dict()).get('stringValue', None)
+    condition = attributes.get('Filter', dict()).get('stringValue', None)
+    force = attributes.get('Force', dict()).get('stringValue', 'False').upper() == 'TRUE'
+
+    if bucket is None:
+        raise ValueError('bucket is none')
+
+    task = get_task(taskid)
+    if task is None:
         if template is None:
             template = get_bucket_template_name(bucket)
 
+        if is_task_exists(bucket, key, condition, template) and not force:
+            logger.info('Task already exists, exit!')
+            return 400, 'task already exists'
+
         task = create_task(taskid, bucket, key, condition, template)
-        total = 0
+    elif task.executedAt is not None:
+        logger.info('Task already executed, exit!')
+        return 400, 'task already executed'
+    else:
+        logger.info('Task resumed, submitted job - %d' % task.submitted)
 
-        if not task.key or task.key.endswith('/'):
-            client = boto3.client('s3').get_paginator('list_objects_v2')
-            if not task.key:
-                paginator = client.paginate(Bucket=task.bucket)
-            else:
-                paginator = client.paginate(Bucket=task.bucket, Prefix=task.key)
-            files = paginator.search(condition if condition is not None else 'Contents[]')
-
-            for f in files:
-                key = f['Key']
-                if key.endswith('/'):
-                    continue
-
-                # get video resolution by mediainfo
-                # mi = get_media_info(bucket, key)
-                # for track in mi.tracks:
-                #     if track.track_type == 'Video':
-                #         logger.info('Video resolution is %d x %d' % (track.width, track.high))
-
-                logger.info('Job recieved, source - %s' % get_source(bucket, key))
-
-                if not key.endswith('/'):
-                    if force or not is_taskitem_exists(task.bucket, key):
-                        create_converter_job(task.taskId, task.bucket, key, task.template_name)
-                        total += 1
-                    else:
-                        logger.info('Job already exists, source - %s' % get_source(bucket, key))
-                else:
-                    logger.info('Job source is directory, source - %s' % get_source(bucket, key))
-
-        elif not task.key.endswith('/'):
-            logger.info('Job recieved, source - %s' % get_source(bucket, key))
-
-            if source_file_exists(task.bucket, task.key) > 0:
-                if force or not is_taskitem_exists(task.bucket, key):
-                    create_converter_job(task.taskId, task.bucket, task.key, task.template_name)
-                    total += 1
-                else:
-                    logger.info('Job already exists, source - %s' % get_source(bucket, key))
+    total = 0
+
+    if not task.key or task.key.endswith('/'):
+        if not _submit_objects(task, condition, force, context):
+            # wait for the running jobs to finish before the deferred jobs are submitted again
+            _continue_task(msg, task.taskId, DEFER_DELAY if task.listed_at is not None else 0)
+            logger.info('Manual task sliced, submitted job - %d, deferred job - %d' % (task.submitted, task.deferred))
+            return 200, 'task continued'
+
+        total = task.submitted
+
+    elif not task.key.endswith('/'):
+        logger.info('Job recieved, source - %s' % get_source(bucket, key))
+
+        if source_file_exists(task.bucket, task.key) > 0:
+            result = next(submit_converter_jobs(task.taskId, task.bucket, [task.key], task.template_name, force,
+                                                concurrency=1, router=get_router(task.bucket, task.template_name),
+                                                admission=admission_controller,
+                                                scheduler=get_scheduler(task.bucket),
+                                                dedupe=get_content_dedupe(task.bucket)))
+            if result.error is not None:
+                raise result.error
+            elif result.deferred:
+                _continue_task(msg, task.taskId, DEFER_DELAY)
+                logger.info('Job deferred, source - %s' % get_source(bucket, key))
+                return 200, 'task continued'
+            elif result.item is not None and result.skipped:
+                logger.info('Job skipped by routing, source - %s' % get_source(bucket, key))
+            elif result.skipped:
+                logger.info('Job already exists, source - %s' % get_source(bucket, key))
             else:
-                logger.info('Job source not exists, source - %s' % get_source(bucket, key))
+                total += 1
+        else:
+            logger.info('Job source not exists, source - %s' % get_source(bucket, key))
+
+    set_task_total(task.taskId, total)
+    logger.info('Manual task started, total job - %d' % total)
+
+    return 200, None
+
+
+def _submit_objects(task: Task, condition: str, force: bool, context) -> bool:
+    """
+    List objects in bucket slice by slice from the checkpoint of task and submit jobs for them
+    A checkpoint is saved after each slice, the listing stops before the deadline of invocation.
+    The jobs deferred by the admission control are saved as `DEFERRED` task items and submitted
+    again before the listing goes on
+    Args:
+        task: The task to submit jobs
+        condition: The filter condition used to look up objects in bucket
+        force: Whether to create the job even if the task item of the source is exists
+        context: The lambda context, `None` means no deadline
+    Returns:
+        Whether all objects are listed and no job is deferred
+    """
+    client = get_s3()
+    expression = jmespath.compile(condition if condition is not None else 'Contents[]')
+
+    params = {'Bucket': task.bucket, 'MaxKeys': LISTING_PAGE_SIZE}
+    if task.key:
+        params['Prefix'] = task.key
+
+    converted = None
+    if not force and task.listed_at is None:
+        with phase('LoadConverted'):
+            converted = get_converted_sources(task.bucket, task.key)
+        logger.info('Converted sources loaded, total - %d, probabilistic - %s'
+                    % (converted.count, converted.probabilistic))
 
-        set_task_total(task.taskId, total)
-        logger.info('Manual task started, total job - %d' % total)
+    router = get_router(task.bucket, task.template_name)
+    scheduler = get_scheduler(task.bucket)
+    dedupe = get_content_dedupe(task.bucket)
+
+    sliced = 0
+    with TaskItemBatchWriter() as writer:
+        if task.deferred > 0:
+            with phase('SubmitDeferred'):
+                _submit_deferred(task, writer, router, scheduler, dedupe)
+            sliced += 1
+
+        while task.listed_at is None:
+            # always submit one slice at least to make sure the task is progressing
+            if sliced > 0 and context is not None and context.get_remaining_time_in_millis() < DEADLINE_MARGIN:
+                return False
+
+            if task.continuation_token is not None:
+                params['ContinuationToken'] = task.continuation_token
+
+            with phase('List'):
+                page = client.list_objects_v2(**params)
+            submitted = 0
+            deferred = 0
+            contents = {f['Key']: (f['ETag'].strip('"'), f['Size']) for f in page.get('Contents', [])}
+
+            with phase('Submit'):
+                for result in submit_converter_jobs(task.taskId, task.bucket, _keys(task, expression.search(page)),
+                                                    task.template_name, force, writer=writer, converted=converted,
+                                                    router=router, contents=contents, admission=admission_controller,
+                                                    scheduler=scheduler, dedupe=dedupe):
+                    if result.deferred:
+                        defer_converter_job(task.taskId, task.bucket, result.key, writer)
+                        deferred += 1
+                    elif _is_submitted(task, result):
+                        submitted += 1
+
+                _flush(writer)
+
+            task.continuation_token = page.get('NextContinuationToken', None) if page.get('IsTruncated') else None
+            task.submitted += submitted
+            task.deferred += deferred
+            with phase('Checkpoint'):
+                save_task_checkpoint(task.taskId, task.continuation_token, submitted, deferred,
+                                     listed=task.continuation_token is None)
+            if task.continuation_token is None:
+                task.listed_at = datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
+            sliced += 1
+
+    logger.info('Admission of jobs - %s' % json.dumps(admission_controller.stats()))
+    if scheduler is not None:
+        logger.info('Outstanding jobs of queues - %s' % json.dumps(scheduler.stats()))
+    return task.deferred == 0
+
+
+def _submit_deferred(task: Task, writer: TaskItemBatchWriter, router, scheduler, dedupe):
+    """
+    Submit the jobs deferred of task again, as many as the running jobs of task can be admitted.
+    The submitted ones are deleted and the ones deferred again are left as they are, so nothing is
+    read or written while the task has the max running jobs
+    Args:
+        task: The task to submit jobs
+        writer: The batch writer to buffer the task items and counters
+        router: The router to pick the template of each source, `None` if no routing rules
+        scheduler: The scheduler to assign the queue and priority of each job, `None` if no scheduler policy
+        dedupe: The content dedupe to copy the outputs of the same content, `None` if not enabled
+    """
+    available = admission_controller.available(task.taskId)
+    if available == 0:
+        logger.info('Deferred jobs left, task has the max running jobs - %d' % task.deferred)
+        return
+
+    items = {item.source[len(get_source(task.bucket, '')):]: item
+             for item in get_deferred_taskitems(task.taskId, available)}
+    submitted = 0
+    deferred = 0
+    done = []  # ids of the deferred items submitted
+
+    for result in submit_converter_jobs(task.taskId, task.bucket, items.keys(), task.template_name, True,
+                                        writer=writer, router=router, admission=admission_controller,
+                                        scheduler=scheduler, dedupe=dedupe):
+        if result.deferred:
+            deferred += 1
+            continue
+        elif _is_submitted(task, result):
+            submitted += 1
+
+        if result.error is None:
+            done.append(items[result.key].itemid)
+
+    _flush(writer)
+    delete_taskitems(done)
+
+    task.submitted += submitted
+    task.deferred -= len(done)
+    save_task_checkpoint(task.taskId, task.continuation_token, submitted, -len(done))
+    logger.info('Deferred jobs submitted - %d, deferred again - %d' % (submitted, deferred))
+
+
+def _flush(writer: TaskItemBatchWriter):
+    """
+    Write the task items of a slice before its checkpoint, the jobs of the items are created already,
+    so the slice is checkpointed even if the write fails to avoid creating them again. The items
+    not written are kept in writer and written again with the next slice
+    """
+    try:
+        writer.flush()
     except Exception as err:
-        error = ''.join(traceback.format_exception(None, err, err.__traceback__))
+        logger.error('Task items write with error, %d items are kept to write again - %s' % (len(writer.unsaved), err))
+
+
+def _is_submitted(task: Task, result: JobResult) -> bool:
+    if result.error is not None:
+        logger.error('Job submit with error, source - %s, error - %s'
+                     % (get_source(task.bucket, result.key), result.error))
+    elif result.item is not None and result.skipped:
+        logger.info('Job skipped by routing, source - %s' % get_source(task.bucket, result.key))
+    elif result.skipped:
+        logger.info('Job already exists, source - %s' % get_source(task.bucket, result.key))
+    else:
+        if result.copied:
+            logger.info('Job outputs copied from the same content, source - %s' % get_source(task.bucket, result.key))
+        return True
+
+    return False
+
+
+def _keys(task: Task, files: list):
+    for f in files or []:
+        if f['Key'].endswith('/'):
+            logger.info('Job source is directory, source - %s' % get_source(task.bucket, f['Key']))
+            continue
+
+        logger.info('Job recieved, source - %s' % get_source(task.bucket, f['Key']))
+        yield f['Key']
 
-        # TODO log error to dynamodb
 
-        logger.error("Manual task executed with error - " + error)
-        return {'status': 400, 'event': event, 'message': error}
+def _continue_task(msg: dict, taskid: str, delay: int = 0):
+    """
+    Send a continuation message of the task to the queue, the message has the same attributes with
+    the original one and an extra `TaskId` attribute
+    Args:
+        msg: The original message record
+        taskid: The id of Task
+        delay: The number of seconds to delay the message
+    """
+    attributes = {
+        k: {'DataType': v['dataType'], 'StringValue': v['stringValue']}
+        for k, v in msg['messageAttributes'].items() if v.get('stringValue', None) is not None
+    }
+    attributes['TaskId'] = {'DataType': 'String', 'StringValue': taskid}
 
-    return {"status": 200, "event": event, 'message': None}
+    get_sqs().send_message(
+        QueueUrl=os.environ['QUEUE_URL'],
+        MessageBody='continue task',
+        MessageAttributes=attributes,
+        DelaySeconds=delay
+    )
@@ -2,15 +2,26 @@
 
 import json
 import logging
+import os
 import subprocess
-import boto3
+import tempfile
+import zlib
 
-from typing import Any, Dict, List
-from task import get_source
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List
+from metrics import LOG_LEVEL
+from task import get_source, get_s3, batch_get_items, batch_write_items, BatchUnprocessed
 
 SIGNED_URL_EXPIRATION = 300  # The number of seconds that the Signed URL is valid
+PROBE_CONCURRENCY = 8  # The number of mediainfo processes run concurrently by default
+PROBE_TIMEOUT = 120  # The number of seconds before a mediainfo process is killed
+PROBE_HEAD_BYTES = 2 * 1024 * 1024  # The number of bytes fetched from the head of object by ranged probe at first
+PROBE_TAIL_BYTES = 1024 * 1024  # The number of bytes fetched from the tail of object by ranged probe at first
+PROBE_MAX_BYTES = 64 * 1024 * 1024  # The max number of bytes fetched by ranged probe
 
-logging.getLogger().setLevel(logging.INFO)
+mediainfo_table_name = 'video-converter-media-info'
+
+logging.getLogger().setLevel(LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 
@@ -33,31 +44,51 @@ class RecursiveNamespace:
 
 
 class _Decoder(json.JSONDecoder):
+    """
+    Decoder of mediainfo output, the keys are normalized and the string values are coerced to
+    bool/int/float while the objects are parsed, so the document is walked only once.
+    """
+    def __init__(self, **kwargs):
+        kwargs['object_pairs_hook'] = _decode_object
+        super().__init__(**kwargs)
+
     def decode(self, s, **kwargs):
-        result = super().decode(s)
-        return self._decode(result)
-
-    def _decode(self, o):
-        if isinstance(o, str):
-            if o.lower() == 'true':
-                return True
-            elif o.lower() == 'false':
-                return False
-            else:
-                try:
-                    return int(o)
-                except ValueError:
-                    try:
-                        return float(o)
-                    except ValueError:
-                        return o
-        elif isinstance(o, dict):
-            return {k: self._decode(v) for k, v in o.items()}
-        elif isinstance(o, list):
-            return [self._decode(v) for v in o]
-        else:
+        result = super().decode(s, **kwargs)
+        return result if isinstance(result, dict) else _decode_value(result)
+
+
+_NUMBER_STARTS = frozenset('0123456789+-.iInN')  # a string starts with other ascii chars is never a number
+
+
+def _decode_object(pairs: list) -> dict:
+    return {k.lower().strip().strip('_'): _decode_value(v) for k, v in pairs}
+
+
+def _decode_value(o):
+    if isinstance(o, str):
+        lower = o.lower()
+        if lower == 'true':
+            return True
+        elif lower == 'false':
+            return False
+
+        stripped = o.lstrip()
+        if not stripped or (stripped[0] not in _NUMBER_STARTS and stripped[0].isascii()):
             return o
 
+        try:
+            return int(o)
+        except ValueError:
+            try:
+                return float(o)
+            except ValueError:
+                return o
+    elif isinstance(o, list):
+        return [_decode_value(v) for v in o]
+    else:
+        # objects are decoded by the hook already
+        return o
+
 
 # noinspection PyUnresolvedReferences
 class Track:
@@ -68,6 +99,9 @@ class Track:
     yield a second attribute starting with `other_` which is a list of all alternative
     attribute values.
     When a non-existing attribute is accessed, `None` is returned.
+    The attributes are kept in the parsed dict of track which is not copied, so it MUST NOT be
+    changed by the caller. An attribute is materialized into the instance dict on its first access,
+    a nested dict as :class:`RecursiveNamespace`, and is read natively afterwards.
 
     Example:
     >>> t = mi.tracks[0]
@@ -81,63 +115,80 @@ class Track:
     NoneType
     All available attributes can be obtained by calling :func:`to_data`.
     """
+    __slots__ = ('track_type', '_data', '__dict__')
 
     def __eq__(self, other):  # type: ignore
-        return self.__dict__ == other.__dict__
-
-    def __getattribute__(self, name):  # type: ignore
-        try:
-            return object.__getattribute__(self, name)
-        except AttributeError:
-            pass
-        return None
+        return isinstance(other, Track) and self.to_data() == other.to_data()
+
+    def __getattr__(self, name):  # type: ignore
+        # only called on the first access of an attribute, a missing one is cached as None as well
+        if name.startswith('__') or name in Track.__slots__:
+            raise AttributeError(name)
+
+        value = self._data.get(self._key(name), None)
+        if isinstance(value, dict):
+            value = RecursiveNamespace(**value)
+        self.__dict__[name] = value
+        return value
+
+    def __setattr__(self, name, value):  # type: ignore
+        if name in Track.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            self._data[self._key(name)] = value
+            self.__dict__[name] = value
 
     def __getstate__(self):  # type: ignore
-        return self.__dict__
+        return self.to_data()
 
     def __setstate__(self, state):  # type: ignore
-        self.__dict__ = state
+        state = dict(state)
+        self._load(state.pop('track_type', None), state)
 
     def __init__(self, track: dict):
-        self.track_type = track["@type"]
+        if "track_id" not in track:
+            # the attributes are unique and `id` is read as `track_id`, keep the parsed dict
+            self._load(track["@type"], track)
+            return
+
+        data = dict()
         repeated_attributes = []
         for k, v in track.items():
             if k == "id":
                 k = "track_id"
 
-            if getattr(self, k) is None:
-                if isinstance(v, dict):
-                    v = json.loads(json.dumps(v), object_hook=lambda d: RecursiveNamespace(**d))
-
-                setattr(self, k, v)
+            if data.get(k, None) is None:
+                data[k] = v
             else:
                 other_name = f"other_{k}"
                 repeated_attributes.append((k, other_name))
-                if getattr(self, other_name) is None:
-                    setattr(self, other_name, [v])
+                if data.get(other_name, None) is None:
+                    data[other_name] = [v]
                 else:
-                    getattr(self, other_name).append(v)
+                    data[other_name].append(v)
 
         for primary_key, other_key in repeated_attributes:
             try:
                 # Attempt to convert the main value to int
                 # Usually, if an attribute is repeated, one of its value
                 # is an int and others are human-readable formats
-                setattr(self, primary_key, int(getattr(self, primary_key)))
-            except ValueError:
+                data[primary_key] = int(data[primary_key])
+            except (TypeError, ValueError):
                 # If it fails, try to find a secondary value
                 # that is an int and swap it with the main value
-                for other_value in getattr(self, other_key):
+                for other_value in data[other_key]:
                     try:
-                        current = getattr(self, primary_key)
+                        current = data[primary_key]
                         # Set the main value to an int
-                        setattr(self, primary_key, int(other_value))
+                        data[primary_key] = int(other_value)
                         # Append its previous value to other values
-                        getattr(self, other_key).append(current)
+                        data[other_key].append(current)
                         break
-                    except ValueError:
+                    except (TypeError, ValueError):
                         pass
 
+        self._load(track["@type"], data)
+
     def __repr__(self):  # type: ignore
         return "<Track track_id='{}', track_type='{}'>".format(self.track_id, self.track_type)
 
@@ -151,12 +202,18 @@ class Track:
         5988
         :rtype: dict
         """
-        data = self.__dict__
-        for k, v in data.items():
-            if isinstance(v, RecursiveNamespace):
-                data[k] = v.__dict__
+        data = {'track_type': self.track_type}
+        for k, v in self._data.items():
+            data["track_id" if k == "id" else k] = v
         return data
 
+    def _key(self, name: str) -> str:
+        return "id" if name == "track_id" and "id" in self._data else name
+
+    def _load(self, track_type: str, data: dict):
+        object.__setattr__(self, 'track_type', track_type)
+        object.__setattr__(self, '_data', data)
+
 
 # noinspection PyUnresolvedReferences
 class MediaInfo:
@@ -181,12 +238,18 @@ class MediaInfo:
 
     def __init__(self, mi_output: dict):
         self.tracks = []
+        self.bytes_fetched = None
+        """ Number of bytes fetched to probe the media, `None` if the media is not probed by ranged reads """
+
+        self._index = dict()  # tracks by type
 
         for iter_track in mi_output.get('media', dict()).get('track', []):
-            self.tracks.append(Track(iter_track))
+            track = Track(iter_track)
+            self.tracks.append(track)
+            self._index.setdefault(track.track_type, []).append(track)
 
     def _tracks(self, track_type: str) -> List[Track]:
-        return [track for track in self.tracks if track.track_type == track_type]
+        return self._index.get(track_type, [])
 
     @property
     def general_tracks(self) -> List[Track]:
@@ -259,22 +322,217 @@ class MediaInfo:
         return json.dumps(self.to_data())
 
 
-def get_media_info(bucket: str, key: str) -> MediaInfo:
+def get_media_info(bucket: str, key: str, etag: str = None, ranged: bool = False, size: int = None) -> MediaInfo:
     """
-    Get media info of an S3 media object
+    Get media info of an S3 media object, the result is cached by the ETag of object
     :param bucket:  S3 bucket name
     :param key:     S3 Key name
-    :return:        Signed URL
+    :param etag:    ETag of the object, looked up if `None`
+    :param ranged:  Whether to probe by ranged reads of the head and tail of object
+    :param size:    Size of the object, looked up if `None` and `ranged` is set
+    :return:        MediaInfo of the object
+    :raises RuntimeError: if the object failed to probe
+    """
+    mi = probe_media_infos(bucket, [key], {key: etag} if etag else None, concurrency=1, ranged=ranged,
+                           sizes={key: size} if size is not None else None)[key]
+    if mi is None:
+        raise RuntimeError('Mediainfo(%s) probe failed' % get_source(bucket, key))
+
+    return mi
+
+
+def probe_media_infos(bucket: str, keys: Iterable[str], etags: Dict[str, str] = None,
+                      concurrency: int = PROBE_CONCURRENCY, timeout: int = PROBE_TIMEOUT,
+                      ranged: bool = False, sizes: Dict[str, int] = None) -> Dict[str, MediaInfo]:
+    """
+    Get media info of S3 media objects, the objects are probed concurrently by a pool of mediainfo
+    processes. The results are cached in DynamoDB by the ETag of object, so an unchanged object is
+    never probed again
+    :param bucket:      S3 bucket name
+    :param keys:        S3 Key names
+    :param etags:       ETags of the objects by key, e.g. from the object listing, looked up if missing
+    :param concurrency: The number of mediainfo processes run concurrently
+    :param timeout:     The number of seconds before a mediainfo process is killed
+    :param ranged:      Whether to probe by ranged reads of the head and tail of objects, refer to `_probe_ranged`
+    :param sizes:       Sizes of the objects by key, looked up if missing and `ranged` is set
+    :return:            MediaInfo by key, `None` if the object failed to probe
+    """
+    keys = list(dict.fromkeys(keys))
+    etags = dict(etags or dict())
+    sizes = dict(sizes or dict())
+
+    def head(key: str):
+        # noinspection PyBroadException
+        try:
+            return _head(bucket, key)
+        except Exception as err:
+            logger.error("Mediainfo(%s) head with error - %s" % (get_source(bucket, key), err))
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(min(concurrency, len(keys)), 1)) as executor:
+        missing = [key for key in keys if not etags.get(key, None) or (ranged and sizes.get(key, None) is None)]
+        for key, response in zip(missing, executor.map(head, missing)):
+            if response is None:
+                # the object is neither looked up in cache nor probed, its result is `None`
+                etags.pop(key, None)
+                continue
+            etags[key] = response['ETag']
+            sizes[key] = response['ContentLength']
+
+        # noinspection PyBroadException
+        try:
+            cached = _get_cached_outputs(bucket, etags)
+        except Exception as err:
+            # the cache is best effort, the objects are probed instead
+            logger.warning("Mediainfo cache is not read, error - %s" % err)
+            cached = dict()
+        probing = [key for key in keys if key in etags and key not in cached]
+
+        def probe(key: str):
+            # noinspection PyBroadException
+            try:
+                if ranged:
+                    return _probe_ranged(bucket, key, sizes[key], timeout)
+                return _probe(_get_signed_url(bucket, key), timeout), None
+            except Exception as err:
+                logger.error("Mediainfo(%s) probe with error - %s" % (get_source(bucket, key), err))
+                return None, None
+
+        probed = dict(zip(probing, executor.map(probe, probing)))
+
+    _save_cached_outputs(bucket, {key: (etags[key], output) for key, (output, _) in probed.items() if output is not None})
+
+    if ranged:
+        fetched = {key: n for key, (_, n) in probed.items() if n is not None}
+        logger.info("Mediainfo probed %d objects by ranged reads, %d from cache, fetched %d of %d bytes"
+                    % (len(keys), len(cached), sum(fetched.values()), sum(sizes[key] for key in fetched)))
+
+    media_infos = dict()
+    for key in keys:
+        output, fetched = probed.get(key, (cached.get(key, None), 0 if key in cached else None))
+        media_infos[key] = MediaInfo(output) if output is not None else None
+        if media_infos[key] is not None:
+            media_infos[key].bytes_fetched = fetched
+
+    return media_infos
+
+
+def _probe(url: str, timeout: int) -> dict:
+    """
+    Run the mediainfo process for the media url
+    :param url:     URL or path of the media
+    :param timeout: The number of seconds before the process is killed
+    :return:        The normalized output of mediainfo
     """
-    signed_url = _get_signed_url(bucket, key)
     mi_output = json.loads(
-        subprocess.check_output(["/opt/bin/mediainfo", "--full", "--output=JSON", signed_url]),
+        subprocess.check_output(["/opt/bin/mediainfo", "--full", "--output=JSON", url], timeout=timeout),
         cls=_Decoder
     )
-    mi_output = _format_keys(mi_output)
+    return mi_output
+
+
+def _probe_ranged(bucket: str, key: str, size: int, timeout: int) -> tuple:
+    """
+    Probe the media by ranged reads instead of streaming the whole object.
+    The head and tail bytes of object are fetched into a sparse file in `/tmp` with the same size of
+    object, if mediainfo reports incomplete data then the ranges are doubled until the media info is
+    complete or `PROBE_MAX_BYTES` are fetched
+    :param bucket:  S3 bucket name
+    :param key:     S3 Key name
+    :param size:    Size of the object
+    :param timeout: The number of seconds before a mediainfo process is killed
+    :return:        The normalized output of mediainfo and the number of bytes fetched
+    """
+    client = get_s3()
+    head, tail = 0, 0  # bytes fetched from the head and tail
+    want_head, want_tail = PROBE_HEAD_BYTES, PROBE_TAIL_BYTES
+
+    with tempfile.NamedTemporaryFile(dir='/tmp', suffix=os.path.splitext(key)[1]) as f:
+        f.truncate(size)
+
+        while True:
+            want_head = min(want_head, size)
+            want_tail = min(want_tail, size - want_head)
+
+            for start, end in ((head, want_head), (size - want_tail, size - tail)):
+                if start < end:
+                    body = client.get_object(Bucket=bucket, Key=key, Range='bytes=%d-%d' % (start, end - 1))['Body']
+                    f.seek(start)
+                    f.write(body.read())
+            f.flush()
+            head, tail = want_head, want_tail
+
+            output = _probe(f.name, timeout)
+            fetched = head + tail
+            if fetched >= size or fetched >= PROBE_MAX_BYTES or _is_complete(output):
+                logger.info("Mediainfo(%s) fetched %d of %d bytes" % (get_source(bucket, key), fetched, size))
+                return output, fetched
+
+            want_head, want_tail = head * 2, tail * 2
+
+
+def _is_complete(mi_output: dict) -> bool:
+    """
+    Check whether the mediainfo output has the duration of media and the properties of its streams
+    :param mi_output: The normalized output of mediainfo
+    :return:          Whether the output is complete
+    """
+    tracks = mi_output.get('media', dict()).get('track', [])
+    general = [t for t in tracks if t.get('@type', None) == 'General']
+    if len(general) == 0 or general[0].get('duration', None) is None:
+        return False
 
-    logger.info("Mediainfo(%s): %s" % (get_source(bucket, key), json.dumps(mi_output, indent=2)))
-    return MediaInfo(mi_output)
+    streams = [t for t in tracks if t.get('@type', None) in ('Video', 'Audio')]
+    if len(streams) == 0:
+        return False
+
+    return all(t.get('width', None) is not None for t in streams if t['@type'] == 'Video')
+
+
+def _head(bucket: str, key: str) -> dict:
+    return get_s3().head_object(Bucket=bucket, Key=key)
+
+
+def _get_cache_keys(bucket: str, key: str, etag: str) -> dict:
+    return {'S_Source': get_source(bucket, key), 'S_ETag': etag.strip('"')}
+
+
+def _get_cached_outputs(bucket: str, etags: Dict[str, str]) -> Dict[str, dict]:
+    """
+    Get the cached mediainfo outputs of objects
+    :param bucket:  S3 bucket name
+    :param etags:   ETags of the objects by key
+    :return:        The outputs by key, the objects not cached are not included
+    """
+    keys = {get_source(bucket, key): key for key in etags}
+    items = batch_get_items(mediainfo_table_name, [_get_cache_keys(bucket, k, v) for k, v in etags.items()])
+
+    outputs = dict()
+    for item in items:
+        data = item['B_MediaInfo']
+        outputs[keys[item['S_Source']]] = json.loads(zlib.decompress(getattr(data, 'value', data)))
+
+    return outputs
+
+
+def _save_cached_outputs(bucket: str, outputs: Dict[str, tuple]):
+    """
+    Save the mediainfo outputs of objects to cache, the output is compressed to fit the item size limit
+    :param bucket:  S3 bucket name
+    :param outputs: The ETag and output of objects by key
+    """
+    requests = [{'PutRequest': {'Item': dict(
+        _get_cache_keys(bucket, key, etag),
+        B_MediaInfo=zlib.compress(json.dumps(output, separators=(',', ':')).encode('utf-8'))
+    )}} for key, (etag, output) in outputs.items()]
+
+    try:
+        batch_write_items(mediainfo_table_name, requests)
+    except BatchUnprocessed as err:
+        # the cache is best effort, the objects not saved are probed again next time
+        logger.warning("Mediainfo cache of %d objects is not saved" % len(err.requests))
+    except Exception as err:
+        logger.warning("Mediainfo cache of %d objects is not saved, error - %s" % (len(requests), err))
 
 
 def _get_signed_url(bucket: str, key: str) -> str:
@@ -284,16 +542,7 @@ def _get_signed_url(bucket: str, key: str) -> str:
     :param key:     S3 Key name
     :return:        Signed URL
     """
-    presigned_url = boto3.client("s3").generate_presigned_url('get_object',
-                                                              Params={'Bucket': bucket, 'Key': key},
-                                                              ExpiresIn=SIGNED_URL_EXPIRATION)
+    presigned_url = get_s3().generate_presigned_url('get_object',
+                                                     Params={'Bucket': bucket, 'Key': key},
+                                                     ExpiresIn=SIGNED_URL_EXPIRATION)
     return presigned_url
-
-
-def _format_keys(x) -> any:
-    if isinstance(x, list):
-        return [_format_keys(v) for v in x]
-    elif isinstance(x, dict):
-        return {k.lower().strip().strip('_'): _format_keys(v) for k, v in x.items()}
-    else:
-        return x
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+import boto3
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'  # Whether the metrics are emitted
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'VideoConverter')  # Namespace of the metrics in CloudWatch
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()  # Level of the root logger of handlers
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # Fraction of invocations profiled, 0 is off
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.01))  # Seconds between two samples of the profiler
+PROFILE_TOP_STACKS = 20  # The number of the most sampled stacks reported
+MAX_METRICS = 100  # The max metrics in one EMF document, the others are kept as properties only
+
+logger = logging.getLogger(__name__)
+
+
+class _Stat:
+    """ Aggregate of the timings of one AWS operation or handler phase """
+    __slots__ = ('count', 'errors', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float, error: bool = False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class Recorder:
+    """
+    Aggregator of the AWS calls and handler phases timed in an invocation.
+    The AWS calls are timed by the botocore hooks of the sessions instrumented by `instrument`,
+    and the phases by `phase`. The recorder is thread safe, the calls of the job workers are
+    aggregated with the ones of handler.
+
+    Example:
+    >>> with phase('list'):
+    ...     client.list_objects_v2(Bucket=bucket)
+    >>> recorder.calls[('s3', 'ListObjectsV2')].count
+    1
+    """
+    def __init__(self):
+        self.calls = defaultdict(_Stat)  # type: Dict[Tuple[str, str], _Stat]
+        """ Timings of the AWS calls by service and operation """
+        self.phases = defaultdict(_Stat)  # type: Dict[str, _Stat]
+        """ Timings of the handler phases by name """
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """ Drop the timings of the former invocation """
+        with self._lock:
+            self.calls = defaultdict(_Stat)
+            self.phases = defaultdict(_Stat)
+
+    def add_call(self, service: str, operation: str, seconds: float, error: bool = False):
+        with self._lock:
+            self.calls[(service, operation)].add(seconds, error)
+
+    def add_phase(self, name: str, seconds: float, error: bool = False):
+        with self._lock:
+            self.phases[name].add(seconds, error)
+
+    def as_emf(self, handler: str) -> dict:
+        """
+        The timings in CloudWatch Embedded Metric Format, each operation has the metrics
+        `<service>.<operation>.Calls`, `.Time`, `.MaxTime` and `.Errors`, each phase has `Phase.<name>.Time`
+        Args:
+            handler: The handler name, the dimension of metrics
+        Returns:
+            The EMF document
+        """
+        values = dict()
+        units = dict()
+
+        with self._lock:
+            for (service, operation), stat in sorted(self.calls.items()):
+                name = '%s.%s' % (service, operation)
+                values.update({name + '.Calls': stat.count, name + '.Time': round(stat.total * 1000, 3),
+                               name + '.MaxTime': round(stat.max * 1000, 3), name + '.Errors': stat.errors})
+                units.update({name + '.Calls': 'Count', name + '.Time': 'Milliseconds',
+                              name + '.MaxTime': 'Milliseconds', name + '.Errors': 'Count'})
+
+            for name, stat in sorted(self.phases.items()):
+                values['Phase.%s.Time' % name] = round(stat.total * 1000, 3)
+                units['Phase.%s.Time' % name] = 'Milliseconds'
+
+            values['AwsCalls'] = sum(stat.count for stat in self.calls.values())
+            values['AwsTime'] = round(sum(stat.total for stat in self.calls.values()) * 1000, 3)
+        units.update({'AwsCalls': 'Count', 'AwsTime': 'Milliseconds'})
+
+        names = ['AwsCalls', 'AwsTime'] + [name for name in units if name not in ('AwsCalls', 'AwsTime')]
+        return dict(values, Handler=handler, _aws={
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Handler']],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in names[:MAX_METRICS]],
+            }],
+        })
+
+
+recorder = Recorder()  # global recorder of the container
+
+
+def _before_call(context: dict = None, **_):
+    if context is not None:
+        context['metrics_started_at'] = time.perf_counter()
+
+
+def _after_call(event_name: str, context: dict = None, http_response=None, **kwargs):
+    started = context.pop('metrics_started_at', None) if context is not None else None
+    if started is None:
+        return
+
+    _, service, operation = event_name.split('.', 2)
+    error = kwargs.get('exception', None) is not None or \
+        (http_response is not None and http_response.status_code >= 400)
+    recorder.add_call(service, operation, time.perf_counter() - started, error)
+
+
+def instrument(session: boto3.session.Session) -> boto3.session.Session:
+    """
+    Time the AWS calls of the clients and resources created by the session
+    Args:
+        session: The boto3 session
+    Returns:
+        The same session
+    """
+    events = getattr(session, 'events', None)
+    if not METRICS_ENABLED or events is None:
+        return session
+
+    events.register('before-call', _before_call, unique_id='metrics-before-call')
+    events.register('after-call', _after_call, unique_id='metrics-after-call')
+    events.register('after-call-error', _after_call, unique_id='metrics-after-call-error')
+    return session
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time a phase of handler, the time of all phases with the same name in an invocation is summed
+    Args:
+        name: Name of the phase
+    """
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        recorder.add_phase(name, time.perf_counter() - started, error)
+
+
+def log(target: logging.Logger, level: int, message: str, **fields):
+    """
+    Log a message with the fields as one JSON object, nothing is serialized if the level is disabled
+    Args:
+        target: The logger
+        level: The level of message
+        message: The message
+        fields: The fields to log with the message
+    """
+    if target.isEnabledFor(level):
+        target.log(level, json.dumps(dict(fields, message=message), separators=(',', ':'), default=str))
+
+
+def log_event(target: logging.Logger, event: dict, **summary):
+    """
+    Log the received event of handler, the summary at `INFO` and the whole event with it at `DEBUG`
+    Args:
+        target: The logger
+        event: The event of handler
+        summary: The fields to describe the event, e.g. the number of records
+    """
+    if target.isEnabledFor(logging.DEBUG):
+        log(target, logging.DEBUG, 'Received event', event=event, **summary)
+    else:
+        log(target, logging.INFO, 'Received event', **summary)
+
+
+class Sampler:
+    """
+    Sampling profiler of the threads of container, the stack of each thread is sampled every
+    `interval` seconds by a daemon thread and counted by its frames (`file:function:line`, the
+    outermost first).
+
+    Example:
+    >>> sampler = Sampler(0.01).start()
+    >>> run()
+    >>> sampler.stop().top(10)
+    """
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        """ Seconds between two samples """
+        self.stacks = Counter()
+        """ Samples of each stack """
+        self.samples = 0
+        """ Total samples taken """
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> 'Sampler':
+        self._thread = threading.Thread(target=self._run, name='metrics-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> 'Sampler':
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def top(self, n: int = PROFILE_TOP_STACKS) -> List[Tuple[str, int]]:
+        """ The `n` most sampled stacks and their samples """
+        return self.stacks.most_common(n)
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                stack = traceback.extract_stack(frame)
+                self.stacks[';'.join('%s:%s:%d' % (os.path.basename(f.filename), f.name, f.lineno)
+                                     for f in stack)] += 1
+            self.samples += 1
+
+
+def _report_profile(handler: str, sampler: Sampler):
+    log(logger, logging.INFO, 'Profile of invocation', handler=handler, interval=sampler.interval,
+        samples=sampler.samples, stacks=[{'stack': stack, 'samples': n} for stack, n in sampler.top()])
+
+
+profile_hook = _report_profile  # type: Callable[[str, Sampler], None]
+""" Function called with the handler name and the sampler of a profiled invocation, logs the top stacks by default """
+
+
+def instrumented(handler: str):
+    """
+    Decorate a lambda handler to time it and its AWS calls, the timings are written to stdout in
+    CloudWatch Embedded Metric Format once at the end of each invocation.
+    A fraction `PROFILE_SAMPLE_RATE` of the invocations are profiled by a `Sampler` and reported
+    to `profile_hook`
+    Args:
+        handler: The handler name, the dimension of metrics
+    """
+    def decorate(func: Callable):
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(event, context):
+            recorder.reset()
+            sampler = Sampler().start() if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE else None
+
+            try:
+                with phase('Handler'):
+                    return func(event, context)
+            finally:
+                if sampler is not None:
+                    # noinspection PyBroadException
+                    try:
+                        profile_hook(handler, sampler.stop())
+                    except Exception as err:
+                        logger.warning('Profile report with error - %s' % err)
+
+                sys.stdout.write(json.dumps(recorder.as_emf(handler), separators=(',', ':')) + '\n')
+                sys.stdout.flush()
+
+        return wrapper
+
+    return decorate
+
+
+if boto3.DEFAULT_SESSION is None:
+    boto3.setup_default_session()
+instrument(boto3.DEFAULT_SESSION)  # the clients created by `boto3.client` and `boto3.resource`
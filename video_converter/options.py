@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from cache import TTLCache
+
+OPTIONS_TTL = float(os.environ.get('OPTIONS_TTL', 300))  # Seconds before the loaded options are reloaded
+OPTIONS_NEGATIVE_TTL = float(os.environ.get('OPTIONS_NEGATIVE_TTL', 30))  # Seconds before a missing key is rechecked
+
+_MISSING = object()
+
+
+class OptionStore:
+    """
+    Options of VideoConverter, refer to the table `'video-converter-options'` in DynamoDB.
+    The whole table is loaded with one paginated scan and reloaded after `ttl` seconds.
+    A key not in table is rechecked with `get_item` after `negative_ttl` seconds, so a new
+    option is seen by a warm container without waiting for the next reload.
+
+    Example:
+    >>> store = OptionStore('video-converter-options', lambda: boto3.resource('dynamodb'))
+    >>> store.bucket_option('my-bucket', 'OutputBucket')
+    'my-output-bucket'
+    """
+    def __init__(self, table_name: str, resource: Callable[[], Any],
+                 ttl: float = OPTIONS_TTL, negative_ttl: float = OPTIONS_NEGATIVE_TTL):
+        self.table_name = table_name
+        """ Name of the options table """
+        self.ttl = ttl
+        """ Seconds before the loaded options are reloaded """
+        self.negative_ttl = negative_ttl
+        """ Seconds before a missing key is rechecked """
+        self._resource = resource
+        self._values = dict()
+        self._missing = TTLCache(negative_ttl, maxsize=1024)
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Get the value of option
+        Args:
+            key: The key of option
+            default: The value returned if the option not exists
+        Returns:
+            The value of option
+        """
+        self._ensure_loaded()
+
+        value = self._values.get(key, _MISSING)
+        if value is not _MISSING:
+            return default if value is None else value
+
+        # the snapshot is fresh enough to tell the key not exists
+        if time.monotonic() - self._loaded_at < self.negative_ttl:
+            return default
+        if self._missing.get(key, default=_MISSING) is not _MISSING:
+            return default
+
+        item = self._resource().Table(self.table_name).get_item(Key={'S_Key': key})
+        value = item.get('Item', dict()).get('S_Value', None)
+        if value is None:
+            self._missing.set(key, True)
+            return default
+
+        self._values[key] = value
+        return value
+
+    def get_int(self, key: str, default: int = None) -> int:
+        """
+        Get the value of option as int
+        Args:
+            key: The key of option
+            default: The value returned if the option not exists
+        Returns:
+            The value of option
+        """
+        value = self.get(key, None)
+        return default if value is None else int(value)
+
+    def job_role(self) -> str:
+        """ The IAM role used to create MediaConvert job, refer to option `MediaConvertJobRole` """
+        return self.get('MediaConvertJobRole')
+
+    def bucket_option(self, bucket: str, name: str, default: Any = None) -> Any:
+        """
+        Get the option of bucket, if the bucket not has the option then the default one is used
+        Args:
+            bucket: Bucket name where the source in
+            name: Name of option, for example: `JobTemplate` refers to `<bucket>-JobTemplate`
+            default: The value returned if neither `<bucket>-<name>` nor `default-<name>` exists
+        Returns:
+            The value of option
+        """
+        value = self.get('%s-%s' % (bucket, name))
+        if value is None:
+            value = self.get('default-%s' % name, default)
+
+        return value
+
+    def refresh(self):
+        """
+        Reload all options from table
+        """
+        values = dict()
+        params = {'ProjectionExpression': 'S_Key, S_Value'}
+        table = self._resource().Table(self.table_name)
+
+        while True:
+            resp = table.scan(**params)
+            for item in resp.get('Items', []):
+                values[item['S_Key']] = item.get('S_Value', None)
+
+            if 'LastEvaluatedKey' not in resp:
+                break
+            params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+        self._values = values
+        self._missing.invalidate()
+        self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl:
+                self.refresh()
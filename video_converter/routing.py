@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+from typing import List
+
+from mediainfo import MediaInfo, get_media_info
+from task import option_store
+
+logger = logging.getLogger(__name__)
+
+_conditions = {
+    'codecs': lambda facts, v: facts['codec'] in v,
+    'min_width': lambda facts, v: facts['width'] is not None and facts['width'] >= v,
+    'max_width': lambda facts, v: facts['width'] is not None and facts['width'] <= v,
+    'min_height': lambda facts, v: facts['height'] is not None and facts['height'] >= v,
+    'max_height': lambda facts, v: facts['height'] is not None and facts['height'] <= v,
+    'min_bitrate': lambda facts, v: facts['bitrate'] is not None and facts['bitrate'] >= v,
+    'max_bitrate': lambda facts, v: facts['bitrate'] is not None and facts['bitrate'] <= v,
+    'min_duration': lambda facts, v: facts['duration'] is not None and facts['duration'] >= v,
+    'max_duration': lambda facts, v: facts['duration'] is not None and facts['duration'] <= v,
+}  # conditions of rule by name, all conditions of a rule MUST be met
+
+
+class Route:
+    """
+    Routing decision of a source, recorded on its task item as `S_Routing`
+    """
+    def __init__(self, template_name: str, skip: bool = False, rule: str = None, facts: dict = None,
+                 reason: str = None):
+        self.template_name = template_name
+        """ The template name used to create MediaConvert job """
+        self.skip = skip
+        """ Whether the source already matches the output profile and no job is created """
+        self.rule = rule
+        """ Name of the matched rule, `None` if no rule matched """
+        self.facts = facts
+        """ The media facts of source used to match the rules, `None` if the source failed to probe """
+        self.reason = reason
+        """ Why the default template is used if the rules are not evaluated """
+
+    def as_json(self) -> str:
+        """ A JSON string of route """
+        return json.dumps({
+            'template': self.template_name,
+            'skip': self.skip,
+            'rule': self.rule,
+            'facts': self.facts,
+            'reason': self.reason,
+        }, separators=(',', ':'))
+
+
+class Router:
+    """
+    Router of the sources in a bucket, picks the template of each source by a rule table.
+    The rule table is a JSON list in option `<bucket>-RoutingRules` (or `default-RoutingRules`),
+    the rules are evaluated in order and the first one whose conditions are all met wins.
+    A rule has a `name`, the `when` conditions and either a `template` or `skip: true` which means
+    the source already matches the output profile. The default template is used if no rule matched
+    or the source failed to probe.
+
+    Conditions: `codecs` (list of video formats, e.g. `["AVC", "HEVC"]`), `min_/max_width`,
+    `min_/max_height`, `min_/max_bitrate` (bit/s) and `min_/max_duration` (seconds).
+
+    Example:
+    >>> router = get_router('bucket', 'template')
+    >>> router('sub-dir/demo.mp4').as_json()
+    '{"template":"template-720p","skip":false,"rule":"hd","facts":{...},"reason":null}'
+    """
+    def __init__(self, bucket: str, template_name: str, rules: List[dict]):
+        self.bucket = bucket
+        """ Bucket name where the sources in """
+        self.template_name = template_name
+        """ The default template name """
+        self.rules = rules
+        """ The rule table """
+
+        for rule in rules:
+            unknown = set(rule.get('when', dict()).keys()) - set(_conditions.keys())
+            if len(unknown) > 0:
+                raise ValueError('Routing rule %s has unknown conditions %s' % (rule.get('name', None), unknown))
+
+    def __call__(self, key: str, etag: str = None, size: int = None) -> Route:
+        """
+        Route a source, the ETag and size are looked up by a HeadObject if either is `None`
+        Args:
+            key: Key of the source in bucket
+            etag: ETag of the source, e.g. from the object listing
+            size: Size of the source in bytes, e.g. from the object listing
+        Returns:
+            The routing decision
+        """
+        # noinspection PyBroadException
+        try:
+            facts = get_media_facts(get_media_info(self.bucket, key, etag, ranged=True, size=size))
+        except Exception as err:
+            logger.warning('Routing of s3://%s/%s uses the default template - %s' % (self.bucket, key, err))
+            return Route(self.template_name, reason='probe failed')
+
+        return self.route(facts)
+
+    def route(self, facts: dict) -> Route:
+        """
+        Pick the template by the media facts
+        Args:
+            facts: The media facts, refer to `get_media_facts`
+        Returns:
+            The routing decision
+        """
+        for rule in self.rules:
+            if all(_conditions[name](facts, value) for name, value in rule.get('when', dict()).items()):
+                if rule.get('skip', False):
+                    return Route(None, True, rule.get('name', None), facts)
+
+                return Route(rule.get('template', self.template_name), False, rule.get('name', None), facts)
+
+        return Route(self.template_name, facts=facts, reason='no rule matched')
+
+
+def get_router(bucket: str, template_name: str) -> Router:
+    """
+    Get the router of bucket
+    Args:
+        bucket: Bucket name where the sources in
+        template_name: The default template name
+    Returns:
+        The router, `None` if the bucket has no routing rules
+    """
+    rules = option_store.bucket_option(bucket, 'RoutingRules')
+    if not rules:
+        return None
+
+    return Router(bucket, template_name, json.loads(rules) if isinstance(rules, str) else rules)
+
+
+def get_media_facts(mi: MediaInfo) -> dict:
+    """
+    Get the facts of media to match the routing rules
+    Args:
+        mi: Media info of the source
+    Returns:
+        The codec, width, height, bitrate of the first video track and the duration of media
+    """
+    general = mi.general_tracks[0] if len(mi.general_tracks) > 0 else None
+    video = mi.video_tracks[0] if len(mi.video_tracks) > 0 else None
+
+    bitrate = video.bitrate if video is not None else None
+    if bitrate is None and general is not None:
+        bitrate = general.overallbitrate
+
+    return {
+        'codec': video.format if video is not None else None,
+        'width': _number(video.width) if video is not None else None,
+        'height': _number(video.height) if video is not None else None,
+        'bitrate': _number(bitrate),
+        'duration': _number(general.duration) if general is not None else None,
+    }
+
+
+def _number(value) -> any:
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
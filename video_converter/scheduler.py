@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import math
+import threading
+import time
+
+from mediainfo import get_media_info
+from task import option_store, get_converter
+
+QUEUE_REFRESH = 10  # The number of seconds that the outstanding jobs of a queue loaded are valid
+MIN_PRIORITY = -50  # The min job priority of MediaConvert
+MAX_PRIORITY = 50  # The max job priority of MediaConvert
+
+logger = logging.getLogger(__name__)
+
+
+class Assignment:
+    """
+    Queue and priority assigned to the job of a source, recorded on its task item
+    """
+    def __init__(self, queue: str, priority: int, duration: float = None, size: int = None):
+        self.queue = queue
+        """ ARN or name of the MediaConvert queue, `None` to use the queue of job template """
+        self.priority = priority
+        """ Priority of the job in queue, from -50 to 50 """
+        self.duration = duration
+        """ Duration of the source in seconds, `None` if not probed """
+        self.size = size
+        """ Size of the source in bytes, `None` if unknown """
+
+
+class Scheduler:
+    """
+    Scheduler of the jobs of sources in a bucket by the policy in option `<bucket>-SchedulerPolicy`
+    (or `default-SchedulerPolicy`), a JSON object like:
+
+        {
+          "reserved": ["arn:aws:mediaconvert:...:queues/Reserved"],
+          "on_demand": "arn:aws:mediaconvert:...:queues/Default",
+          "max_outstanding": 10,
+          "order": "shortest-first",
+          "classes": [{"max_duration": 60, "priority": 40}, {"min_size": 10737418240, "priority": -40}]
+        }
+
+    The job goes to the reserved queue with the least outstanding (submitted and progressing) jobs
+    while it has less than `max_outstanding`, and overflows to the `on_demand` queue (or the queue
+    of job template if not set) when all reserved queues are full.
+    The priority is the one of the first matched class (conditions `min_/max_duration` in seconds and
+    `min_/max_size` in bytes), or by the `order` if no class matched: `shortest-first` gives a
+    shorter source a higher priority, `fifo` (default) gives 0.
+    The duration is probed by mediainfo only if the policy needs it.
+    The outstanding jobs of a queue are loaded by `get_queue` every `QUEUE_REFRESH` seconds and
+    counted with the jobs assigned since then, a job not created is counted out by `release`.
+    The scheduler is thread safe.
+
+    Example:
+    >>> scheduler = get_scheduler('bucket')
+    >>> assignment = scheduler('sub-dir/demo.mp4', etag, size)
+    """
+    def __init__(self, bucket: str, policy: dict):
+        self.bucket = bucket
+        """ Bucket name where the sources in """
+        self.reserved = list(policy.get('reserved', []))
+        """ The reserved queues """
+        self.on_demand = policy.get('on_demand', None)
+        """ The on-demand queue which the jobs overflow to """
+        self.max_outstanding = int(policy.get('max_outstanding', 10))
+        """ The max outstanding jobs of a reserved queue """
+        self.order = policy.get('order', 'fifo')
+        """ The order of jobs without a matched class, `shortest-first` or `fifo` """
+        self.classes = list(policy.get('classes', []))
+        """ The priority classes """
+        self._outstanding = dict()  # outstanding jobs and the time loaded of each queue
+        self._lock = threading.Lock()
+
+        if self.order not in ('shortest-first', 'fifo'):
+            raise ValueError('Scheduler order %s is not supported' % self.order)
+
+    @property
+    def needs_duration(self) -> bool:
+        """ Whether the duration of source is needed by the policy """
+        return self.order == 'shortest-first' or any(
+            'min_duration' in c or 'max_duration' in c for c in self.classes
+        )
+
+    def __call__(self, key: str, etag: str = None, size: int = None) -> Assignment:
+        """
+        Assign the queue and priority to the job of a source
+        Args:
+            key: Key of the source in bucket
+            etag: ETag of the source, looked up if `None`
+            size: Size of the source in bytes, `None` if unknown
+        Returns:
+            The assignment
+        """
+        duration = None
+        if self.needs_duration:
+            # noinspection PyBroadException
+            try:
+                general = get_media_info(self.bucket, key, etag, ranged=True, size=size).general_tracks
+                duration = general[0].duration if len(general) > 0 else None
+            except Exception as err:
+                logger.warning('Scheduler of s3://%s/%s probe with error - %s' % (self.bucket, key, err))
+
+        if not isinstance(duration, (int, float)):
+            duration = None
+
+        return Assignment(self.assign_queue(), self.priority(duration, size), duration, size)
+
+    def priority(self, duration: float = None, size: int = None) -> int:
+        """
+        Get the priority of job by the duration and size of source
+        Args:
+            duration: Duration of the source in seconds, `None` if unknown
+            size: Size of the source in bytes, `None` if unknown
+        Returns:
+            The priority from -50 to 50
+        """
+        facts = {'duration': duration, 'size': size}
+        for c in self.classes:
+            if all(_matches(facts, name, value) for name, value in c.items() if name != 'priority'):
+                return max(MIN_PRIORITY, min(MAX_PRIORITY, int(c.get('priority', 0))))
+
+        if self.order == 'shortest-first' and duration is not None:
+            # 1 minute is 41, 10 minutes is 19, 1 hour is -4 and 4 hours is -21
+            return max(MIN_PRIORITY, min(MAX_PRIORITY, int(round(50 - 30 * math.log10(1 + duration / 60)))))
+
+        return 0
+
+    def assign_queue(self) -> str:
+        """
+        Pick the reserved queue with the least outstanding jobs if it is not full, or the on-demand one
+        Returns:
+            The queue, `None` to use the queue of job template
+        """
+        now = time.monotonic()
+        with self._lock:
+            stale = [queue for queue in self.reserved if self._is_stale(queue, now)]
+
+        # load the queues out of the lock, not to block the assignments of the other jobs
+        loaded = {queue: self._load_outstanding(queue) for queue in stale}
+
+        with self._lock:
+            for queue, outstanding in loaded.items():
+                if self._is_stale(queue, now):  # not refreshed by another thread meanwhile
+                    self._outstanding[queue] = (outstanding, now)
+
+            candidates = [(self._outstanding.get(queue, (0, None))[0], queue) for queue in self.reserved]
+            candidates = [c for c in candidates if c[0] < self.max_outstanding]
+            if len(candidates) == 0:
+                return self.on_demand
+
+            outstanding, queue = min(candidates)
+            self._outstanding[queue] = (outstanding + 1, self._outstanding[queue][1])
+            return queue
+
+    def release(self, queue: str):
+        """
+        Count out a job assigned to the queue which is not created, e.g. deferred or failed to create
+        Args:
+            queue: The queue assigned to the job
+        """
+        with self._lock:
+            if queue in self._outstanding:
+                outstanding, loaded_at = self._outstanding[queue]
+                self._outstanding[queue] = (max(outstanding - 1, 0), loaded_at)
+
+    def stats(self) -> dict:
+        """ The outstanding jobs of each reserved queue known by the scheduler """
+        with self._lock:
+            return {queue: outstanding for queue, (outstanding, _) in self._outstanding.items()}
+
+    def _is_stale(self, queue: str, now: float) -> bool:
+        _, loaded_at = self._outstanding.get(queue, (0, None))
+        return loaded_at is None or now - loaded_at > QUEUE_REFRESH
+
+    def _load_outstanding(self, queue: str) -> int:
+        # noinspection PyBroadException
+        try:
+            resp = get_converter().get_queue(Name=queue.rsplit('/', 1)[-1])['Queue']
+            return resp.get('SubmittedJobsCount', 0) + resp.get('ProgressingJobsCount', 0)
+        except Exception as err:
+            logger.warning('Queue(%s) outstanding jobs load with error - %s' % (queue, err))
+            return self._outstanding.get(queue, (0, None))[0]
+
+
+_schedulers = dict()  # schedulers by bucket and policy, to keep the outstanding jobs across invocations
+
+
+def get_scheduler(bucket: str) -> Scheduler:
+    """
+    Get the scheduler of bucket
+    Args:
+        bucket: Bucket name where the sources in
+    Returns:
+        The scheduler, `None` if the bucket has no scheduler policy
+    """
+    policy = option_store.bucket_option(bucket, 'SchedulerPolicy')
+    if not policy:
+        return None
+
+    policy = json.loads(policy) if isinstance(policy, str) else policy
+    key = (bucket, json.dumps(policy, sort_keys=True))
+    if key not in _schedulers:
+        _schedulers[key] = Scheduler(bucket, policy)
+
+    return _schedulers[key]
+
+
+def _matches(facts: dict, name: str, value) -> bool:
+    bound, _, fact = name.partition('_')
+    if fact not in facts or bound not in ('min', 'max'):
+        raise ValueError('Scheduler class condition %s is not supported' % name)
+
+    if facts[fact] is None:
+        return False
+
+    return facts[fact] >= value if bound == 'min' else facts[fact] <= value
@@ -1,21 +1,155 @@
 # -*- coding: utf-8 -*-
 
 import boto3
+import hashlib
 import json
+import logging
+import os
+import random
+import threading
+import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from admission import AdmissionController, JobDeferred
+from cache import TTLCache
+from dedupe import SourceSet
+from job_spec import JobSpecBuilder
+from metrics import instrument
+from options import OptionStore
 
 import urllib3
 urllib3.disable_warnings()  # disable InsecureRequestWarning
 
+logger = logging.getLogger(__name__)
+
 task_table_name = 'video-converter-tasks'
 taskitem_table_name = 'video-converter-task-items'
 options_table_name = 'video-converter-options'
 
-mc_client = boto3.client('mediaconvert')
-mc_endpoints = mc_client.describe_endpoints()
-converter = boto3.client('mediaconvert', endpoint_url=mc_endpoints['Endpoints'][0]['Url'], verify=False)
-db = boto3.resource('dynamodb')
+DEFAULT_JOB_CONCURRENCY = 8  # The number of jobs submitted concurrently by default
+BATCH_WRITE_SIZE = 25  # The max number of items in one BatchWriteItem request
+BATCH_RETRIES = 8  # The max times to retry the unprocessed requests of BatchWriteItem and BatchGetItem
+BATCH_GET_SIZE = 100  # The max number of keys in one BatchGetItem request
+BATCH_WRITE_DELAY = 2  # The max seconds a task item is buffered before a chunk not full is written
+TRANSACT_SIZE = 100  # The max number of actions in one TransactWriteItems request
+TASK_COUNTER_SHARDS = int(os.environ.get('TASK_COUNTER_SHARDS', 0))  # Shards of task counters, 0 means no shard
+TEMPLATE_CACHE_TTL = 300  # The number of seconds that a cached job template is valid
+TEMPLATE_CACHE_SIZE = 64  # The max number of job templates (and destinations) in cache
+CREATE_RETRIES = 3  # The max times to retry a throttled job create before the job is deferred
+THROUGHPUT_WINDOW = 300  # The number of seconds of the window to measure the progress throughput of task
+
+_local = threading.local()  # boto3 resources are not thread safe, keep one per thread
+_window_starts = dict()  # start of the throughput window of the task (or shard) items last known, by key
+_converter = None  # MediaConvert client, created on first use
+_converter_lock = threading.Lock()
+
+
+def _get_session() -> boto3.session.Session:
+    """
+    Get the boto3 session of current thread, the session is created on first use and the calls of
+    its clients and resources are timed by `metrics`
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = instrument(boto3.session.Session())
+        _local.session = session
+
+    return session
+
+
+def get_db():
+    """
+    Get the DynamoDB resource of current thread, the resource is created on first use
+    """
+    resource = getattr(_local, 'db', None)
+    if resource is None:
+        resource = _get_session().resource('dynamodb')
+        _local.db = resource
+
+    return resource
+
+
+def get_s3():
+    """
+    Get the S3 client of current thread, the client is created on first use
+    """
+    client = getattr(_local, 's3', None)
+    if client is None:
+        client = _get_session().client('s3')
+        _local.s3 = client
+
+    return client
+
+
+def get_sqs():
+    """
+    Get the SQS client of current thread, the client is created on first use
+    """
+    client = getattr(_local, 'sqs', None)
+    if client is None:
+        client = _get_session().client('sqs')
+        _local.sqs = client
+
+    return client
+
+
+def get_converter():
+    """
+    Get the MediaConvert client with the account endpoint, the client is created on first use and
+    shared by all threads
+    """
+    global _converter
+
+    if _converter is None:
+        with _converter_lock:
+            if _converter is None:
+                _converter = boto3.client('mediaconvert', endpoint_url=get_mediaconvert_endpoint(), verify=False)
+
+    return _converter
+
+
+def get_mediaconvert_endpoint() -> str:
+    """
+    Get the MediaConvert endpoint url of the account.
+    The url is looked up from the environment variable `MEDIACONVERT_ENDPOINT` and the option
+    `MediaConvertEndpoint` in order, if neither exists then the endpoint is discovered by
+    `describe_endpoints` and saved to the option for other containers
+    Returns:
+        The endpoint url
+    """
+    endpoint = os.environ.get('MEDIACONVERT_ENDPOINT', None)
+    if endpoint:
+        return endpoint
+
+    endpoint = option_store.get('MediaConvertEndpoint')
+    if endpoint:
+        return endpoint
+
+    endpoint = boto3.client('mediaconvert').describe_endpoints()['Endpoints'][0]['Url']
+    get_db().Table(options_table_name).put_item(
+        Item={'S_Key': 'MediaConvertEndpoint', 'S_Value': endpoint},
+        ReturnValues='NONE'
+    )
+
+    return endpoint
+
+
+option_store = OptionStore(options_table_name, get_db)  # global option store
+job_spec_builder = JobSpecBuilder(option_store)  # global builder of job params
+admission_controller = AdmissionController(option_store, lambda taskid: _get_task_running(taskid))  # global
+
+
+class BatchUnprocessed(RuntimeError):
+    """ Requests of a batch operation are still unprocessed after retries """
+    def __init__(self, message: str, requests: list):
+        super().__init__(message)
+        self.requests = requests
+        """ The unprocessed requests, e.g. the `PutRequest` of BatchWriteItem or the keys of BatchGetItem """
 
 
 class Task:
@@ -51,6 +185,39 @@ class Task:
         """ Total running jobs related to this task """
         self.error = 0
         """ Total error jobs related to this task """
+        self.continuation_token = None
+        """ Continuation token to list the remaining objects in bucket, `None` if not started or finished """
+        self.submitted = 0
+        """ Total jobs submitted by the finished listing slices of this task """
+        self.shards = 0
+        """ Number of the counter shards of this task, 0 means the counters are not sharded """
+        self.fingerprint = None
+        """ Fingerprint of the bucket, key, filter and template of this task, refer to `get_task_fingerprint` """
+        self.listed_at = None
+        """ Datetime in string that all objects in bucket are listed, `None` if not listed yet """
+        self.deferred = 0
+        """ Total jobs deferred by the admission control and not submitted yet """
+        self.progress_sum = 0
+        """ Sum of the progress of all jobs, a finished or error job counts as 100 """
+        self.completed_duration = 0
+        """ Total seconds from created to finished of the completed jobs """
+        self.throughput = 0.0
+        """ Progress per second of all jobs in the recent `THROUGHPUT_WINDOW` seconds when the task is loaded """
+
+    @property
+    def percent_complete(self) -> float:
+        """ Percent of the progress of all jobs, from 0 to 100 """
+        total = max(self.total, self.submitted)
+        return min(float(self.progress_sum) / total, 100.0) if total > 0 else 0.0
+
+    @property
+    def eta(self) -> float:
+        """ Estimated seconds to finish all jobs by the throughput, `None` if no progress in the window """
+        remaining = max(self.total, self.submitted) * 100 - float(self.progress_sum)
+        if remaining <= 0:
+            return 0.0
+
+        return remaining / self.throughput if self.throughput > 0 else None
 
     def as_dict(self) -> dict:
         """ A dict of task """
@@ -65,6 +232,14 @@ class Task:
             'N_Finished': self.finished,
             'N_Running': self.running,
             'N_Error': self.error,
+            'S_ContinuationToken': self.continuation_token,
+            'N_Submitted': self.submitted,
+            'N_Shards': self.shards,
+            'S_Fingerprint': self.fingerprint,
+            'S_ListedAt': self.listed_at,
+            'N_Deferred': self.deferred,
+            'N_ProgressSum': self.progress_sum,
+            'N_CompletedDuration': self.completed_duration,
         }
 
     @classmethod
@@ -82,6 +257,15 @@ class Task:
         task.finished = item.get('N_Finished', 0)
         task.running = item.get('N_Running', 0)
         task.error = item.get('N_Error', 0)
+        task.continuation_token = item.get('S_ContinuationToken', None)
+        task.submitted = item.get('N_Submitted', 0)
+        task.shards = item.get('N_Shards', 0)
+        task.fingerprint = item.get('S_Fingerprint', None)
+        task.listed_at = item.get('S_ListedAt', None)
+        task.deferred = item.get('N_Deferred', 0)
+        task.progress_sum = item.get('N_ProgressSum', 0)
+        task.completed_duration = item.get('N_CompletedDuration', 0)
+        task.throughput = _get_throughput(item, time.time())
 
         return task
 
@@ -96,6 +280,10 @@ class TaskItem:
         """ Item Id """
         self.source = None
         """ Source of task item. For example: s3://bucket/sub-dir/example.mp4 """
+        self.source_bucket = None
+        """ Bucket name of the source """
+        self.target = None
+        """ Target of task item. For example: s3://output-bucket/sub-dir/example.mp4 """
         self.taskid = None
         """ Task Id of the item """
         self.status = None
@@ -107,20 +295,54 @@ class TaskItem:
         self.finished_at = None
         """ Datetime in string the item job finished at """
         self.error = None
+        self.routing = None
+        """ Routing decision of the item in JSON, refer to `routing.Route`, `None` if not routed """
+        self.template_name = None
+        """ Template name used to create the MediaConvert job of item """
+        self.etag = None
+        """ ETag of the source object without quotes, `None` if unknown """
+        self.size = None
+        """ Size of the source object, `None` if unknown """
+        self.outputs = None
+        """
+        Output files of the item in JSON, a list of the output groups in `{"type": <type>, "paths": [<url>]}`
+        with the playlists and the output files recorded on the job completed, `None` if not completed
+        """
+        self.copied_from = None
+        """ Id of the task item which outputs are copied by the content dedupe, `None` if a job is created """
+        self.queue = None
+        """ The MediaConvert queue assigned by the scheduler, `None` if the queue of job template is used """
+        self.priority = None
+        """ The job priority assigned by the scheduler, `None` if not scheduled """
 
     def as_dict(self):
         """ A dict of task item """
-        return {
+        item = {
             'S_ItemId': self.itemid,
             'S_Source': self.source,
+            'S_SourceBucket': self.source_bucket,
+            'S_Target': self.target,
             'S_TaskId': self.taskid,
             'S_Status': self.status,
             'S_CreatedAt': self.created_at,
             'S_FinishedAt': self.finished_at,
             'N_Progress': self.progress,
             'S_Error': self.error,
+            'S_Routing': self.routing,
+            'S_TemplateName': self.template_name,
+            'S_Outputs': self.outputs,
+            'S_CopiedFrom': self.copied_from,
+            'S_Queue': self.queue,
+            'N_Priority': self.priority,
         }
 
+        # the keys of ContentIndex are saved only if the content is known
+        if self.etag is not None and self.size is not None:
+            item['S_ETag'] = self.etag
+            item['N_Size'] = self.size
+
+        return item
+
     @classmethod
     def from_item(cls, item: dict):
         """ Create a task item instance from dict """
@@ -128,12 +350,22 @@ class TaskItem:
 
         task.itemid = item['S_ItemId']
         task.source = item['S_Source']
+        task.source_bucket = item.get('S_SourceBucket', None)
+        task.target = item.get('S_Target', None)
         task.taskid = item['S_TaskId']
         task.status = item.get('S_Status', None)
         task.progress = item.get('N_Progress', 0)
         task.created_at = item.get('S_CreatedAt', None)
         task.finished_at = item.get('S_FinishedAt', None)
         task.error = item.get('S_Error', None)
+        task.routing = item.get('S_Routing', None)
+        task.template_name = item.get('S_TemplateName', None)
+        task.etag = item.get('S_ETag', None)
+        task.size = item.get('N_Size', None)
+        task.outputs = item.get('S_Outputs', None)
+        task.copied_from = item.get('S_CopiedFrom', None)
+        task.queue = item.get('S_Queue', None)
+        task.priority = item.get('N_Priority', None)
 
         return task
 
@@ -146,9 +378,20 @@ def get_task(taskid: str) -> Task:
     Returns:
         The task object, if id not exists in DynamoDB then return `None`
     """
-    resp = db.Table(taskitem_table_name).get_item(Key={'S_TaskId': taskid})
+    resp = get_db().Table(task_table_name).get_item(Key={'S_TaskId': taskid})
     task = Task.from_item(resp['Item']) if resp.get('Item', None) is not None else None
 
+    shards = max(task.shards, TASK_COUNTER_SHARDS) if task is not None else 0
+    if shards > 0:
+        keys = [{'S_TaskId': _get_shard_id(taskid, shard)} for shard in range(shards)]
+        for item in batch_get_items(task_table_name, keys):
+            task.running += item.get('N_Running', 0)
+            task.finished += item.get('N_Finished', 0)
+            task.error += item.get('N_Error', 0)
+            task.progress_sum += item.get('N_ProgressSum', 0)
+            task.completed_duration += item.get('N_CompletedDuration', 0)
+            task.throughput += _get_throughput(item, time.time())
+
     return task
 
 
@@ -170,8 +413,10 @@ def create_task(taskid: str, bucket: str, key: str = None, condition: str = None
     task.key = key
     task.filter = condition
     task.template_name = template
+    task.shards = TASK_COUNTER_SHARDS
+    task.fingerprint = get_task_fingerprint(bucket, key, condition, template)
 
-    db.Table(task_table_name).put_item(
+    get_db().Table(task_table_name).put_item(
         Item=task.as_dict(),
         ReturnValues='NONE'
     )
@@ -179,6 +424,91 @@ def create_task(taskid: str, bucket: str, key: str = None, condition: str = None
     return task
 
 
+def get_task_items(itemids: Iterable[str]) -> dict:
+    """
+    Get task items by itemids with `BatchGetItem`
+    Args:
+        itemids: The ids of Task item
+    Returns:
+        The task item objects keyed by itemid, the ids not exist in DynamoDB are not included
+    """
+    keys = [{'S_ItemId': itemid} for itemid in dict.fromkeys(itemids)]
+    items = [TaskItem.from_item(item) for item in batch_get_items(taskitem_table_name, keys)]
+
+    return {item.itemid: item for item in items}
+
+
+def batch_get_items(table_name: str, keys: list) -> list:
+    """
+    Get items by keys with `BatchGetItem` in chunks, the unprocessed keys are retried
+    Args:
+        table_name: The name of table
+        keys: The keys of items, MUST be unique
+    Returns:
+        The items exist in DynamoDB
+    """
+    items = []
+
+    def send(chunk: list) -> list:
+        resp = get_db().batch_get_item(RequestItems={table_name: {'Keys': chunk}})
+        items.extend(resp.get('Responses', dict()).get(table_name, []))
+        return resp.get('UnprocessedKeys', dict()).get(table_name, dict()).get('Keys', [])
+
+    _batch_send(send, keys, BATCH_GET_SIZE, 'BatchGetItem')
+    return items
+
+
+def batch_write_items(table_name: str, requests: list):
+    """
+    Write items with `BatchWriteItem` in chunks, the unprocessed requests are retried
+    Args:
+        table_name: The name of table
+        requests: The `PutRequest` and `DeleteRequest` of items
+    Raises:
+        BatchUnprocessed: If any requests are still unprocessed after retries
+    """
+    _batch_send(lambda chunk: get_db().batch_write_item(
+        RequestItems={table_name: chunk}
+    ).get('UnprocessedItems', dict()).get(table_name, []), requests, BATCH_WRITE_SIZE, 'BatchWriteItem')
+
+
+def _batch_send(send: Callable[[list], list], requests: list, size: int, operation: str):
+    """
+    Send the requests of a batch operation in chunks, the unprocessed requests of each chunk are sent
+    again with exponential backoff up to `BATCH_RETRIES` times
+    Args:
+        send: The function to send a chunk, returns the unprocessed requests of it
+        requests: The requests to send
+        size: The max number of requests in a chunk
+        operation: Name of the batch operation
+    Raises:
+        BatchUnprocessed: If any requests are still unprocessed after retries, it is raised after all
+            chunks are sent. If a request fails, it is raised at once with the requests not sent yet
+    """
+    unprocessed = []
+
+    for i in range(0, len(requests), size):
+        chunk = requests[i:i + size]
+        for retry in range(BATCH_RETRIES + 1):
+            if retry > 0:
+                time.sleep(min(0.05 * 2 ** (retry - 1), 2))
+
+            try:
+                chunk = send(chunk)
+            except Exception as err:
+                raise BatchUnprocessed('%s failed - %s' % (operation, err),
+                                       unprocessed + chunk + requests[i + size:]) from err
+
+            if len(chunk) == 0:
+                break
+
+        unprocessed.extend(chunk)
+
+    if len(unprocessed) > 0:
+        raise BatchUnprocessed('%d requests of %s are unprocessed after %d retries'
+                               % (len(unprocessed), operation, BATCH_RETRIES), unprocessed)
+
+
 def get_task_item(itemid: str) -> TaskItem:
     """
     Get task by itemid
@@ -187,7 +517,7 @@ def get_task_item(itemid: str) -> TaskItem:
     Returns:
         The task item object, if id not exists in DynamoDB then return `None`
     """
-    resp = db.Table(taskitem_table_name).get_item(Key={'S_ItemId': itemid})
+    resp = get_db().Table(taskitem_table_name).get_item(Key={'S_ItemId': itemid})
     item = TaskItem.from_item(resp['Item']) if resp.get('Item', None) is not None else None
 
     return item
@@ -200,7 +530,7 @@ def set_task_total(taskid: str, total: int):
         taskid: The id of Task
         total: The total number
     """
-    db.Table(task_table_name).update_item(
+    get_db().Table(task_table_name).update_item(
         Key={'S_TaskId': taskid},
         UpdateExpression='SET N_Total = :total, S_ExecutedAt = :at',
         ExpressionAttributeValues={
@@ -211,67 +541,336 @@ def set_task_total(taskid: str, total: int):
     )
 
 
-def increase_task_running_counter(taskid: str):
+def save_task_checkpoint(taskid: str, token: str, submitted: int, deferred: int = 0, listed: bool = False):
     """
-    Increase the running job counter of the Task
+    Save the listing checkpoint of the task after a slice of objects is submitted
     Args:
         taskid: The id of Task
+        token: The continuation token to list the remaining objects, `None` if all objects are listed
+        submitted: The number of jobs submitted by the slice
+        deferred: The change of the number of jobs deferred by the slice
+        listed: Whether all objects are listed, the datetime is saved as `S_ListedAt` if so
     """
-    db.Table(task_table_name).update_item(
+    expression = 'SET S_ContinuationToken = :token, N_Submitted = if_not_exists(N_Submitted, :zero) + :n, ' \
+                 'N_Deferred = if_not_exists(N_Deferred, :zero) + :deferred'
+    values = {
+        ':token': token,
+        ':zero': 0,
+        ':n': submitted,
+        ':deferred': deferred,
+    }
+
+    if listed:
+        expression += ', S_ListedAt = :at'
+        values[':at'] = datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
+
+    get_db().Table(task_table_name).update_item(
         Key={'S_TaskId': taskid},
-        UpdateExpression='SET N_Running = N_Running + :one',
-        ExpressionAttributeValues={':one': 1},
+        UpdateExpression=expression,
+        ExpressionAttributeValues=values,
         ReturnValues='NONE'
     )
 
 
-def increase_task_finished_counter(taskid: str):
+def _get_task_running(taskid: str) -> int:
+    task = get_task(taskid)
+    return task.running if task is not None else 0
+
+
+def increase_task_running_counter(taskid: str):
+    """
+    Increase the running job counter of the Task
+    Args:
+        taskid: The id of Task
+    """
+    increase_task_counters(taskid, {'N_Running': 1})
+
+
+def increase_task_finished_counter(taskid: str, progress: int = 0, duration: int = 0):
     """
     Increase the finished job counter of the Task
     Args:
         taskid: The id of Task
+        progress: The progress of the job not counted in `N_ProgressSum` yet
+        duration: The seconds from created to finished of the job
     """
-    db.Table(task_table_name).update_item(
-        Key={'S_TaskId': taskid},
-        UpdateExpression='SET N_Finished = N_Finished + :one, N_Running = N_Running - :one',
-        ExpressionAttributeValues={':one': 1},
-        ReturnValues='NONE'
-    )
+    increase_task_counters(taskid, {'N_Finished': 1, 'N_Running': -1, 'N_ProgressSum': progress,
+                                    'N_CompletedDuration': duration})
 
 
-def increase_task_error_counter(taskid: str):
+def increase_task_error_counter(taskid: str, progress: int = 0):
     """
     Increase the error job counter of the Task
     Args:
         taskid: The id of Task
+        progress: The progress of the job not counted in `N_ProgressSum` yet
     """
-    db.Table(task_table_name).update_item(
-        Key={'S_TaskId': taskid},
-        UpdateExpression='SET N_Error = N_Error + :one, N_Running = N_Running - :one',
-        ExpressionAttributeValues={':one': 1},
-        ReturnValues='NONE'
+    increase_task_counters(taskid, {'N_Error': 1, 'N_Running': -1, 'N_ProgressSum': progress})
+
+
+def increase_task_counters(taskid: str, counters: dict):
+    """
+    Increase several counters of the Task in one update.
+    If `TASK_COUNTER_SHARDS` is set, the update goes to a random shard item of the task instead of
+    the task item, so the writes of a large task are spread across partitions.
+    The increase of `N_ProgressSum` is also added to the throughput window of the item, the window
+    is rolled over once it is older than `THROUGHPUT_WINDOW` seconds
+    Args:
+        taskid: The id of Task
+        counters: The numbers to increase, keyed by the counter attribute name such as `N_Running`
+    """
+    counters = {k: v for k, v in counters.items() if v != 0}
+    if len(counters) == 0:
+        return
+
+    now = int(time.time())
+    update = _get_counter_update(taskid, counters, now)
+    resp = get_db().Table(task_table_name).update_item(
+        ReturnValues='UPDATED_NEW' if 'N_ProgressSum' in counters else 'NONE',
+        **update
     )
 
+    if 'N_ProgressSum' in counters:
+        key = update['Key']['S_TaskId']
+        _window_starts[key] = _roll_throughput_window(key, resp.get('Attributes', dict()), now)
+
+
+def _get_counter_update(taskid: str, counters: dict, now: int) -> dict:
+    """ The `update_item` params of the task (or a random shard) item to increase the counters """
+    key = taskid
+    if TASK_COUNTER_SHARDS > 0:
+        key = _get_shard_id(taskid, random.randrange(TASK_COUNTER_SHARDS))
+
+    expression = 'SET ' + ', '.join('%s = if_not_exists(%s, :zero) + :%s' % (k, k, k) for k in counters)
+    values = {':%s' % k: v for k, v in counters.items()}
+    values[':zero'] = 0
+
+    if 'N_ProgressSum' in counters:
+        expression += ', N_WindowProgress = if_not_exists(N_WindowProgress, :zero) + :N_ProgressSum, ' \
+                      'N_WindowStart = if_not_exists(N_WindowStart, :now)'
+        values[':now'] = now
+
+    return {'Key': {'S_TaskId': key}, 'UpdateExpression': expression, 'ExpressionAttributeValues': values}
+
+
+def _get_shard_id(taskid: str, shard: int) -> str:
+    return '%s#%d' % (taskid, shard)
+
+
+def _roll_throughput_window(key: str, attributes: dict, now: int) -> int:
+    """
+    Start a new throughput window of the task (or shard) item if the current one is older than
+    `THROUGHPUT_WINDOW` seconds, the rate of the current one is saved as `N_LastRate`.
+    The progress added since the window is read is kept in the new one.
+    Returns the start of the window after it, `None` if unknown
+    """
+    start = attributes.get('N_WindowStart', None)
+    if start is None or now - start < THROUGHPUT_WINDOW:
+        return start
+
+    progress = attributes.get('N_WindowProgress', 0)
+    try:
+        get_db().Table(task_table_name).update_item(
+            Key={'S_TaskId': key},
+            UpdateExpression='SET N_WindowStart = :now, N_WindowProgress = N_WindowProgress - :progress, '
+                             'N_LastRate = :rate',
+            ConditionExpression='N_WindowStart = :start',
+            ExpressionAttributeValues={
+                ':now': now,
+                ':progress': progress,
+                ':rate': Decimal(str(round(float(progress) / (now - start), 4))),
+                ':start': start,
+            },
+            ReturnValues='NONE'
+        )
+    except get_db().meta.client.exceptions.ConditionalCheckFailedException:
+        return None  # rolled over by another update
+
+    return now
+
+
+def _check_throughput_window(key: str, now: int):
+    """
+    Roll the throughput window of the task (or shard) item after its progress is increased in a
+    transaction, which returns no attributes. The window is read only if its start is not known
+    or the known one is old enough to roll
+    """
+    start = _window_starts.get(key, None)
+    if start is not None and now - start < THROUGHPUT_WINDOW:
+        return
+
+    attributes = get_db().Table(task_table_name).get_item(
+        Key={'S_TaskId': key},
+        ProjectionExpression='N_WindowStart, N_WindowProgress',
+        ConsistentRead=True
+    ).get('Item', dict())
+    _window_starts[key] = _roll_throughput_window(key, attributes, now)
+
+
+def _get_throughput(item: dict, now: float) -> float:
+    """
+    Estimate the progress per second of the task (or shard) item in the recent `THROUGHPUT_WINDOW`
+    seconds, by the progress of the current window and the rate of the last one weighted by the
+    part of it still in the recent seconds
+    """
+    start = item.get('N_WindowStart', None)
+    if start is None:
+        return 0.0
+
+    elapsed = max(now - float(start), 1.0)
+    progress = float(item.get('N_WindowProgress', 0))
+    if elapsed >= THROUGHPUT_WINDOW:
+        return progress / elapsed
+
+    return (progress + float(item.get('N_LastRate', 0)) * (THROUGHPUT_WINDOW - elapsed)) / THROUGHPUT_WINDOW
+
+
+def get_settled_counters(old: dict, status: str) -> dict:
+    """
+    Get the task counters to increase when a job is finished or failed
+    Args:
+        old: The attributes of task item before the status is updated, e.g. `TaskItem.as_dict`
+        status: The status updated to, `COMPLETE` or `ERROR`
+    Returns:
+        The counters, the rest of the progress of job to 100 is added to `N_ProgressSum`, and the
+        duration of a completed job to `N_CompletedDuration`. Empty if the job was finished or failed
+        already, e.g. the event is delivered again
+    """
+    if old.get('S_Status', None) in ('COMPLETE', 'ERROR'):
+        return dict()
+
+    progress = old.get('N_Progress', 0)
+    if not isinstance(progress, (int, Decimal)) or progress < 0:
+        progress = 0
+
+    counters = {'N_Running': -1, 'N_ProgressSum': 100 - progress}
+    if status == 'COMPLETE':
+        counters['N_Finished'] = 1
+        counters['N_CompletedDuration'] = _get_duration(
+            old.get('S_CreatedAt', None), datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
+        )
+    else:
+        counters['N_Error'] = 1
+
+    return counters
+
+
+def _get_duration(created_at: str, finished_at: str) -> int:
+    if not created_at or not finished_at:
+        return 0
+
+    created = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S%z')
+    finished = datetime.strptime(finished_at, '%Y-%m-%d %H:%M:%S%z')
+    return max(int((finished - created).total_seconds()), 0)
+
+
+def verify_task_progress(taskid: str, fix: bool = False) -> dict:
+    """
+    Recompute the progress sum and completed duration of task from all its task items and compare
+    them with the ones maintained incrementally. The durations are compared in seconds, so each
+    completed job may differ by 1 second
+    Args:
+        taskid: The id of Task
+        fix: Whether to save the recomputed ones to the task if they are different
+    Returns:
+        The saved and recomputed numbers, and whether they are consistent
+    """
+    table = get_db().Table(taskitem_table_name)
+    params = {
+        'IndexName': 'TaskIndex',
+        'KeyConditionExpression': 'S_TaskId = :taskid',
+        'ProjectionExpression': 'S_Status, N_Progress, S_CreatedAt, S_FinishedAt',
+        'ExpressionAttributeValues': {':taskid': taskid},
+    }
+    progress_sum = 0
+    completed_duration = 0
+    completed = 0
+
+    while True:
+        resp = table.query(**params)
+        for item in resp.get('Items', []):
+            status = item.get('S_Status', None)
+            if status in ('SKIPPED', 'DEFERRED'):
+                continue  # no job is created for the item
+
+            if status in ('COMPLETE', 'ERROR'):
+                progress_sum += 100
+            elif isinstance(item.get('N_Progress', None), (int, Decimal)) and item['N_Progress'] > 0:
+                progress_sum += item['N_Progress']
+
+            if status == 'COMPLETE':
+                completed_duration += _get_duration(item.get('S_CreatedAt', None), item.get('S_FinishedAt', None))
+                completed += 1
+
+        if 'LastEvaluatedKey' not in resp:
+            break
+        params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    task = get_task(taskid)
+    if task is None:
+        raise ValueError('Task(%s) not exists' % taskid)
+
+    consistent = task.progress_sum == progress_sum and \
+        abs(task.completed_duration - completed_duration) <= completed
+    if fix and not consistent:
+        # the shard items are kept, the task item takes the difference
+        row = get_db().Table(task_table_name).get_item(Key={'S_TaskId': taskid})['Item']
+        get_db().Table(task_table_name).update_item(
+            Key={'S_TaskId': taskid},
+            UpdateExpression='SET N_ProgressSum = :progress, N_CompletedDuration = :duration',
+            ExpressionAttributeValues={
+                ':progress': progress_sum - (task.progress_sum - row.get('N_ProgressSum', 0)),
+                ':duration': completed_duration - (task.completed_duration - row.get('N_CompletedDuration', 0)),
+            },
+            ReturnValues='NONE'
+        )
+
+    return {
+        'progress_sum': {'saved': task.progress_sum, 'recomputed': progress_sum},
+        'completed_duration': {'saved': task.completed_duration, 'recomputed': completed_duration},
+        'consistent': consistent,
+    }
+
 
-def update_taskitem_status(itemid: str, status: str, error: str = None):
+def update_taskitem_status(itemid: str, status: str, error: str = None, progress: any = None,
+                           outputs: str = None) -> dict:
     """
     Update the task item status
     Args:
         itemid: The id of Task item
         status: The status to update to
         error: The error infomation if has
+        progress: The progress to update to in the same request if not `None`
+        outputs: The output files of job in JSON to save in the same request if not `None`, refer to
+            `TaskItem.outputs`
+    Returns:
+        The attributes of task item before the update, to find the delivered again status and the
+        progress not counted in task, refer to `get_settled_counters`
     """
-    db.Table(taskitem_table_name).update_item(
+    expression = 'SET S_Status = :status, S_FinishedAt = :at, S_Error = :error'
+    values = {
+        ':status': status,
+        ':at': datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z'),
+        ':error': error,
+    }
+
+    if progress is not None:
+        expression += ', N_Progress = :progress'
+        values[':progress'] = progress
+
+    if outputs is not None:
+        expression += ', S_Outputs = :outputs'
+        values[':outputs'] = outputs
+
+    resp = get_db().Table(taskitem_table_name).update_item(
         Key={'S_ItemId': itemid},
-        UpdateExpression='SET S_Status = :status, S_FinishedAt = :at, S_Error = :error',
-        ExpressionAttributeValues={
-            ':status': status,
-            ':at': datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z'),
-            ':error': error,
-        },
-        ReturnValues='NONE'
+        UpdateExpression=expression,
+        ExpressionAttributeValues=values,
+        ReturnValues='ALL_OLD'
     )
 
+    return resp.get('Attributes', dict())
+
 
 def update_taskitem_progress(itemid: str, progress: int):
     """
@@ -280,7 +879,7 @@ def update_taskitem_progress(itemid: str, progress: int):
         itemid: The id of Task item
         progress: The progress of job with MediaConvert
     """
-    db.Table(taskitem_table_name).update_item(
+    get_db().Table(taskitem_table_name).update_item(
         Key={'S_ItemId': itemid},
         UpdateExpression='SET N_Progress = :progress',
         ExpressionAttributeValues={':progress': progress},
@@ -288,18 +887,189 @@ def update_taskitem_progress(itemid: str, progress: int):
     )
 
 
-def is_taskitem_exists(bucket: str, key: str) -> bool:
+class TaskItemUpdate:
+    """
+    Update of a task item by a job event, with the task counters it increases.
+    The update is conditioned on the status and progress of the task item read before it, and
+    written with the counters in one transaction by `write_taskitem_updates`, so the counters of
+    an event are increased exactly once: if the write fails, nothing is written and the event
+    delivered again makes the same update, and if it succeeds, the event delivered again finds
+    the task item updated and makes no update.
+    Refer to `get_progress_update` and `get_settle_update`
+    """
+    def __init__(self, item: TaskItem, expression: str, condition: str, values: dict, counters: dict):
+        self.item = item
+        """ The task item read before the update """
+        self.expression = expression
+        """ The update expression of task item """
+        self.condition = condition
+        """ The condition that the task item is not changed since it is read """
+        self.values = values
+        """ The expression attribute values of the update and condition """
+        self.counters = counters
+        """ The numbers to increase the counters of task, keyed by the counter attribute name """
+
+
+def get_progress_update(item: TaskItem, progress: int, delta: int = 0, interval: int = 0) -> TaskItemUpdate:
+    """
+    Get the update to save the progress of job only if it moves forward by `delta` at least, or
+    `interval` seconds passed since the last saved one. The progress moved is added to `N_ProgressSum`
+    Args:
+        item: The task item read
+        progress: The progress of job with MediaConvert
+        delta: The min progress moved to save
+        interval: The min seconds since the last saved one to save
+    Returns:
+        The update, `None` if the job is finished or the progress does not move forward by `delta`
+        in `interval` seconds. The interval is checked by the condition of update
+    """
+    saved = item.progress if isinstance(item.progress, (int, Decimal)) else 0
+    if item.status in ('COMPLETE', 'ERROR') or progress <= saved:
+        return None
+
+    now = int(time.time())
+    values = {':progress': progress, ':now': now}
+    condition = _get_unchanged_condition(item, values)
+    if saved > progress - delta:
+        condition += ' AND (attribute_not_exists(N_ProgressAt) OR N_ProgressAt <= :before)'
+        values[':before'] = now - interval
+
+    return TaskItemUpdate(item, 'SET N_Progress = :progress, N_ProgressAt = :now', condition, values,
+                          {'N_ProgressSum': progress - saved})
+
+
+def get_settle_update(item: TaskItem, status: str, error: str = None, outputs: str = None) -> TaskItemUpdate:
+    """
+    Get the update to finish or fail the job, the counters are refer to `get_settled_counters`
+    Args:
+        item: The task item read
+        status: The status to update to, `COMPLETE` or `ERROR`
+        error: The error infomation if has
+        outputs: The output files of job in JSON to save if not `None`, refer to `TaskItem.outputs`
+    Returns:
+        The update, `None` if the job is finished or failed already, e.g. the event is delivered again
+    """
+    counters = get_settled_counters(item.as_dict(), status)
+    if len(counters) == 0:
+        return None
+
+    expression = 'SET S_Status = :status, S_FinishedAt = :at, S_Error = :error, N_Progress = :progress'
+    values = {
+        ':status': status,
+        ':at': datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z'),
+        ':error': error,
+        ':progress': 100 if status == 'COMPLETE' else '-1',
+    }
+
+    if outputs is not None:
+        expression += ', S_Outputs = :outputs'
+        values[':outputs'] = outputs
+
+    return TaskItemUpdate(item, expression, _get_unchanged_condition(item, values), values, counters)
+
+
+def _get_unchanged_condition(item: TaskItem, values: dict) -> str:
+    """ The condition that the status and progress of task item are not changed since read """
+    values[':read_status'] = item.status
+    values[':read_progress'] = item.progress
+    if item.progress == 0:
+        return 'S_Status = :read_status AND (N_Progress = :read_progress OR attribute_not_exists(N_Progress))'
+
+    return 'S_Status = :read_status AND N_Progress = :read_progress'
+
+
+def write_taskitem_updates(taskid: str, updates: List[TaskItemUpdate]) -> List[TaskItemUpdate]:
+    """
+    Write the updates of task items of a task with the task counters increased by the sum of theirs,
+    in transactions of `TRANSACT_SIZE` actions at most. The task items of a transaction and the
+    counters are updated together or not at all, a transaction conflicted with another write is retried
+    Args:
+        taskid: The id of Task
+        updates: The updates of the task items of task, one update of a task item at most
+    Returns:
+        The updates not written because their task items are changed since read, e.g. by another
+        event of the job, read the task items again to get the updates again
+    Raises:
+        Exception: The error of a transaction, the updates of the former transactions are written
+    """
+    client = get_db().meta.client
+    conflicts = []
+
+    for i in range(0, len(updates), TRANSACT_SIZE - 1):
+        chunk = updates[i:i + TRANSACT_SIZE - 1]
+        retry = 0
+
+        while len(chunk) > 0:
+            counters = dict()
+            for update in chunk:
+                for k, v in update.counters.items():
+                    counters[k] = counters.get(k, 0) + v
+            counters = {k: v for k, v in counters.items() if v != 0}
+
+            now = int(time.time())
+            actions = [{'Update': {
+                'TableName': taskitem_table_name,
+                'Key': {'S_ItemId': update.item.itemid},
+                'UpdateExpression': update.expression,
+                'ConditionExpression': update.condition,
+                'ExpressionAttributeValues': update.values,
+            }} for update in chunk]
+            counter = _get_counter_update(taskid, counters, now) if len(counters) > 0 else None
+            if counter is not None:
+                actions.append({'Update': dict(counter, TableName=task_table_name)})
+
+            try:
+                client.transact_write_items(TransactItems=actions)
+            except client.exceptions.TransactionCanceledException as err:
+                codes = [reason.get('Code', None) for reason in err.response.get('CancellationReasons', [])]
+                changed = [update for update, code in zip(chunk, codes) if code == 'ConditionalCheckFailed']
+                if len(changed) == 0:
+                    # conflicted with another write of the items or throttled
+                    if retry >= BATCH_RETRIES:
+                        raise
+                    time.sleep(min(0.05 * 2 ** retry, 2))
+                    retry += 1
+
+                conflicts.extend(changed)
+                chunk = [update for update in chunk if update not in changed]
+                continue
+
+            if counter is not None and 'N_ProgressSum' in counters:
+                _check_throughput_window(counter['Key']['S_TaskId'], now)
+            break
+
+    return conflicts
+
+
+def is_taskitem_exists(bucket: str, key: str, etag: str = None) -> bool:
     """
     Check whether the task item is exists
     Args:
         bucket: Bucket name where the source in
         key: Key of the source in bucket
+        etag: ETag of the source, only the task item of the same ETag is checked if set, e.g. the one
+            of a redelivered event, so the job of an object uploaded again is created
     Returns:
         Whether the task item is exists
     """
-    item = db.Table(taskitem_table_name).query(
+    if etag is None:
+        return _is_source_exists(get_source(bucket, key))
+
+    item = get_db().Table(taskitem_table_name).query(
+        KeyConditionExpression='S_Source = :source',
+        FilterExpression='S_ETag = :etag',
+        ExpressionAttributeValues={':source': get_source(bucket, key), ':etag': etag.strip('"')},
+        IndexName='SourceIndex',
+        Select='COUNT'
+    )
+
+    return item.get('Count', 0) > 0
+
+
+def _is_source_exists(source: str) -> bool:
+    item = get_db().Table(taskitem_table_name).query(
         KeyConditionExpression='S_Source = :source',
-        ExpressionAttributeValues={':source': get_source(bucket, key)},
+        ExpressionAttributeValues={':source': source},
         IndexName='SourceIndex',
         Select='COUNT'
     )
@@ -307,32 +1077,360 @@ def is_taskitem_exists(bucket: str, key: str) -> bool:
     return item.get('Count', 0) > 0
 
 
-def is_task_exists(bucket: str, key: str, condition: str) -> bool:
+def get_converted_sources(bucket: str, prefix: str = '') -> SourceSet:
     """
-    Check whether the task is exists
+    Load the sources of all task items under the prefix of bucket in bulk, so the duplicate check of
+    each object in prefix is answered locally
+    Args:
+        bucket: Bucket name where the sources in
+        prefix: The prefix of keys in bucket
+    Returns:
+        The set of converted sources
+    """
+    def sources():
+        params = {
+            'IndexName': 'SourceBucketIndex',
+            'KeyConditionExpression': 'S_SourceBucket = :bucket AND begins_with(S_Source, :prefix)',
+            'ExpressionAttributeValues': {':bucket': bucket, ':prefix': get_source(bucket, prefix or '')},
+            'ProjectionExpression': 'S_Source',
+        }
+        table = get_db().Table(taskitem_table_name)
+
+        while True:
+            resp = table.query(**params)
+            for item in resp.get('Items', []):
+                yield item['S_Source']
+
+            if 'LastEvaluatedKey' not in resp:
+                break
+            params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    return SourceSet(sources(), _is_source_exists)
+
+
+def backfill_taskitem_source_buckets() -> int:
+    """
+    Save the source bucket to the task items created before it is introduced.
+    It's safe to run it more than once
+    Returns:
+        The number of task items updated
+    """
+    table = get_db().Table(taskitem_table_name)
+    params = {
+        'ProjectionExpression': 'S_ItemId, S_Source',
+        'FilterExpression': 'attribute_exists(S_Source) AND attribute_not_exists(S_SourceBucket)',
+    }
+    updated = 0
+
+    while True:
+        resp = table.scan(**params)
+        for item in resp.get('Items', []):
+            table.update_item(
+                Key={'S_ItemId': item['S_ItemId']},
+                UpdateExpression='SET S_SourceBucket = :bucket',
+                ExpressionAttributeValues={':bucket': item['S_Source'][len('s3://'):].split('/', 1)[0]},
+                ReturnValues='NONE'
+            )
+            updated += 1
+
+        if 'LastEvaluatedKey' not in resp:
+            break
+        params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    return updated
+
+
+def is_task_exists(bucket: str, key: str, condition: str, template: str = None) -> bool:
+    """
+    Check whether the task is exists, the task is looked up by its fingerprint
     Args:
         bucket: Bucket name where the source in
         key: Key of the source in bucket
         condition: The filter condition used to look up objects in bucket
+        template: The template name used to create MediaConvert job
     Returns:
         Whether the task is exists
     """
-    item = db.Table(task_table_name).query(
-        KeyConditionExpression='S_Bucket = :bucket',
-        IndexName='BucketIndex',
-        FilterExpression='S_Key = :key AND S_Filter = :filter',
-        ExpressionAttributeValues={
-            ':bucket': bucket,
-            ':key': key,
-            ':filter': condition
-        },
-        Select='COUNT'
+    item = get_db().Table(task_table_name).query(
+        KeyConditionExpression='S_Fingerprint = :fingerprint',
+        IndexName='FingerprintIndex',
+        ExpressionAttributeValues={':fingerprint': get_task_fingerprint(bucket, key, condition, template)},
+        Select='COUNT',
+        Limit=1
     )
 
     return item.get('Count', 0) > 0
 
 
-def create_converter_job(taskid: str, bucket: str, key: str, template_name: str):
+def get_task_fingerprint(bucket: str, key: str, condition: str, template: str) -> str:
+    """
+    Get the fingerprint of a task, the tasks with the same bucket, key, filter and template have
+    the same fingerprint
+    Args:
+        bucket: Bucket name where the source in
+        key: Key of the source in bucket
+        condition: The filter condition used to look up objects in bucket
+        template: The template name used to create MediaConvert job
+    Returns:
+        The fingerprint in hex string
+    """
+    return hashlib.sha256(json.dumps([bucket, key, condition, template]).encode('utf-8')).hexdigest()
+
+
+def backfill_task_fingerprints() -> int:
+    """
+    Save the fingerprint to the tasks created before it is introduced, the shard items of counters
+    are skipped. It's safe to run it more than once
+    Returns:
+        The number of tasks updated
+    """
+    table = get_db().Table(task_table_name)
+    params = {
+        'ProjectionExpression': 'S_TaskId, S_Bucket, S_Key, S_Filter, S_TemplateName',
+        'FilterExpression': 'attribute_exists(S_Bucket) AND attribute_not_exists(S_Fingerprint)',
+    }
+    updated = 0
+
+    while True:
+        resp = table.scan(**params)
+        for item in resp.get('Items', []):
+            table.update_item(
+                Key={'S_TaskId': item['S_TaskId']},
+                UpdateExpression='SET S_Fingerprint = :fingerprint',
+                ExpressionAttributeValues={':fingerprint': get_task_fingerprint(
+                    item['S_Bucket'], item.get('S_Key', None), item.get('S_Filter', None),
+                    item.get('S_TemplateName', None)
+                )},
+                ReturnValues='NONE'
+            )
+            updated += 1
+
+        if 'LastEvaluatedKey' not in resp:
+            break
+        params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    return updated
+
+
+_template_cache = TTLCache(TEMPLATE_CACHE_TTL, TEMPLATE_CACHE_SIZE)  # job templates by name
+_destination_cache = TTLCache(TEMPLATE_CACHE_TTL, TEMPLATE_CACHE_SIZE)  # destinations by (template, bucket)
+
+
+def get_job_template(template_name: str) -> dict:
+    """
+    Get the JobTemplate of MediaConvert, the template is cached for `TEMPLATE_CACHE_TTL` seconds
+    Args:
+        template_name: The name of JobTemplate
+    Returns:
+        The JobTemplate
+    """
+    return _template_cache.get(
+        template_name, lambda: get_converter().get_job_template(Name=template_name)['JobTemplate']
+    )
+
+
+def get_output_destination(template_name: str, bucket: str) -> Tuple[str, bool]:
+    """
+    Get the output destination of jobs created with the JobTemplate for sources in the bucket.
+    If the JobTemplate has no destination, the output bucket from options is used.
+    The destination is cached with the JobTemplate
+    Args:
+        template_name: The name of JobTemplate
+        bucket: Bucket name where the source in
+    Returns:
+        The destination and whether it is defined by the JobTemplate
+    """
+    def load():
+        dest = get_job_template(template_name)['Settings']['OutputGroups'][0]['OutputGroupSettings'].get(
+            'Destination', None
+        )
+        if dest is not None:
+            return dest, True
+
+        return option_store.bucket_option(bucket, 'OutputBucket'), False
+
+    return _destination_cache.get((template_name, bucket), load)
+
+
+def get_output_url(template_name: str, bucket: str, key: str) -> Tuple[str, str]:
+    """
+    Get the output destination of the job of source
+    Args:
+        template_name: The template name used to create MediaConvert job
+        bucket: Bucket name where the source in
+        key: Key of the source in bucket
+    Returns:
+        The destination by `get_output_destination` and the destination url of job output, the url
+        is `None` if the destination is defined by the JobTemplate
+    """
+    dest, from_template = get_output_destination(template_name, bucket)
+    if from_template:
+        return dest, None
+
+    sub = ''
+    if '/' in key:
+        sub = key[0:key.rindex('/') + 1]
+
+    return dest, 's3://%s/%s' % (dest, sub)
+
+
+def invalidate_template_cache(template_name: str = None):
+    """
+    Remove the JobTemplate and its destinations from cache
+    Args:
+        template_name: The name of JobTemplate, remove all if `None`
+    """
+    _template_cache.invalidate(template_name)
+
+    if template_name is None:
+        _destination_cache.invalidate()
+    else:
+        for key in [k for k in _destination_cache.keys() if k[0] == template_name]:
+            _destination_cache.invalidate(key)
+
+
+def template_cache_stats() -> dict:
+    """ Hits, misses and size of the JobTemplate and destination caches """
+    return {'template': _template_cache.stats(), 'destination': _destination_cache.stats()}
+
+
+class TaskItemBatchWriter:
+    """
+    Buffer of the task items to save and the task counters to increase.
+    The task items are written with `BatchWriteItem` in chunks, the counter increments of all
+    items in a chunk are folded into one `update_item` per task.
+    A chunk not full is written too once its first item is buffered for `BATCH_WRITE_DELAY` seconds,
+    to save the task item before the events of its job come in.
+    The jobs of a chunk are created before it is written, so a chunk failed to write is never
+    raised to the job which fills it: the items and counters not written are kept and written
+    again with the next chunk, `flush` raises the error if they are still not written.
+    The writer is thread safe, use it as a context manager to flush the remaining items on exit.
+
+    Example:
+    >>> with TaskItemBatchWriter() as writer:
+    ...     create_converter_job(taskid, bucket, key, template_name, writer)
+    """
+    def __init__(self, batch_size: int = BATCH_WRITE_SIZE):
+        self._batch_size = min(max(batch_size, 1), BATCH_WRITE_SIZE)
+        self._items = []
+        self._buffered_at = None  # the time the first item of the chunk buffered
+        self._counters = dict()  # counter increments of the items written and not applied yet, by task
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def put_item(self, item: TaskItem):
+        """
+        Buffer a task item to save, the counter of its task is increased by its status
+        Args:
+            item: The task item to save
+        """
+        with self._lock:
+            if len(self._items) == 0:
+                self._buffered_at = time.monotonic()
+            self._items.append(item)
+            if len(self._items) < self._batch_size and time.monotonic() - self._buffered_at < BATCH_WRITE_DELAY:
+                return
+
+            chunk, self._items = self._items, []
+
+        # noinspection PyBroadException
+        try:
+            self._write(chunk)
+        except Exception as err:
+            logger.warning('Task items write with error, %d items are kept to write again - %s'
+                           % (len(self.unsaved), err))
+
+    def flush(self):
+        """
+        Write all buffered task items and counters
+        Raises:
+            BatchUnprocessed: If any task items are still not written, they are kept in the writer,
+                refer to `unsaved`. The error of counters update is raised as is
+        """
+        with self._lock:
+            chunk, self._items = self._items, []
+
+        try:
+            self._write(chunk)
+        except Exception:
+            for item in self.unsaved:
+                logger.error('Task item of job %s is not saved, source - %s' % (item.itemid, item.source))
+            raise
+
+    @property
+    def unsaved(self) -> List[TaskItem]:
+        """ The task items buffered and not written yet """
+        with self._lock:
+            return list(self._items)
+
+    def _write(self, chunk: list):
+        error = None
+        written = chunk
+
+        try:
+            batch_write_items(taskitem_table_name, [{'PutRequest': {'Item': item.as_dict()}} for item in chunk])
+        except BatchUnprocessed as err:
+            unprocessed = {request['PutRequest']['Item']['S_ItemId'] for request in err.requests}
+            written = [item for item in chunk if item.itemid not in unprocessed]
+            with self._lock:
+                self._items = [item for item in chunk if item.itemid in unprocessed] + self._items
+            error = err
+
+        with self._lock:
+            _add_counters(self._counters, _get_item_counters(written))
+            counters, self._counters = self._counters, dict()
+
+        for taskid, counter in counters.items():
+            try:
+                increase_task_counters(taskid, counter)
+            except Exception as err:
+                with self._lock:
+                    _add_counters(self._counters, {taskid: counter})
+                error = error if error is not None else err
+
+        if error is not None:
+            raise error
+
+
+def _get_item_counters(items: List[TaskItem]) -> Dict[str, dict]:
+    """ The counter increments of the task items saved, by task """
+    counters = dict()
+    for item in items:
+        if item.status in ('SKIPPED', 'DEFERRED'):
+            continue  # no job is created for the item
+
+        counter = counters.setdefault(item.taskid, {'N_Running': 0, 'N_Error': 0, 'N_Finished': 0,
+                                                     'N_ProgressSum': 0})
+        if item.status == 'ERROR':
+            counter['N_Error'] += 1
+            counter['N_ProgressSum'] += 100
+        elif item.status == 'COMPLETE':
+            counter['N_Finished'] += 1  # the outputs are copied by the content dedupe
+            counter['N_ProgressSum'] += 100
+        else:
+            counter['N_Running'] += 1
+
+    return counters
+
+
+def _add_counters(counters: Dict[str, dict], increments: Dict[str, dict]):
+    """ Add the counter increments by task to `counters` """
+    for taskid, increment in increments.items():
+        counter = counters.setdefault(taskid, dict())
+        for k, v in increment.items():
+            counter[k] = counter.get(k, 0) + v
+
+
+def create_converter_job(taskid: str, bucket: str, key: str, template_name: str,
+                         writer: TaskItemBatchWriter = None, routing: str = None,
+                         content: Tuple[str, int] = None,
+                         admission: AdmissionController = None,
+                         assignment: Any = None) -> TaskItem:
     """
     Create MediaConvert job, save info to taskitem and update task running/error counter
     Args:
@@ -340,72 +1438,358 @@ def create_converter_job(taskid: str, bucket: str, key: str, template_name: str)
         bucket: Bucket name where the source in
         key: Key of the source in bucket
         template_name: The template name used to create MediaConvert job
+        writer: The batch writer to buffer the task item and counters, write them directly if `None`
+        routing: The routing decision of the source in JSON to record on the task item
+        content: The ETag and size of the source to record on the task item for the content dedupe
+        admission: The admission controller to pace the job creates, a throttled create is retried
+            by it and the job is deferred if still throttled. The create is not paced if `None`
+        assignment: The queue and priority of job assigned by the scheduler, refer to `scheduler.Assignment`,
+            the ones of job template are used if `None`
+    Returns:
+        The task item saved for the job
+    Raises:
+        JobDeferred: If the job is deferred by the admission controller, no task item is saved
     """
 
-    increase_task_running_counter(taskid)
+    if writer is None:
+        increase_task_running_counter(taskid)
     source = get_source(bucket, key)
     dest = None
     error = None
 
     # noinspection PyBroadException
     try:
-        with open('./task_params.json', 'r') as f:
-            params = json.load(f)
-            params['Role'] = _get_options('MediaConvertJobRole')
-            params['JobTemplate'] = template_name
-            params['Settings']['Inputs'][0]['FileInput'] = source
-
-        template_params = converter.get_job_template(Name=template_name)
-        dest = template_params['JobTemplate']['Settings']['OutputGroups'][0]['OutputGroupSettings'].get(
-            'Destination', None
-        )
-
-        if dest is None:
-            dest = _get_options('%s-OutputBucket' % bucket)
-            if dest is None:
-                dest = _get_options('default-OutputBucket')
-
-            sub = ''
-            if '/' in key:
-                sub = key[0:key.rindex('/') + 1]
+        dest, output = get_output_url(template_name, bucket, key)
 
-            params['Settings']['OutputGroups'] = [{
-                'OutputGroupSettings': {
-                    'Type': 'FILE_GROUP_SETTINGS',
-                    'FileGroupSettings': {
-                        'Destination': 's3://%s/%s' % (dest, sub)
-                    },
-                }
-            }]
+        params = job_spec_builder.build(bucket, template_name, source, option_store.job_role(), output)
+        if assignment is not None:
+            params['Priority'] = assignment.priority
+            if assignment.queue is not None:
+                params['Queue'] = assignment.queue
 
-        resp = converter.create_job(**params)
+        resp = _create_job(params, admission)
 
         status = 'RUNNING'
         itemid = resp['Job']['Id']
         created_at = resp['Job']['CreatedAt'].strftime('%Y-%m-%d %H:%M:%S%z')
         finished_at = None
+    except JobDeferred:
+        if writer is None:
+            increase_task_counters(taskid, {'N_Running': -1})
+        raise
     except Exception as err:
         error = str(err)
-        increase_task_error_counter(taskid)
+        if writer is None:
+            increase_task_error_counter(taskid, 100)
 
         status = 'ERROR'
         itemid = uuid.uuid4().hex
         created_at = datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
         finished_at = datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
 
-    db.Table(taskitem_table_name).put_item(
-        Item={
-            'S_ItemId': itemid,
-            'S_Source': source,
-            'S_Target': get_source(dest, key),
-            'S_TaskId': taskid,
-            'S_Status': status,
-            'N_Progress': 0,
-            'S_CreatedAt': created_at,
-            'S_FinishedAt': finished_at,
-            'S_Error': error,
-        },
-        ReturnValues='NONE')
+    item = TaskItem()
+    item.itemid = itemid
+    item.source = source
+    item.source_bucket = bucket
+    item.target = get_source(dest, key)
+    item.taskid = taskid
+    item.status = status
+    item.created_at = created_at
+    item.finished_at = finished_at
+    item.error = error
+    item.routing = routing
+    item.template_name = template_name
+    if content is not None:
+        item.etag, item.size = content[0].strip('"'), content[1]
+    if assignment is not None:
+        item.queue, item.priority = assignment.queue, assignment.priority
+
+    if writer is None:
+        get_db().Table(taskitem_table_name).put_item(
+            Item=item.as_dict(),
+            ReturnValues='NONE')
+    else:
+        writer.put_item(item)
+
+    return item
+
+
+def _create_job(params: dict, admission: AdmissionController) -> dict:
+    if admission is None:
+        return get_converter().create_job(**params)
+
+    for _ in range(CREATE_RETRIES + 1):
+        if not admission.acquire():
+            raise JobDeferred('no job create is allowed in time')
+
+        try:
+            resp = get_converter().create_job(**params)
+        except Exception as err:
+            if getattr(err, 'response', dict()).get('Error', dict()).get('Code', None) \
+                    not in ('TooManyRequestsException', 'ThrottlingException'):
+                raise
+
+            admission.on_throttled()
+            continue
+
+        admission.on_created()
+        return resp
+
+    raise JobDeferred('job create is throttled after %d retries' % CREATE_RETRIES)
+
+
+def defer_converter_job(taskid: str, bucket: str, key: str, writer: TaskItemBatchWriter = None) -> TaskItem:
+    """
+    Save a `DEFERRED` task item for the source whose job is deferred by the admission control,
+    the task counters are not changed. The deferred items are submitted again by `get_deferred_taskitems`
+    Args:
+        taskid: The id of Task
+        bucket: Bucket name where the source in
+        key: Key of the source in bucket
+        writer: The batch writer to buffer the task item, write it directly if `None`
+    Returns:
+        The task item saved
+    """
+    item = TaskItem()
+    item.itemid = uuid.uuid4().hex
+    item.source = get_source(bucket, key)
+    item.source_bucket = bucket
+    item.taskid = taskid
+    item.status = 'DEFERRED'
+    item.created_at = datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
+
+    if writer is None:
+        get_db().Table(taskitem_table_name).put_item(
+            Item=item.as_dict(),
+            ReturnValues='NONE')
+    else:
+        writer.put_item(item)
+
+    return item
+
+
+def get_deferred_taskitems(taskid: str, limit: int = None) -> List[TaskItem]:
+    """
+    Get the task items deferred by the admission control of task
+    Args:
+        taskid: The id of Task
+        limit: The max number of task items to get, all of them if `None`
+    Returns:
+        The deferred task items
+    """
+    if limit is not None and limit <= 0:
+        return []
+
+    table = get_db().Table(taskitem_table_name)
+    params = {
+        'IndexName': 'TaskIndex',
+        'KeyConditionExpression': 'S_TaskId = :taskid',
+        'FilterExpression': 'S_Status = :status',
+        'ExpressionAttributeValues': {':taskid': taskid, ':status': 'DEFERRED'},
+    }
+    items = []
+
+    while True:
+        resp = table.query(**params)
+        items.extend(TaskItem.from_item(item) for item in resp.get('Items', []))
+
+        if limit is not None and len(items) >= limit:
+            return items[0:limit]
+        if 'LastEvaluatedKey' not in resp:
+            return items
+        params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def delete_taskitems(itemids: Iterable[str]):
+    """
+    Delete the task items in batch
+    Args:
+        itemids: The ids of Task item
+    """
+    batch_write_items(taskitem_table_name, [{'DeleteRequest': {'Key': {'S_ItemId': itemid}}} for itemid in itemids])
+
+
+def skip_converter_job(taskid: str, bucket: str, key: str, routing: str,
+                       writer: TaskItemBatchWriter = None) -> TaskItem:
+    """
+    Save a `SKIPPED` task item for the source which needs no job, the task counters are not changed
+    Args:
+        taskid: The id of Task
+        bucket: Bucket name where the source in
+        key: Key of the source in bucket
+        routing: The routing decision of the source in JSON to record on the task item
+        writer: The batch writer to buffer the task item, write it directly if `None`
+    Returns:
+        The task item saved
+    """
+    now = datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
+
+    item = TaskItem()
+    item.itemid = uuid.uuid4().hex
+    item.source = get_source(bucket, key)
+    item.source_bucket = bucket
+    item.taskid = taskid
+    item.status = 'SKIPPED'
+    item.created_at = now
+    item.finished_at = now
+    item.routing = routing
+
+    if writer is None:
+        get_db().Table(taskitem_table_name).put_item(
+            Item=item.as_dict(),
+            ReturnValues='NONE')
+    else:
+        writer.put_item(item)
+
+    return item
+
+
+def _get_content(bucket: str, key: str) -> Tuple[str, int]:
+    resp = get_s3().head_object(Bucket=bucket, Key=key)
+    return resp['ETag'].strip('"'), resp['ContentLength']
+
+
+class JobResult:
+    """
+    Result of a job submitted by `submit_converter_jobs`
+    """
+    def __init__(self, key: str):
+        self.key = key
+        """ Key of the source in bucket """
+        self.item = None
+        """ The task item saved for the job, `None` if the job is failed or skipped as the task item exists """
+        self.skipped = False
+        """
+        Whether the job is skipped because the task item already exists, or the source already
+        matches the output profile by routing (the `SKIPPED` task item is saved as `item`)
+        """
+        self.error = None
+        """ The error raised while submitting the job if has """
+        self.copied = False
+        """ Whether the outputs are copied from the same content converted instead of creating a job """
+        self.deferred = False
+        """ Whether the job is deferred by the admission control, no task item is saved """
+
+
+def submit_converter_jobs(taskid: str, bucket: str, keys: Iterable[str], template_name: str,
+                          force: bool = False, concurrency: int = None,
+                          writer: TaskItemBatchWriter = None,
+                          converted: SourceSet = None,
+                          router: Callable[[str, str, int], Any] = None,
+                          contents: Dict[str, Tuple[str, int]] = None,
+                          admission: AdmissionController = None,
+                          scheduler: Callable[[str, str, int], Any] = None,
+                          dedupe: Callable[..., TaskItem] = None) -> Iterator[JobResult]:
+    """
+    Submit MediaConvert jobs for the keys with a bounded pool of workers
+    The results are yielded in the same order as the keys, errors raised while submitting a job
+    are captured in its result instead of interrupting the others
+    Args:
+        taskid: The id of Task
+        bucket: Bucket name where the sources in
+        keys: Keys of the sources in bucket
+        template_name: The template name used to create MediaConvert job
+        force: Whether to create the job even if the task item of the source is exists
+        concurrency: The number of jobs submitted concurrently, default from option `JobConcurrency`
+        writer: The batch writer to buffer the task items and counters, write them directly if `None`
+        converted: The sources loaded by `get_converted_sources` to check duplicate, check each source
+            with `is_taskitem_exists` if `None`, of the same ETag if the content of source is in `contents`
+        router: The router to pick the template of each source by the key, ETag and size of source,
+            refer to `routing.get_router`. `template_name` is used for all sources if `None`
+        contents: The ETag and size of the sources by key, e.g. from the object listing, recorded on
+            the task items. The content of a source not in it is looked up if `dedupe` is set
+        admission: The admission controller to pace the job creates and cap the running jobs of task,
+            refer to `admission_controller`. The jobs are not paced or deferred if `None`
+        scheduler: The scheduler to assign the queue and priority of each job by the key, ETag and
+            size of source, refer to `scheduler.get_scheduler`, the queue of a job not created is released.
+            The ones of job template are used if `None`
+        dedupe: The content dedupe to copy the outputs of the same content converted instead of creating
+            a job, refer to `content.get_content_dedupe`. A job is created for each source if `None`
+    Returns:
+        An iterator of the job results
+    """
+    if concurrency is None:
+        concurrency = option_store.get_int('JobConcurrency', DEFAULT_JOB_CONCURRENCY)
+    concurrency = max(concurrency, 1)
+
+    def submit(key: str) -> JobResult:
+        result = JobResult(key)
+        admitted = False  # a job admitted is counted out if it is not created
+        assignment = None  # the queue assigned is counted out if the job is not created
+
+        def release():
+            if admitted:
+                admission.release(taskid)
+            if assignment is not None and assignment.queue is not None:
+                scheduler.release(assignment.queue)
+
+        # noinspection PyBroadException
+        try:
+            content = contents.get(key, None) if contents is not None else None
+            if force:
+                exists = False
+            elif converted is not None:
+                exists = converted.contains(get_source(bucket, key))
+            else:
+                exists = is_taskitem_exists(bucket, key, content[0] if content is not None else None)
+
+            route = None
+            if router is not None and not exists:
+                route = router(key, *(content if content is not None else (None, None)))
+
+            if exists:
+                result.skipped = True
+            elif route is not None and route.skip:
+                result.item = skip_converter_job(taskid, bucket, key, route.as_json(), writer)
+                result.skipped = True
+            else:
+                template = route.template_name if route is not None else template_name
+                if content is None and dedupe is not None:
+                    content = _get_content(bucket, key)
+
+                if dedupe is not None:
+                    try:
+                        result.item = dedupe(taskid, key, template, content, writer)
+                    except Exception as err:
+                        logger.warning('Content dedupe with error, create job instead, source - %s, error - %s'
+                                       % (get_source(bucket, key), err))
+                    if result.item is not None:
+                        result.copied = True
+                        return result
+
+                if admission is not None:
+                    if not admission.admit(taskid):
+                        raise JobDeferred('task has the max running jobs')
+                    admitted = True
+
+                if scheduler is not None:
+                    assignment = scheduler(key, *(content if content is not None else (None, None)))
+
+                result.item = create_converter_job(taskid, bucket, key, template, writer,
+                                                   route.as_json() if route is not None else None, content,
+                                                   admission, assignment)
+                if result.item.status == 'ERROR':
+                    release()
+        except JobDeferred:
+            result.deferred = True
+            admission.on_deferred()
+            release()
+        except Exception as err:
+            result.error = err
+            release()
+
+        return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()  # keep at most 2 * concurrency jobs in flight to bound the memory
+
+        for key in keys:
+            pending.append(executor.submit(submit, key))
+            if len(pending) >= concurrency * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
 
 
 def source_file_exists(bucket: str, key: str) -> bool:
@@ -424,8 +1808,7 @@ def source_file_exists(bucket: str, key: str) -> bool:
 
     # noinspection PyBroadException
     try:
-        f = boto3.resource('s3').Object(bucket, key)
-        if f.content_length == 0:
+        if get_s3().head_object(Bucket=bucket, Key=key)['ContentLength'] == 0:
             return False
     except:
         return False
@@ -442,11 +1825,7 @@ def get_bucket_template_name(bucket: str) -> str:
     Returns:
         The JobTemplate name of MediaConvert
     """
-    template = _get_options('%s-JobTemplate' % bucket)
-    if template is None:
-        template = _get_options('default-JobTemplate')
-
-    return template
+    return option_store.bucket_option(bucket, 'JobTemplate')
 
 
 def get_source(bucket: str, key: str) -> str:
@@ -461,18 +1840,5 @@ def get_source(bucket: str, key: str) -> str:
     return "s3://%s/%s" % (bucket, key)
 
 
-_options = dict()  # global option store
-
-
 def _get_options(key: str) -> any:
-    opt = _options.get(key, None)
-    if opt is not None:
-        return opt
-
-    item = db.Table(options_table_name).get_item(
-        Key={'S_Key': key}
-    )
-
-    value = item.get('Item', dict()).get('S_Value', None)
-    _options[key] = value
-    return value
+    return option_store.get(key)
@@ -2,14 +2,26 @@
 
 import logging
 import math
+import time
 from task import *
+from metrics import LOG_LEVEL, instrumented, log_event, phase
 
-logging.getLogger().setLevel(logging.INFO)
+DEFAULT_PROGRESS_DELTA = 5  # The min progress moved to save by default
+DEFAULT_PROGRESS_INTERVAL = 60  # The min seconds since the last saved progress to save by default
+UPDATE_ATTEMPTS = 3  # The max times to update a task item read again as it is changed by another event
+MISSING_RETRY_PERIOD = 3600  # The max seconds since an event to retry it while the task item of its job is not found
+
+logging.getLogger().setLevel(LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+progress_stats = {'written': 0, 'suppressed': 0}  # progress updates of the container
+
+_status_rank = {'STATUS_UPDATE': 0, 'COMPLETE': 1, 'ERROR': 1}  # a finished status overrides the progressing one
 
+
+@instrumented('TaskEvent')
 def lambda_handler(event, _):
-    logger.info("Received event: " + json.dumps(event, indent=2))
+    log_event(logger, event, job=event['detail']['jobId'], status=event['detail']['status'])
 
     code = 200
     error = None
@@ -20,21 +32,35 @@ def lambda_handler(event, _):
 
     taskitem = get_task_item(itemid)
     if taskitem is not None:
-        if status == 'COMPLETE':
-            increase_task_finished_counter(taskitem.taskid)
-        elif status == 'ERROR':
-            error = event['detail']['errorMessage']
-            increase_task_error_counter(taskitem.itemid)
-        elif status == 'STATUS_UPDATE':
-            progress = math.floor(float(event['detail']['jobProgress']['jobPercentComplete']))
-            update_taskitem_progress(itemid, progress)
+        for _ in range(UPDATE_ATTEMPTS):
+            update = _get_update(taskitem, event['detail'])
+            if update is None or len(write_taskitem_updates(taskitem.taskid, [update])) == 0:
+                break
 
-        if status != 'STATUS_UPDATE':
-            update_taskitem_status(itemid, status, error)
-            update_taskitem_progress(itemid, 100 if status == 'COMPLETE' else '-1')
+            if status == 'STATUS_UPDATE':
+                update = None  # the progress is moved by another event
+                break
+
+            taskitem = get_task_item(itemid)  # changed by another event since read
+        else:
+            raise RuntimeError("Job(%s) is changed by other events in %d attempts" % (itemid, UPDATE_ATTEMPTS))
+
+        if status == 'STATUS_UPDATE':
+            progress = math.floor(float(event['detail']['jobProgress']['jobPercentComplete']))
+            progress_stats['written' if update is not None else 'suppressed'] += 1
+            if update is None:
+                logger.info("Job(%s) progress update to [%d] is suppressed, progress updates - %s"
+                            % (itemid, progress, json.dumps(progress_stats)))
+                return {"status": code, "event": event, 'message': 'progress update suppressed'}
+        elif update is None:
+            logger.info("Job(%s) status [%s] is applied already" % (itemid, status))
+            return {"status": code, "event": event, 'message': 'event delivered again'}
 
         logger.info("Job(%s) status is updated to [%s] "
                     % (itemid, str(progress) if status == 'STATUS_UPDATE' else status))
+    elif _is_retryable(event['detail']):
+        # the task item may be buffered by the writer of executor yet, the event is invoked again to retry
+        raise RuntimeError("Job(%s) not exists, the event is retried" % itemid)
     else:
         code = 400
         error = "Job not exists"
@@ -42,3 +68,133 @@ def lambda_handler(event, _):
         logger.info("Job(%s) not exists. " % itemid)
 
     return {"status": code, "event": event, 'message': error}
+
+
+@instrumented('TaskEventBatch')
+def batch_handler(event, _):
+    """
+    Handle a batch of MediaConvert events buffered by SQS, the message body of each record is an
+    EventBridge event of MediaConvert job state change.
+    The events of a job are de-duplicated to the latest one, the task items are read in batch, and
+    the task items of a task are updated with its counters in one transaction, refer to
+    `write_taskitem_updates`. A failed record is safe to deliver again, the update of an event
+    applied already is not made again. The event of a job whose task item is not found is failed
+    to deliver it again, as the item may be not written yet, refer to `_is_retryable`.
+    Returns:
+        The records failed to apply, in the partial batch response format of SQS
+    """
+    log_event(logger, event, records=len(event['Records']))
+
+    failures = []
+    latest = dict()  # the latest event of each job
+    records = dict()  # message ids of each job
+
+    for record in event['Records']:
+        try:
+            detail = json.loads(record['body'])['detail']
+            itemid = detail['jobId']
+        except (ValueError, KeyError, TypeError) as err:
+            logger.error("Invalid event(%s) - %s" % (record['messageId'], err))
+            failures.append(record['messageId'])
+            continue
+
+        records.setdefault(itemid, []).append(record['messageId'])
+        if itemid not in latest or _is_later(detail, latest[itemid]):
+            latest[itemid] = detail
+
+    try:
+        with phase('GetItems'):
+            taskitems = get_task_items(latest.keys())
+    except Exception as err:
+        logger.error("Get task items with error - %s" % err)
+        return {'batchItemFailures': [{'itemIdentifier': i} for i in failures + sum(records.values(), [])]}
+
+    updates = dict()  # updates of the task items of each task
+
+    for itemid, detail in latest.items():
+        taskitem = taskitems.get(itemid, None)
+        if taskitem is None:
+            logger.info("Job(%s) not exists. " % itemid)
+            if _is_retryable(detail):
+                failures.extend(records[itemid])  # the task item may be buffered by the writer of executor yet
+            continue
+
+        # noinspection PyBroadException
+        try:
+            update = _get_update(taskitem, detail)
+        except Exception as err:
+            logger.error("Job(%s) event with error - %s" % (itemid, err))
+            failures.extend(records[itemid])
+            continue
+
+        if update is not None:
+            updates.setdefault(taskitem.taskid, []).append(update)
+        elif detail['status'] == 'STATUS_UPDATE':
+            progress_stats['suppressed'] += 1
+
+    with phase('UpdateItems'):
+        for taskid, task_updates in updates.items():
+            try:
+                changed = write_taskitem_updates(taskid, task_updates)
+            except Exception as err:
+                logger.error("Task(%s) items update with error - %s" % (taskid, err))
+                for update in task_updates:
+                    failures.extend(records[update.item.itemid])
+                continue
+
+            for update in task_updates:
+                progressed = latest[update.item.itemid]['status'] == 'STATUS_UPDATE'
+                if update not in changed:
+                    progress_stats['written'] += progressed
+                elif progressed:
+                    progress_stats['suppressed'] += 1  # the progress is moved by another event
+                else:
+                    # changed by another event since read, the record is delivered again to apply it to the item read again
+                    failures.extend(records[update.item.itemid])
+
+    logger.info("Handled %d jobs of %d events, failed %d events, progress updates - %s"
+                % (len(latest), len(event['Records']), len(failures), json.dumps(progress_stats)))
+
+    return {'batchItemFailures': [{'itemIdentifier': i} for i in failures]}
+
+
+def _get_update(taskitem: TaskItem, detail: dict) -> TaskItemUpdate:
+    """ The update of task item by the job event, `None` if suppressed or the event is applied already """
+    status = detail['status']
+    if status == 'STATUS_UPDATE':
+        return get_progress_update(taskitem, math.floor(float(detail['jobProgress']['jobPercentComplete'])),
+                                   option_store.get_int('ProgressUpdateDelta', DEFAULT_PROGRESS_DELTA),
+                                   option_store.get_int('ProgressUpdateInterval', DEFAULT_PROGRESS_INTERVAL))
+
+    return get_settle_update(taskitem, status, detail.get('errorMessage', None) if status == 'ERROR' else None,
+                             _get_outputs(detail))
+
+
+def _get_outputs(detail: dict) -> str:
+    """ The output files of a completed job in JSON, refer to `TaskItem.outputs` """
+    if detail['status'] != 'COMPLETE' or 'outputGroupDetails' not in detail:
+        return None
+
+    return json.dumps([{
+        'type': group.get('type', None),
+        'paths': group.get('playlistFilePaths', []) + [
+            path for output in group.get('outputDetails', []) for path in output.get('outputFilePaths', [])],
+    } for group in detail['outputGroupDetails']], separators=(',', ':'))
+
+
+def _is_retryable(detail: dict) -> bool:
+    """
+    Whether the event of a job whose task item is not found is retried, the task item of a job
+    created recently may be not written yet, and the events of the jobs not created by the converter
+    are not retried after `MISSING_RETRY_PERIOD`
+    """
+    timestamp = detail.get('timestamp', None)
+    return timestamp is None or time.time() - timestamp / 1000 < MISSING_RETRY_PERIOD
+
+
+def _is_later(detail: dict, other: dict) -> bool:
+    rank, other_rank = _status_rank.get(detail['status'], 0), _status_rank.get(other['status'], 0)
+    if rank != other_rank:
+        return rank > other_rank
+
+    return detail.get('timestamp', 0) >= other.get('timestamp', 0)
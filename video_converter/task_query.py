@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import hashlib
+import json
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List
+
+from task import Task, TaskItem, get_db, get_source, task_table_name, taskitem_table_name
+
+DEFAULT_PAGE_SIZE = 100  # The max number of items read in one request by default
+DEFAULT_SEGMENTS = 4  # The number of segments read in parallel by a scan by default
+SEGMENT_BUFFER_PAGES = 2  # The number of pages buffered of each segment read in parallel
+
+_END = 'end'  # position of a segment read to the end
+
+_TASKITEM_KEYS = ('S_ItemId', 'S_Source', 'S_TaskId')  # attributes always read to create a TaskItem
+_TASK_KEYS = ('S_TaskId', 'S_Bucket')  # attributes always read to create a Task
+
+
+class ItemIterator:
+    """
+    Iterator of the items of a query or scan read page by page, the items are created by `factory`
+    as they are yielded and never held in memory beyond the page being read.
+    After any item is yielded, `cursor` is a token to resume the read right after it, pass it to
+    the same query to go on. A scan with more than one segment reads the segments in parallel
+    threads, the items of segments are yielded as they arrive and the cursor keeps the position
+    of each segment. The iterator can be iterated only once.
+
+    Example:
+    >>> items = iter_task_items(taskid, page_size=50)
+    >>> for item in itertools.islice(items, 50):
+    ...     print(item.source, item.status)
+    >>> token = items.cursor  # to read the next 50 items later
+    """
+    def __init__(self, table_name: str, params: dict, keys: Iterable[str], factory: Callable[[dict], Any],
+                 projection: Iterable[str] = None, page_size: int = DEFAULT_PAGE_SIZE, cursor: str = None,
+                 segments: int = 1):
+        self.table_name = table_name
+        """ Name of the table read """
+        self.page_size = max(page_size, 1)
+        """ The max number of items read in one request """
+        self.segments = max(segments, 1)
+        """ The number of segments read in parallel, only for a scan """
+        self.pages = 0
+        """ Total requests sent """
+        self._params = dict(params)
+        self._keys = list(keys)  # the key attributes of table and index, the position of an item
+        self._factory = factory
+        self._lock = threading.Lock()
+
+        if projection is not None:
+            self._params['ProjectionExpression'] = ', '.join(sorted(set(projection) | set(self._keys)))
+        if self.segments > 1 and 'KeyConditionExpression' in self._params:
+            raise ValueError('A query can not be read in segments')
+
+        self._query = hashlib.sha1(json.dumps([table_name, self._params, self.segments], sort_keys=True,
+                                              default=str).encode('utf-8')).hexdigest()[:16]
+        self._positions = _decode_cursor(cursor, self._query, self.segments) if cursor else [None] * self.segments
+
+    @property
+    def cursor(self) -> str:
+        """ The token to resume the read after the last item yielded, `None` if all items are read """
+        with self._lock:
+            if all(position == _END for position in self._positions):
+                return None
+
+            return _encode_cursor(self._query, self._positions)
+
+    def __iter__(self) -> Iterator[Any]:
+        if self.segments == 1:
+            for item in self._read(0):
+                self._positions[0] = {k: item[k] for k in self._keys}
+                yield self._factory(item)
+
+            self._positions[0] = _END
+            return
+
+        yield from self._read_segments()
+
+    def _read(self, segment: int) -> Iterator[dict]:
+        if self._positions[segment] == _END:
+            return
+
+        params = dict(self._params, Limit=self.page_size)
+        if self.segments > 1:
+            params.update(Segment=segment, TotalSegments=self.segments)
+        if self._positions[segment] is not None:
+            params['ExclusiveStartKey'] = self._positions[segment]
+
+        table = get_db().Table(self.table_name)
+        read = table.query if 'KeyConditionExpression' in params else table.scan
+
+        while True:
+            resp = read(**params)
+            with self._lock:
+                self.pages += 1
+
+            for item in resp.get('Items', []):
+                yield item
+
+            if 'LastEvaluatedKey' not in resp:
+                return
+            params['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+    def _read_segments(self) -> Iterator[Any]:
+        buffer = queue.Queue(maxsize=self.page_size * SEGMENT_BUFFER_PAGES * self.segments)
+        stopped = threading.Event()
+
+        def put(entry):
+            while not stopped.is_set():
+                try:
+                    buffer.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def run(segment: int):
+            # noinspection PyBroadException
+            try:
+                for item in self._read(segment):
+                    if not put((segment, item)):
+                        return
+                put((segment, _END))
+            except Exception as err:
+                put((segment, err))
+
+        threads = [threading.Thread(target=run, args=(segment,), daemon=True) for segment in range(self.segments)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            running = len(threads)
+            while running > 0:
+                segment, item = buffer.get()
+                if isinstance(item, Exception):
+                    raise item
+
+                if item == _END:
+                    self._positions[segment] = _END
+                    running -= 1
+                    continue
+
+                self._positions[segment] = {k: item[k] for k in self._keys}
+                yield self._factory(item)
+        finally:
+            stopped.set()  # the threads are stopped if the iteration is closed early
+            for thread in threads:
+                thread.join()
+
+
+def _encode_cursor(query: str, positions: List[Any]) -> str:
+    data = json.dumps({'q': query, 'p': positions}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str, query: str, segments: int) -> List[Any]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except ValueError:
+        raise ValueError('Cursor %s is invalid' % cursor)
+
+    if data.get('q', None) != query or len(data.get('p', [])) != segments:
+        raise ValueError('Cursor %s is not of the query' % cursor)
+
+    return data['p']
+
+
+def iter_task_items(taskid: str, status: str = None, projection: Iterable[str] = None,
+                    page_size: int = DEFAULT_PAGE_SIZE, cursor: str = None) -> ItemIterator:
+    """
+    Iterate the task items of a task by the index `TaskIndex`
+    Args:
+        taskid: The id of Task
+        status: Only the task items of the status if not `None`, e.g. `RUNNING`
+        projection: The attributes to read, e.g. `['S_Status', 'N_Progress']`, all attributes if `None`.
+            `S_ItemId`, `S_Source` and `S_TaskId` are always read
+        page_size: The max number of items read in one request
+        cursor: The cursor of a former iteration of the same query to resume
+    Returns:
+        An iterator of `TaskItem`
+    """
+    params = {
+        'IndexName': 'TaskIndex',
+        'KeyConditionExpression': 'S_TaskId = :taskid',
+        'ExpressionAttributeValues': {':taskid': taskid},
+    }
+    if status is not None:
+        params['FilterExpression'] = 'S_Status = :status'
+        params['ExpressionAttributeValues'][':status'] = status
+
+    return ItemIterator(taskitem_table_name, params, ('S_ItemId', 'S_TaskId'), TaskItem.from_item,
+                        _with(projection, _TASKITEM_KEYS), page_size, cursor)
+
+
+def iter_items_by_status(status: str, projection: Iterable[str] = None, page_size: int = DEFAULT_PAGE_SIZE,
+                         cursor: str = None) -> ItemIterator:
+    """
+    Iterate the task items of all tasks in a status by the index `StatusIndex`
+    Args:
+        status: The status of task items, e.g. `ERROR`
+        projection: The attributes to read, all attributes if `None`. `S_ItemId`, `S_Source`, `S_TaskId`
+            and `S_Status` are always read
+        page_size: The max number of items read in one request
+        cursor: The cursor of a former iteration of the same query to resume
+    Returns:
+        An iterator of `TaskItem`
+    """
+    params = {
+        'IndexName': 'StatusIndex',
+        'KeyConditionExpression': 'S_Status = :status',
+        'ExpressionAttributeValues': {':status': status},
+    }
+
+    return ItemIterator(taskitem_table_name, params, ('S_ItemId', 'S_Status'), TaskItem.from_item,
+                        _with(projection, _TASKITEM_KEYS), page_size, cursor)
+
+
+def iter_items_by_source(bucket: str, key: str, projection: Iterable[str] = None,
+                         page_size: int = DEFAULT_PAGE_SIZE, cursor: str = None) -> ItemIterator:
+    """
+    Iterate the task items of a source of all tasks by the index `SourceIndex`
+    Args:
+        bucket: Bucket name where the source in
+        key: Key of the source in bucket
+        projection: The attributes to read, all attributes if `None`. `S_ItemId`, `S_Source` and `S_TaskId`
+            are always read
+        page_size: The max number of items read in one request
+        cursor: The cursor of a former iteration of the same query to resume
+    Returns:
+        An iterator of `TaskItem`
+    """
+    params = {
+        'IndexName': 'SourceIndex',
+        'KeyConditionExpression': 'S_Source = :source',
+        'ExpressionAttributeValues': {':source': get_source(bucket, key)},
+    }
+
+    return ItemIterator(taskitem_table_name, params, ('S_ItemId', 'S_Source'), TaskItem.from_item,
+                        _with(projection, _TASKITEM_KEYS), page_size, cursor)
+
+
+def scan_task_items(taskid: str = None, status: str = None, segments: int = DEFAULT_SEGMENTS,
+                    projection: Iterable[str] = None, page_size: int = DEFAULT_PAGE_SIZE,
+                    cursor: str = None) -> ItemIterator:
+    """
+    Iterate the task items by a parallel scan of the table in segments, to read a very large task
+    (or all tasks) faster than the query of `iter_task_items` at the cost of reading the whole table.
+    The items are yielded in no order
+    Args:
+        taskid: Only the task items of the task if not `None`
+        status: Only the task items of the status if not `None`
+        segments: The number of segments read in parallel
+        projection: The attributes to read, all attributes if `None`. `S_ItemId`, `S_Source` and `S_TaskId`
+            are always read
+        page_size: The max number of items read in one request of a segment
+        cursor: The cursor of a former iteration of the same scan to resume
+    Returns:
+        An iterator of `TaskItem`
+    """
+    conditions = []
+    values = dict()
+    if taskid is not None:
+        conditions.append('S_TaskId = :taskid')
+        values[':taskid'] = taskid
+    if status is not None:
+        conditions.append('S_Status = :status')
+        values[':status'] = status
+
+    params = dict()
+    if len(conditions) > 0:
+        params['FilterExpression'] = ' AND '.join(conditions)
+        params['ExpressionAttributeValues'] = values
+
+    return ItemIterator(taskitem_table_name, params, ('S_ItemId',), TaskItem.from_item,
+                        _with(projection, _TASKITEM_KEYS), page_size, cursor, segments)
+
+
+def iter_tasks(segments: int = 1, projection: Iterable[str] = None, page_size: int = DEFAULT_PAGE_SIZE,
+               cursor: str = None) -> ItemIterator:
+    """
+    Iterate all tasks by a scan of the table, the shard items of counters are skipped and not
+    summed into the counters of tasks, use `get_task` to get the counters of a sharded task
+    Args:
+        segments: The number of segments read in parallel
+        projection: The attributes to read, all attributes if `None`. `S_TaskId` and `S_Bucket` are always read
+        page_size: The max number of items read in one request of a segment
+        cursor: The cursor of a former iteration of the same scan to resume
+    Returns:
+        An iterator of `Task`
+    """
+    params = {'FilterExpression': 'attribute_exists(S_Bucket)'}
+
+    return ItemIterator(task_table_name, params, ('S_TaskId',), Task.from_item, _with(projection, _TASK_KEYS),
+                        page_size, cursor, segments)
+
+
+def _with(projection: Iterable[str], keys: Iterable[str]) -> List[str]:
+    return None if projection is None else list(projection) + list(keys)